@@ -0,0 +1,131 @@
+# Copyright 2022 The Flax Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Import time and local throughput of `flax.training.checkpoints`.
+
+Compares the default POSIX storage backend for local paths with routing the
+same paths through `tensorflow.io.gfile`, and the peak host memory of
+restoring to host arrays (also converted to bfloat16 while they are read)
+versus streaming the leaves to a device.  The latter is only meaningful on
+accelerators, on the CPU backend device buffers are host memory.  Also times
+restoring a tree of many small leaves, both decoded at once and read leaf by
+leaf as large checkpoints are::
+
+  python benchmarks/checkpoint_benchmark.py --num_leaves=16 --leaf_mb=64
+"""
+
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from unittest import mock
+
+from absl import app
+from absl import flags
+from flax import io
+from flax.training import checkpoints
+import jax
+import numpy as np
+
+
+flags.DEFINE_integer('num_leaves', 16, 'Number of array leaves in the tree.')
+flags.DEFINE_integer('leaf_mb', 64, 'Size of every leaf in megabytes.')
+flags.DEFINE_integer('repeats', 3, 'Number of timed save/restore rounds.')
+flags.DEFINE_integer('num_small_leaves', 100000,
+                     'Number of float32[8] leaves in the tree of small leaves.')
+
+FLAGS = flags.FLAGS
+
+
+def _import_seconds(statement):
+  """Returns the wall time of running `statement` in a fresh interpreter."""
+  start = time.perf_counter()
+  subprocess.run([sys.executable, '-c', statement], check=True)
+  return time.perf_counter() - start
+
+
+def _throughput(tree, nbytes):
+  """Returns the best (save, restore) throughput in MB/s."""
+  save_times, restore_times = [], []
+  with tempfile.TemporaryDirectory() as ckpt_dir:
+    for step in range(FLAGS.repeats):
+      start = time.perf_counter()
+      checkpoints.save_checkpoint(ckpt_dir, tree, step)
+      save_times.append(time.perf_counter() - start)
+      start = time.perf_counter()
+      checkpoints.restore_checkpoint(ckpt_dir, tree)
+      restore_times.append(time.perf_counter() - start)
+  mb = nbytes / 2**20
+  return mb / min(save_times), mb / min(restore_times)
+
+
+def _restore_peak_mb(tree, **kwargs):
+  """Returns the peak traced host memory of a restore in MB."""
+  with tempfile.TemporaryDirectory() as ckpt_dir:
+    checkpoints.save_checkpoint(ckpt_dir, tree, 0)
+    tracemalloc.start()
+    restored = checkpoints.restore_checkpoint(ckpt_dir, None, **kwargs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del restored
+  return peak / 2**20
+
+
+def _restore_seconds(tree):
+  """Returns the best restore time of a checkpoint of `tree` in seconds."""
+  restore_times = []
+  with tempfile.TemporaryDirectory() as ckpt_dir:
+    checkpoints.save_checkpoint(ckpt_dir, tree, 0)
+    for _ in range(FLAGS.repeats):
+      start = time.perf_counter()
+      checkpoints.restore_checkpoint(ckpt_dir, None)
+      restore_times.append(time.perf_counter() - start)
+  return min(restore_times)
+
+
+def main(argv):
+  del argv
+  print('import time (s):')
+  print(f'  python:                    {_import_seconds("pass"):.2f}')
+  print(f'  flax.training.checkpoints: '
+        f'{_import_seconds("import flax.training.checkpoints"):.2f}')
+  print(f'  ... + tensorflow.io.gfile: '
+        f'{_import_seconds("import flax.training.checkpoints; import tensorflow"):.2f}')
+
+  size = (FLAGS.leaf_mb << 20) // 4
+  tree = {f'layer_{i}': np.full((size,), i, np.float32)
+          for i in range(FLAGS.num_leaves)}
+  nbytes = FLAGS.num_leaves * (FLAGS.leaf_mb << 20)
+  print(f'local throughput for {nbytes >> 20} MB (save, restore MB/s):')
+  print('  posix backend: %8.1f %8.1f' % _throughput(tree, nbytes))
+  with mock.patch.object(io, '_LOCAL_BACKEND', io.GFileBackend()):
+    print('  gfile backend: %8.1f %8.1f' % _throughput(tree, nbytes))
+  print(f'peak host memory of restoring {nbytes >> 20} MB (MB):')
+  print(f'  host arrays:        {_restore_peak_mb(tree):8.1f}')
+  print(f'  host, as bfloat16:  '
+        f'{_restore_peak_mb(tree, dtype=jax.numpy.bfloat16):8.1f}')
+  print(f'  streamed to device: '
+        f'{_restore_peak_mb(tree, placement=jax.devices()[0]):8.1f}')
+
+  tree = {f'layer_{i}': np.full((8,), i, np.float32)
+          for i in range(FLAGS.num_small_leaves)}
+  print(f'restore time of {FLAGS.num_small_leaves} small leaves (s):')
+  print(f'  decoded at once:  {_restore_seconds(tree):8.2f}')
+  with mock.patch.object(checkpoints, '_SMALL_CHECKPOINT_BYTES', 0):
+    print(f'  leaf by leaf:     {_restore_seconds(tree):8.2f}')
+
+
+if __name__ == '__main__':
+  app.run(main)
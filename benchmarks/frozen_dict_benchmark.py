@@ -0,0 +1,64 @@
+# Copyright 2022 The Flax Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Time of nested access and updates of a `flax.core.FrozenDict`.
+
+Accesses a leaf of a variables tree like
+``variables['params']['encoder']['layer_0']['kernel']`` and replaces or pops
+its ``batch_stats`` collection, for trees of growing size.  Neither depends on
+the size of the accessed or shared subtrees::
+
+  python benchmarks/frozen_dict_benchmark.py --num_layers=1000,10000
+"""
+
+import timeit
+
+from absl import app
+from absl import flags
+from flax.core import freeze
+import numpy as np
+
+
+flags.DEFINE_list('num_layers', ['100', '1000', '10000'],
+                  'Numbers of layers, every layer has four leaves.')
+flags.DEFINE_integer('number', 1000, 'Number of accesses per measurement.')
+
+FLAGS = flags.FLAGS
+
+
+def _microseconds(fn):
+  return min(timeit.repeat(fn, number=FLAGS.number, repeat=3)) / (
+      FLAGS.number * 1e-6)
+
+
+def main(argv):
+  del argv
+  print('us per operation:       access       copy        pop')
+  for num_layers in map(int, FLAGS.num_layers):
+    layers = {f'layer_{i}': {'kernel': np.zeros(()), 'bias': np.zeros(())}
+              for i in range(num_layers)}
+    variables = freeze({'params': {'encoder': layers},
+                        'batch_stats': {'encoder': layers}})
+    batch_stats = variables['batch_stats']
+    # pylint: disable=cell-var-from-loop
+    access = lambda: variables['params']['encoder']['layer_0']['kernel']
+    copy = lambda: variables.copy({'batch_stats': batch_stats})
+    pop = lambda: variables.pop('batch_stats')
+    # pylint: enable=cell-var-from-loop
+    print(f'  {4 * num_layers:6d} leaves: {_microseconds(access):10.2f} '
+          f'{_microseconds(copy):10.2f} {_microseconds(pop):10.2f}')
+
+
+if __name__ == '__main__':
+  app.run(main)
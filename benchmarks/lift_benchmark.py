@@ -0,0 +1,124 @@
+# Copyright 2022 The Flax Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Trace time of `apply` on a deep stack of nested lifted transforms.
+
+Every layer is rematerialized and vmaps its heads, so every layer goes through
+`lift.pack` twice.  Reports the trace time and the time spent in the
+bookkeeping of `lift.pack`, measured with `flax.profiling`.  Also times
+`lift.pack` on a scope tree containing a deep chain of nested scopes, as passed
+to a transform that is given the scopes of many submodules::
+
+  python benchmarks/lift_benchmark.py --num_layers=24,96 --num_scopes=96,384
+"""
+
+import time
+
+from absl import app
+from absl import flags
+from flax import linen as nn
+from flax import profiling
+from flax.core import lift
+from flax.core import Scope
+import jax
+import jax.numpy as jnp
+
+
+flags.DEFINE_list('num_layers', ['24', '96'], 'Numbers of layers.')
+flags.DEFINE_integer('features', 16, 'Hidden dimension.')
+flags.DEFINE_integer('num_heads', 4, 'Number of vmapped heads per layer.')
+flags.DEFINE_list('num_scopes', ['96', '384'],
+                  'Numbers of nested scopes passed to `lift.pack`.')
+flags.DEFINE_integer('num_calls', 10, 'Number of `lift.pack` calls to time.')
+
+FLAGS = flags.FLAGS
+
+# Entries of the profile that belong to the bookkeeping of `lift.pack`.
+_PACK_PHASES = ('lift._dedup_scopes', 'group_collections')
+
+
+class Layer(nn.Module):
+  features: int
+  num_heads: int
+
+  @nn.compact
+  def __call__(self, x):
+    heads = nn.vmap(nn.Dense, in_axes=None, out_axes=0,
+                    variable_axes={'params': 0}, split_rngs={'params': True},
+                    axis_size=self.num_heads)(self.features)(x)
+    x = x + heads.mean(axis=0)
+    return nn.LayerNorm()(x)
+
+
+class Stack(nn.Module):
+  num_layers: int
+  features: int
+  num_heads: int
+
+  @nn.compact
+  def __call__(self, x):
+    for _ in range(self.num_layers):
+      x = nn.remat(Layer)(self.features, self.num_heads)(x)
+    return x
+
+
+def _pack_identity(scopes):
+  def inner(scope_fn, repack, variable_groups, rng_groups):
+    return None, repack(scope_fn(variable_groups, rng_groups))
+  lift.pack(inner, (True,), (True,), (True,), name='identity')(scopes)
+
+
+def _nested_scopes(num_scopes):
+  """Returns a chain of scopes, each with params and a batch_stats entry."""
+  root = Scope({'params': {}, 'batch_stats': {}},
+               rngs={'params': jax.random.PRNGKey(0)}, mutable=True)
+  scopes = [root]
+  for i in range(num_scopes - 1):
+    scopes.append(scopes[-1].push(f'layer_{i}'))
+  for scope in scopes:
+    scope.put_variable('params', 'kernel', jnp.zeros(()))
+    scope.put_variable('batch_stats', 'mean', jnp.zeros(()))
+  return scopes
+
+
+def main(argv):
+  del argv
+  print('lift.pack seconds per call:')
+  for num_scopes in map(int, FLAGS.num_scopes):
+    scopes = _nested_scopes(num_scopes)
+    _pack_identity(scopes)
+    start = time.perf_counter()
+    for _ in range(FLAGS.num_calls):
+      _pack_identity(scopes)
+    seconds = (time.perf_counter() - start) / FLAGS.num_calls
+    print(f'  {num_scopes:4d} scopes: {seconds:10.4f}')
+  print('apply trace seconds:     total      pack bookkeeping')
+  for num_layers in map(int, FLAGS.num_layers):
+    model = Stack(num_layers, FLAGS.features, FLAGS.num_heads)
+    x = jnp.ones((2, FLAGS.features))
+    variables = model.init(jax.random.PRNGKey(0), x)
+    # A fresh function, `jax.jit` caches traces per function.
+    apply_fn = lambda v, x: model.apply(v, x)  # pylint: disable=unnecessary-lambda
+    start = time.perf_counter()
+    jax.jit(apply_fn).lower(variables, x)
+    total = time.perf_counter() - start
+    with profiling.trace_profile() as profile:
+      jax.jit(lambda v, x: model.apply(v, x)).lower(variables, x)
+    pack = sum(stat.self_time for stat in profile.summary(by_path=False)
+               if stat.name in _PACK_PHASES)
+    print(f'  {num_layers:4d} layers: {total:12.2f} {pack:16.3f}')
+
+
+if __name__ == '__main__':
+  app.run(main)
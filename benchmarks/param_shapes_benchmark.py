@@ -0,0 +1,98 @@
+# Copyright 2022 The Flax Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Trace time of `apply` on a deep Transformer encoder.
+
+`Scope.param` validates the shapes of existing params against the shapes their
+initializers would produce.  Compares tracing `apply` while tracing every
+initializer for every param with the shapes cached per initializer and
+arguments::
+
+  python benchmarks/param_shapes_benchmark.py --num_layers=24,48
+"""
+
+import time
+from unittest import mock
+
+from absl import app
+from absl import flags
+from flax import linen as nn
+from flax.core import scope
+import jax
+import jax.numpy as jnp
+
+
+flags.DEFINE_list('num_layers', ['12', '48'], 'Numbers of encoder layers.')
+flags.DEFINE_integer('features', 64, 'Model dimension.')
+
+FLAGS = flags.FLAGS
+
+
+class EncoderLayer(nn.Module):
+  features: int
+
+  @nn.compact
+  def __call__(self, x):
+    y = nn.LayerNorm()(x)
+    y = nn.SelfAttention(num_heads=4)(y)
+    x = x + y
+    y = nn.LayerNorm()(x)
+    y = nn.Dense(4 * self.features)(y)
+    y = nn.Dense(self.features)(nn.relu(y))
+    return x + y
+
+
+class Encoder(nn.Module):
+  num_layers: int
+  features: int
+
+  @nn.compact
+  def __call__(self, x):
+    for _ in range(self.num_layers):
+      x = EncoderLayer(self.features)(x)
+    return nn.LayerNorm()(x)
+
+
+def _traced_init_shapes(init_fn, init_args):
+  abs_rng = jax.ShapeDtypeStruct(scope._default_key_shape(), jnp.uint32)  # pylint: disable=protected-access
+  abs_value = jax.eval_shape(lambda rng: init_fn(rng, *init_args), abs_rng)
+  return tuple(jnp.shape(x) for x in jax.tree_util.tree_leaves(abs_value))
+
+
+def _trace_seconds(model, variables, x):
+  start = time.perf_counter()
+  jax.jit(model.apply).lower(variables, x)
+  return time.perf_counter() - start
+
+
+def main(argv):
+  del argv
+  print('apply trace seconds:     traced    cached')
+  for num_layers in map(int, FLAGS.num_layers):
+    model = Encoder(num_layers, FLAGS.features)
+    x = jnp.ones((1, 16, FLAGS.features))
+    variables = model.init(jax.random.PRNGKey(0), x)
+    num_params = len(jax.tree_util.tree_leaves(variables))
+    traced, cached = [], []
+    for _ in range(2):
+      with mock.patch.object(scope, '_abstract_init_shapes',
+                             _traced_init_shapes):
+        traced.append(_trace_seconds(model, variables, x))
+      cached.append(_trace_seconds(model, variables, x))
+    traced, cached = min(traced), min(cached)
+    print(f'  {num_params:5d} params: {traced:9.2f} {cached:9.2f}')
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,81 @@
+# Copyright 2022 The Flax Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Trace time of `init` and `apply` on a deep MLP with many dropout layers.
+
+Every submodule derives its rngs from the rngs of its parent and every
+`make_rng` call folds in a counter.  Traces both with the default rngs and with
+`flax_lazy_rng`::
+
+  python benchmarks/rng_benchmark.py --num_layers=100,200
+"""
+
+import time
+from unittest import mock
+
+from absl import app
+from absl import flags
+from flax import config
+from flax import linen as nn
+import jax
+import jax.numpy as jnp
+
+
+flags.DEFINE_list('num_layers', ['100', '200'], 'Numbers of dropout layers.')
+flags.DEFINE_integer('features', 16, 'Hidden dimension.')
+
+FLAGS = flags.FLAGS
+
+
+class DropoutMLP(nn.Module):
+  num_layers: int
+  features: int
+
+  @nn.compact
+  def __call__(self, x):
+    for _ in range(self.num_layers):
+      x = nn.Dense(self.features)(x)
+      x = nn.Dropout(0.1, deterministic=False)(nn.relu(x))
+    return x
+
+
+def _trace_seconds(fn, *args):
+  # A fresh function, `jax.jit` caches traces per function.
+  traced_fn = lambda *args: fn(*args)  # pylint: disable=unnecessary-lambda
+  start = time.perf_counter()
+  jax.jit(traced_fn).lower(*args)
+  return time.perf_counter() - start
+
+
+def main(argv):
+  del argv
+  print('trace seconds:         init     apply')
+  for num_layers in map(int, FLAGS.num_layers):
+    model = DropoutMLP(num_layers, FLAGS.features)
+    x = jnp.ones((1, FLAGS.features))
+    rngs = {'params': jax.random.PRNGKey(0),
+            'dropout': jax.random.PRNGKey(1)}
+    for lazy_rng in (False, True):
+      with mock.patch.object(config, 'flax_lazy_rng', lazy_rng):
+        variables = model.init(rngs, x)
+        apply_fn = lambda v, x, rng: model.apply(v, x, rngs={'dropout': rng})
+        init_s = min(_trace_seconds(model.init, rngs, x) for _ in range(2))
+        apply_s = min(_trace_seconds(apply_fn, variables, x, rngs['dropout'])
+                      for _ in range(2))
+      mode = 'lazy' if lazy_rng else 'legacy'
+      print(f'  {num_layers:4d} layers {mode:6s} {init_s:8.2f} {apply_s:9.2f}')
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,184 @@
+# Copyright 2022 The Flax Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Peak host memory and wall time of Flax checkpoint serialization.
+
+Serializes a synthetic tree of float32 leaves to a temporary file, restores it
+again and reports the peak traced allocation size (numpy buffers are tracked by
+`tracemalloc`) together with the wall time of every code path, including
+saving and restoring with compressed leaves.  A single array above
+`MAX_CHUNK_SIZE` measures the chunked code paths, for which the increase of the
+resident set size of a forked process is reported as well (Linux only)::
+
+  python benchmarks/serialization_benchmark.py --num_leaves=16 --leaf_mb=64
+  python benchmarks/serialization_benchmark.py --chunked_mb=2100
+"""
+
+import mmap
+import os
+import resource
+import tempfile
+import time
+import tracemalloc
+
+from absl import app
+from absl import flags
+from flax import serialization
+import numpy as np
+
+
+flags.DEFINE_integer('num_leaves', 16, 'Number of array leaves in the tree.')
+flags.DEFINE_integer('leaf_mb', 64, 'Size of every leaf in megabytes.')
+flags.DEFINE_string('codec', 'zlib', 'Codec used for the compressed rows.')
+flags.DEFINE_integer('chunked_mb', 0,
+                     'Size of the chunked array in megabytes, 0 to skip.')
+flags.DEFINE_integer('max_chunk_mb', None,
+                     'Overrides `serialization.MAX_CHUNK_SIZE` in megabytes.')
+
+FLAGS = flags.FLAGS
+
+
+def _make_tree(num_leaves, leaf_mb):
+  size = (leaf_mb << 20) // 4
+  return {f'layer_{i}': {'kernel': np.full((size,), i, np.float32)}
+          for i in range(num_leaves)}
+
+
+def _save_bytes(tree, path):
+  with open(path, 'wb') as fp:
+    fp.write(serialization.to_bytes(tree))
+
+
+def _save_streaming(tree, path):
+  with open(path, 'wb') as fp:
+    serialization.to_file(tree, fp)
+
+
+def _save_compressed(tree, path):
+  with open(path, 'wb') as fp:
+    serialization.to_file(tree, fp, codec=FLAGS.codec)
+
+
+def _restore_bytes(tree, path):
+  with open(path, 'rb') as fp:
+    return serialization.from_bytes(tree, fp.read())
+
+
+def _open_lazy(path):
+  with open(path, 'rb') as fp:
+    contents = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+  return serialization.msgpack_restore_lazy(contents)
+
+
+def _restore_lazy_subtree(tree, path):
+  """Restores only the first layer of `tree` from a lazily opened file."""
+  name = next(iter(tree))
+  return serialization.from_state_dict({name: tree[name]}, _open_lazy(path))
+
+
+def _restore_lazy_parallel(path):
+  with open(path, 'rb') as fp:
+    return serialization.materialize_parallel(
+        serialization.msgpack_restore_lazy(fp))
+
+
+def _measure(fn, *args):
+  """Returns (peak traced bytes, seconds) of calling `fn(*args)`."""
+  tracemalloc.start()
+  tracemalloc.reset_peak()
+  base, _ = tracemalloc.get_traced_memory()
+  start = time.perf_counter()
+  fn(*args)
+  elapsed = time.perf_counter() - start
+  _, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  return peak - base, elapsed
+
+
+def _measure_rss(fn, *args):
+  """Returns the peak increase of the resident set size of `fn(*args)`.
+
+  `fn` runs in a forked child process, so the measurement is not affected by
+  memory that the allocator of this process retained from earlier runs.
+  """
+  read_fd, write_fd = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    with open('/proc/self/statm') as f:
+      base = int(f.read().split()[1]) * resource.getpagesize()
+    fn(*args)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    os.write(write_fd, str(peak - base).encode())
+    os._exit(0)  # pylint: disable=protected-access
+  os.close(write_fd)
+  with os.fdopen(read_fd) as f:
+    result = int(f.read())
+  os.waitpid(pid, 0)
+  return result
+
+
+def _chunked_main():
+  """Measures saving and restoring a single array above MAX_CHUNK_SIZE."""
+  tree = {'embedding': np.ones(((FLAGS.chunked_mb << 20) // 4,), np.float32)}
+  print(f'chunked array: {FLAGS.chunked_mb} MB, MAX_CHUNK_SIZE: '
+        f'{serialization.MAX_CHUNK_SIZE >> 20} MB')
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    path = os.path.join(tmp_dir, 'checkpoint')
+    fns = (('to_file', _save_streaming, tree, path),
+           ('from_bytes', _restore_bytes, tree, path),
+           ('lazy + parallel read', _restore_lazy_parallel, path))
+    for name, fn, *args in fns:
+      peak, elapsed = _measure(fn, *args)
+      rss = _measure_rss(fn, *args)
+      print(f'{name:>20}: peak {peak / 2**20:10.1f} MB '
+            f'({peak / 2**20 / FLAGS.chunked_mb:.2f}x array), '
+            f'rss {rss / 2**20:10.1f} MB '
+            f'({rss / 2**20 / FLAGS.chunked_mb:.2f}x array), {elapsed:.2f} s')
+
+
+def main(argv):
+  del argv
+  if FLAGS.max_chunk_mb is not None:
+    serialization.MAX_CHUNK_SIZE = FLAGS.max_chunk_mb << 20
+  if FLAGS.chunked_mb:
+    _chunked_main()
+    return
+  tree = _make_tree(FLAGS.num_leaves, FLAGS.leaf_mb)
+  tree_mb = FLAGS.num_leaves * FLAGS.leaf_mb
+  print(f'tree size: {tree_mb} MB')
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    path = os.path.join(tmp_dir, 'checkpoint')
+    for name, fn in (('to_bytes', _save_bytes), ('to_file', _save_streaming)):
+      peak, elapsed = _measure(fn, tree, path)
+      print(f'{name:>20}: peak {peak / 2**20:10.1f} MB '
+            f'({peak / 2**20 / tree_mb:.2f}x tree), {elapsed:.2f} s')
+    compressed_path = path + '.' + FLAGS.codec
+    peak, elapsed = _measure(_save_compressed, tree, compressed_path)
+    print(f'{"to_file " + FLAGS.codec:>20}: peak {peak / 2**20:10.1f} MB '
+          f'({peak / 2**20 / tree_mb:.2f}x tree), {elapsed:.2f} s')
+    restore_fns = (('from_bytes', _restore_bytes, tree, path),
+                   ('lazy open', _open_lazy, path),
+                   ('lazy first layer', _restore_lazy_subtree, tree, path),
+                   ('from_bytes ' + FLAGS.codec, _restore_bytes, tree,
+                    compressed_path))
+    for name, fn, *args in restore_fns:
+      peak, elapsed = _measure(fn, *args)
+      print(f'{name:>20}: peak {peak / 2**20:10.1f} MB '
+            f'({peak / 2**20 / tree_mb:.2f}x tree), {elapsed:.2f} s')
+    print(f'file size: {os.path.getsize(path) / 2**20:.1f} MB, '
+          f'{FLAGS.codec}: {os.path.getsize(compressed_path) / 2**20:.1f} MB')
+
+
+if __name__ == '__main__':
+  app.run(main)
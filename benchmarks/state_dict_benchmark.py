@@ -0,0 +1,91 @@
+# Copyright 2022 The Flax Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Time of `flax.serialization.to_state_dict` and `from_state_dict`.
+
+Compares the bulk conversion of a train state with many small leaves, which
+flattens the target once and reuses a layout cached per tree structure, with
+the recursive conversion of every node::
+
+  python benchmarks/state_dict_benchmark.py --num_layers=10000
+"""
+
+import time
+from typing import Any, NamedTuple
+
+from absl import app
+from absl import flags
+from flax import serialization
+from flax import struct
+from flax.core import freeze
+import numpy as np
+
+
+flags.DEFINE_integer('num_layers', 10000, 'Number of layers in the tree.')
+flags.DEFINE_integer('repeats', 3, 'Number of timed conversions.')
+
+FLAGS = flags.FLAGS
+
+
+class _AdamState(NamedTuple):
+  mu: Any
+  nu: Any
+
+
+@struct.dataclass
+class _TrainState:
+  step: int
+  params: Any
+  opt_state: _AdamState
+
+
+def _best_seconds(fn):
+  times = []
+  for _ in range(FLAGS.repeats):
+    start = time.perf_counter()
+    fn()
+    times.append(time.perf_counter() - start)
+  return min(times)
+
+
+def main(argv):
+  del argv
+  params = freeze({
+      f'layer_{i}': {f'dense_{j}': {'kernel': np.ones((2, 2), np.float32),
+                                    'bias': np.zeros((2,), np.float32)}
+                     for j in range(5)}
+      for i in range(FLAGS.num_layers)})
+  state = _TrainState(step=0, params=params,
+                      opt_state=_AdamState(mu=params, nu=params))
+  state_dict = serialization.to_state_dict(state)
+  num_leaves = 3 * 10 * FLAGS.num_layers
+
+  print(f'state dict conversion of {num_leaves} leaves (to, from s):')
+  start = time.perf_counter()
+  serialization._state_dict_layout.cache_clear()  # pylint: disable=protected-access
+  serialization._is_restorable.cache_clear()  # pylint: disable=protected-access
+  serialization.from_state_dict(state, serialization.to_state_dict(state))
+  print(f'  layout (first use): {time.perf_counter() - start:8.2f}')
+  print('  bulk:      %8.2f %8.2f' % (
+      _best_seconds(lambda: serialization.to_state_dict(state)),
+      _best_seconds(lambda: serialization.from_state_dict(state, state_dict))))
+  with serialization._recursive_conversion():  # pylint: disable=protected-access
+    print('  recursive: %8.2f %8.2f' % (
+        _best_seconds(lambda: serialization.to_state_dict(state)),
+        _best_seconds(
+            lambda: serialization.from_state_dict(state, state_dict))))
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,106 @@
+# Copyright 2022 The Flax Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Time of `flatten_dict` and `unflatten_dict` on Transformer parameters.
+
+Compares the recursive implementation with the `PathIndex` cached per tree
+structure, for the parameters of encoder-decoder Transformers with growing
+numbers of layers, and times selecting all kernels by a regular expression::
+
+  python benchmarks/traverse_util_benchmark.py --num_layers=12,48
+"""
+
+import re
+import timeit
+
+from absl import app
+from absl import flags
+from flax import traverse_util
+from flax.core import freeze
+import jax
+import numpy as np
+
+
+flags.DEFINE_list('num_layers', ['6', '24', '96'],
+                  'Numbers of encoder and decoder layers.')
+flags.DEFINE_integer('number', 100, 'Number of calls per measurement.')
+
+FLAGS = flags.FLAGS
+
+
+def _dense():
+  return {'kernel': np.zeros(()), 'bias': np.zeros(())}
+
+
+def _layer_norm():
+  return {'scale': np.zeros(()), 'bias': np.zeros(())}
+
+
+def _attention():
+  return {name: _dense() for name in ('query', 'key', 'value', 'out')}
+
+
+def _transformer_params(num_layers):
+  encoder = {f'encoderblock_{i}': {
+      'LayerNorm_0': _layer_norm(), 'SelfAttention_0': _attention(),
+      'LayerNorm_1': _layer_norm(),
+      'MlpBlock_0': {'Dense_0': _dense(), 'Dense_1': _dense()},
+  } for i in range(num_layers)}
+  decoder = {f'encoderdecoderblock_{i}': {
+      'LayerNorm_0': _layer_norm(), 'SelfAttention_0': _attention(),
+      'LayerNorm_1': _layer_norm(), 'MultiHeadDotProductAttention_0':
+          _attention(), 'LayerNorm_2': _layer_norm(),
+      'MlpBlock_0': {'Dense_0': _dense(), 'Dense_1': _dense()},
+  } for i in range(num_layers)}
+  encoder['encoder_norm'] = _layer_norm()
+  decoder['encoderdecoder_norm'] = _layer_norm()
+  return freeze({'shared_embedding': {'embedding': np.zeros(())},
+                 'encoder': encoder, 'decoder': decoder})
+
+
+def _select(params, pattern):
+  leaves = jax.tree_util.tree_leaves(params)
+  return [leaves[i] for i in traverse_util.path_index(params).match(pattern)]
+
+
+def _microseconds(fn):
+  return min(timeit.repeat(fn, number=FLAGS.number, repeat=3)) / (
+      FLAGS.number * 1e-6)
+
+
+def main(argv):
+  del argv
+  print('us per call:     flatten           unflatten         select kernels')
+  print('              recursive indexed  recursive indexed  recursive indexed')
+  for num_layers in map(int, FLAGS.num_layers):
+    params = _transformer_params(num_layers)
+    flat = traverse_util.flatten_dict(params)
+    kernel = re.compile(r'/kernel$')
+    # pylint: disable=cell-var-from-loop
+    times = [
+        lambda: traverse_util._flatten_dict_recursive(params),  # pylint: disable=protected-access
+        lambda: traverse_util.flatten_dict(params),
+        lambda: traverse_util._unflatten_dict_recursive(flat),  # pylint: disable=protected-access
+        lambda: traverse_util.unflatten_dict(flat),
+        lambda: [value for key, value in traverse_util._flatten_dict_recursive(  # pylint: disable=protected-access
+            params).items() if kernel.search('/' + '/'.join(key))],
+        lambda: _select(params, r'/kernel$'),
+    ]
+    # pylint: enable=cell-var-from-loop
+    times = ' '.join(f'{_microseconds(fn):9.1f}' for fn in times)
+    print(f'{len(flat):5d} leaves: {times}')
+
+
+if __name__ == '__main__':
+  app.run(main)
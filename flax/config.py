@@ -23,6 +23,11 @@
 
     Whether to automatically wrap Module methods with named_call for profiles.
     Set by the FLAX_PROFILE environment variable.  Defaults to False.
+
+.. data:: flax_trace_profile
+
+    Whether to record the time Flax spends while tracing, see `flax.profiling`.
+    Set by the FLAX_TRACE_PROFILE environment variable.  Defaults to False.
 """
 
 import os
@@ -59,5 +64,8 @@ flax_filter_frames = bool_env('FLAX_FILTER_FRAMES', True)
 # Whether to automatically wrap Module methods with named_call for profiles.
 flax_profile = bool_env('FLAX_PROFILE', False)
 
+# Whether to record the time Flax spends while tracing.
+flax_trace_profile = bool_env('FLAX_TRACE_PROFILE', False)
+
 # Whether to use the lazy rng implementation
 flax_lazy_rng = bool_env('FLAX_LAZY_RNG', False)
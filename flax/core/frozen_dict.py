@@ -63,7 +63,7 @@ class FrozenDict(Mapping[K, V]):
   def __getitem__(self, key):
     v = self._dict[key]
     if isinstance(v, dict):
-      return FrozenDict(v)
+      return _wrap_frozen(v)
     return v
 
   def __setitem__(self, key, value):
@@ -107,8 +107,16 @@ class FrozenDict(Mapping[K, V]):
     return self._hash
 
   def copy(self, add_or_replace: Mapping[K, V]) -> 'FrozenDict[K, V]':
-    """Create a new FrozenDict with additional or replaced entries."""
-    return type(self)({**self, **unfreeze(add_or_replace)})
+    """Create a new FrozenDict with additional or replaced entries.
+
+    The entries of this FrozenDict and FrozenDict values of `add_or_replace`
+    are shared with the new FrozenDict instead of copied, so replacing e.g. a
+    collection of a variables dict takes time proportional to the number of
+    top-level keys.
+    """
+    new_dict = dict(self._dict)
+    new_dict.update(_prepare_freeze(dict(add_or_replace)))
+    return type(self)(new_dict, __unsafe_skip_copy__=True)
 
   def keys(self):
     return FrozenKeysView(self)
@@ -135,7 +143,8 @@ class FrozenDict(Mapping[K, V]):
     value = self[key]
     new_dict = dict(self._dict)
     new_dict.pop(key)
-    new_self = type(self)(new_dict)
+    # The remaining values are already frozen and can be shared.
+    new_self = type(self)(new_dict, __unsafe_skip_copy__=True)
     return new_self, value
 
   def unfreeze(self) -> Dict[K, V]:
@@ -161,6 +170,18 @@ class FrozenDict(Mapping[K, V]):
     return cls(*data, __unsafe_skip_copy__=True)
 
 
+def _wrap_frozen(xs: Dict[Any, Any]) -> FrozenDict:
+  """Wraps a nested dict of a FrozenDict in O(1), without copying it.
+
+  The nested dicts of a FrozenDict are private copies that are never mutated,
+  so nested FrozenDicts can share them.
+  """
+  frozen = FrozenDict.__new__(FrozenDict)
+  frozen._dict = xs  # pylint: disable=protected-access
+  frozen._hash = None  # pylint: disable=protected-access
+  return frozen
+
+
 def _prepare_freeze(xs: Any) -> Any:
   """Deep copy unfrozen dicts to make the dictionary FrozenDict safe."""
   if isinstance(xs, FrozenDict):
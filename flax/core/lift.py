@@ -20,6 +20,7 @@ import functools
 import warnings
 
 
+from flax import profiling
 from flax import traceback_util
 import jax
 from jax import random
@@ -31,7 +32,8 @@ from .frozen_dict import FrozenDict
 from .frozen_dict import unfreeze
 
 from .scope import (RNGSequences, Scope, DenyList, CollectionFilter, PRNGSequenceFilter,
-    is_filter_empty, in_filter, union_filters, intersect_filters, subtract_filters, group_collections)
+    is_filter_empty, in_filter, union_filters, intersect_filters, subtract_filters, group_collections,
+    _compile_filter, _group_collections)
 
 from . import axes_scan
 
@@ -45,40 +47,80 @@ def tree_map_rngs(fn, tree):
   return jax.tree_map(fn, tree, is_leaf=lambda x: isinstance(x, random.KeyArray))
 
 
+@profiling.record('lift._dedup_scopes')
 def _dedup_scopes(scopes):
-  paths = []
+  """Removes the scopes that are descendants of other scopes in `scopes`.
+
+  Returns the minimal set of scopes and, for each scope in `scopes`, its
+  furthest ancestor in the minimal set and the path from that ancestor to it.
+  """
+  if len(scopes) == 1:
+    return tuple(scopes), ((scopes[0], ()),)
   # must preseve insertion order for duplication to work correctly
   minimal_set = collections.OrderedDict((s, ()) for s in scopes)
+  # Maps the id of a scope to its furthest ancestor in `minimal_set` and the
+  # path from that ancestor, or None if no ancestor is in `minimal_set`.  Each
+  # scope in the parent chains is only visited once.
+  ancestors = {}
+  paths = []
   for leaf in scopes:
-    scope = leaf.parent
-    max_parent = leaf
-    max_parent_path = ()
-    path = [leaf.name]
-    while scope is not None:
-      if scope in minimal_set:
-        max_parent = scope
-        max_parent_path = tuple(reversed(path))
-      path.append(scope.name)
+    chain = []
+    scope = leaf
+    while scope is not None and id(scope) not in ancestors:
+      chain.append(scope)
       scope = scope.parent
-    if max_parent is not leaf and leaf in minimal_set:
-      del minimal_set[leaf]
-    paths.append((max_parent, max_parent_path))
+    for scope in reversed(chain):
+      parent = scope.parent
+      if parent is None:
+        ancestor = None
+      elif ancestors[id(parent)] is not None:
+        max_parent, max_parent_path = ancestors[id(parent)]
+        ancestor = (max_parent, max_parent_path + (scope.name,))
+      elif parent in minimal_set:
+        ancestor = (parent, (scope.name,))
+      else:
+        ancestor = None
+      ancestors[id(scope)] = ancestor
+    ancestor = ancestors[id(leaf)]
+    if ancestor is None:
+      paths.append((leaf, ()))
+    else:
+      paths.append(ancestor)
+      minimal_set.pop(leaf, None)
   return tuple(minimal_set), tuple(paths)
 
 
 def _dup_scopes(orig_scopes, scopes, paths):
   mapping = dict(zip(orig_scopes, scopes))
+  # Child scopes are pushed once per root and path, so scopes sharing a path
+  # prefix share the pushed scopes.
+  pushed = {}
   scopes = []
   for root, path in paths:
     scope = mapping[root]
-    for name in path:
-      scope = scope.push(name, reuse=True)
+    root_id = id(scope)
+    # Find the longest prefix of the path that was already pushed.
+    i = len(path)
+    while i > 0 and (root_id, path[:i]) not in pushed:
+      i -= 1
+    if i > 0:
+      scope = pushed[root_id, path[:i]]
+    for j in range(i, len(path)):
+      scope = scope.push(path[j], reuse=True)
+      pushed[root_id, path[:j + 1]] = scope
     scopes.append(scope)
   return scopes
 
+
 def _transpose(xs):
   return tuple(zip(*xs))
 
+
+def _scope_tree_path(scope_tree, *args, **kwargs):
+  del args, kwargs
+  scopes = jax.tree_leaves(scope_tree)
+  return scopes[0].path_text if scopes else ''
+
 def pack(fn: Callable[..., Any],
          in_variable_filters: Sequence[CollectionFilter],
          out_variable_filters: Sequence[CollectionFilter],
@@ -89,6 +131,15 @@ def pack(fn: Callable[..., Any],
 
   The pack function is the building block for all other lifted transformations.
   """
+  in_variable_predicates = [_compile_filter(f) for f in in_variable_filters]
+  out_variable_predicates = [_compile_filter(f)
+                             for f in tuple(out_variable_filters) + (True,)]
+  rng_predicates = [_compile_filter(f) for f in rng_filters]
+  out_mutable = False
+  for out_filter in out_variable_filters:
+    out_mutable = union_filters(out_mutable, out_filter)
+
+  @profiling.record(f'lift.{name or "pack"}', _scope_tree_path)
   @functools.wraps(fn)
   def wrapper(scope_tree: Scope, *args, **kwargs):
     if not enable_kwargs and kwargs:
@@ -103,8 +154,8 @@ def pack(fn: Callable[..., Any],
     for scope in scopes:
       scope._validate_trace_level()
       scope._populate_collections()
-      variable_groups_xs.append(group_collections(
-          scope._variables, in_variable_filters))
+      variable_groups_xs.append(_group_collections(
+          scope._variables, in_variable_predicates))
     variable_groups_xs_t = _transpose(variable_groups_xs)
 
     # Make sure that in-only variable collections are frozen
@@ -112,15 +163,15 @@ def pack(fn: Callable[..., Any],
       for variable_group in variable_group_xs:
         for col_name, collection in variable_group.items():
           col_in_out = any(
-              in_filter(col_filter, col_name)
-              for col_filter in out_variable_filters)
+              out_predicate(col_name)
+              for out_predicate in out_variable_predicates[:-1])
           if not col_in_out:
             variable_group[col_name] = freeze(collection)
     rng_groups_xs = []
     inner_rng_counters = []
     for scope in scopes:
       rng_counters = scope.rng_counters
-      rng_groups = group_collections(scope.rngs, rng_filters)
+      rng_groups = _group_collections(scope.rngs, rng_predicates)
       rng_groups_xs.append(rng_groups)
       inner_rng_counters.append(rng_counters)
     rng_groups_xs_t = _transpose(rng_groups_xs)
@@ -131,9 +182,6 @@ def pack(fn: Callable[..., Any],
       for inner_scope in inner_scopes:
         inner_scope.invalidate()
       inner_scopes = []
-      mutable = False
-      for out_filter in out_variable_filters:
-        mutable = union_filters(mutable, out_filter)
       # could be () in the edge case where no rngs or variable_groups are lifted
       # in this case fallback to ((),) * len(scopes) to make sure the zip has something
       # to iterate over for each scope.
@@ -150,7 +198,7 @@ def pack(fn: Callable[..., Any],
           rngs.update(rng_group)
         # make sure variable dicts are cloned and can't be manipulated by ref sharing.
         variables = jax.tree_map(lambda x: x, variables)
-        scope_mutable = intersect_filters(scope.mutable, mutable)
+        scope_mutable = intersect_filters(scope.mutable, out_mutable)
         new_path = scope.path
         if name:
           if new_path:
@@ -178,8 +226,8 @@ def pack(fn: Callable[..., Any],
         mutable_variables = {key: val for key, val
                              in inner_scope._variables.items()
                              if in_filter(inner_scope.mutable, key)}
-        out_variable_groups = group_collections(
-            mutable_variables, tuple(out_variable_filters) + (True,))
+        out_variable_groups = _group_collections(
+            mutable_variables, out_variable_predicates)
         remainder = tuple(out_variable_groups[-1].keys())
         if remainder:
           raise ValueError(f'unmapped output variables: {remainder}')
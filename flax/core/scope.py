@@ -20,6 +20,7 @@ import hashlib
 import dataclasses
 
 import typing
+import weakref
 from typing import (Any, Callable, Dict, Generic, Iterable, Mapping, Optional,
                     Sequence, Set, Tuple, TypeVar, Union)
 
@@ -28,6 +29,7 @@ from flax import errors
 from flax import traceback_util
 from flax import struct
 from flax import config
+from flax import profiling
 from .frozen_dict import freeze
 from .frozen_dict import FrozenDict
 from .frozen_dict import unfreeze
@@ -101,14 +103,74 @@ class LazyRng(struct.PyTreeNode):
       return LazyRng(rng, suffix)
 
 
+class _ChildRng:
+  """The rng of a child scope, derived from its parent's rng on first use.
+
+  Without `flax_lazy_rng`, pushing a child scope folds the child's name into
+  every rng sequence. Deferring the fold-in skips it for sequences the child and
+  its descendants never use, e.g. 'dropout' in a `Dense` layer. The result is
+  cached, so every rng is still folded in at most once.
+  """
+  __slots__ = ('_parent', '_name', '_rng')
+
+  def __init__(self, parent: Union['_ChildRng', LazyRng], name: str):
+    self._parent = parent
+    self._name = name
+    self._rng = None
+
+  def get(self) -> LazyRng:
+    if self._rng is None:
+      self._rng = LazyRng.create(_materialize_rng(self._parent), self._name)
+      self._parent = None
+    return self._rng
+
+
+def _materialize_rng(rng: Union[_ChildRng, LazyRng]) -> LazyRng:
+  if isinstance(rng, _ChildRng):
+    return rng.get()
+  return rng
+
+
+class _RngView(Mapping[str, LazyRng]):
+  """A read-only view of the rngs of a scope.
+
+  Deferred rngs are derived from their parent's rng when they are looked up,
+  so looking up one sequence doesn't fold in the others.
+  """
+  __slots__ = ('_rngs',)
+
+  def __init__(self, rngs: Dict[str, Union[_ChildRng, LazyRng]]):
+    self._rngs = rngs
+
+  def __getitem__(self, name: str) -> LazyRng:
+    return _materialize_rng(self._rngs[name])
+
+  def __contains__(self, name: Any) -> bool:
+    return name in self._rngs
+
+  def __iter__(self):
+    return iter(self._rngs)
+
+  def __len__(self) -> int:
+    return len(self._rngs)
+
+  def __repr__(self) -> str:
+    return f'{type(self).__name__}({dict(self)!r})'
+
+
+@functools.lru_cache(maxsize=4096)
+def _str_hash(x: str) -> int:
+  """Returns the first 4 bytes of the SHA-1 hash of a string as an integer."""
+  m = hashlib.sha1()
+  m.update(x.encode('utf-8'))
+  d = m.digest()
+  return int.from_bytes(d[:4], byteorder='big')
+
+
 def _legacy_rng_fold_in(rng: PRNGKey, data: Iterable[PRNGFoldable]) -> PRNGKey:
   for x in data:
     if isinstance(x, str):
-      m = hashlib.sha1()
-      m.update(x.encode('utf-8'))
-      d = m.digest()
-      hash_int = int.from_bytes(d[:4], byteorder='big')
-      rng = random.fold_in(rng, jnp.uint32(hash_int))
+      rng = random.fold_in(rng, np.uint32(_str_hash(x)))
     elif isinstance(x, int):
       rng = random.fold_in(rng, x)
     else:
@@ -116,11 +178,34 @@ def _legacy_rng_fold_in(rng: PRNGKey, data: Iterable[PRNGFoldable]) -> PRNGKey:
   return rng
 
 
+@functools.lru_cache(maxsize=4096)
+def _sha1_state(data: Tuple[PRNGFoldable, ...]):
+  """Returns a SHA-1 hash object updated with `data`, cached per prefix."""
+  if not data:
+    return hashlib.sha1()
+  m = _sha1_state(data[:-1]).copy()
+  x = data[-1]
+  if isinstance(x, str):
+    m.update(x.encode('utf-8'))
+  elif isinstance(x, int):
+    m.update(x.to_bytes((x.bit_length() + 7) // 8, byteorder='big'))
+  else:
+    raise ValueError(f'Expected int or string, got: {x}')
+  return m
+
+
+@functools.lru_cache(maxsize=4096)
+def _static_hash(data: Tuple[PRNGFoldable, ...]) -> int:
+  d = _sha1_state(data).digest()
+  return int.from_bytes(d[:4], byteorder='big')
+
+
 def _fold_in_static(rng: PRNGKey, data: typing.Collection[PRNGFoldable]) -> PRNGKey:
   """Folds static data (strings & ints) into a jax.random.PRNGKey using its SHA-1 hash.
 
   This is faster than splitting an PRNGKey because it allows generating new PRNG
-  keys in parallel that are independent of each other.
+  keys in parallel that are independent of each other. The hashes are cached
+  per path.
 
   Args:
    rng: the rng to fold the string into.
@@ -131,17 +216,7 @@ def _fold_in_static(rng: PRNGKey, data: typing.Collection[PRNGFoldable]) -> PRNG
   """
   if len(data) == 0:
     return rng
-  m = hashlib.sha1()
-  for x in data:
-    if isinstance(x, str):
-      m.update(x.encode('utf-8'))
-    elif isinstance(x, int):
-      m.update(x.to_bytes((x.bit_length() + 7) // 8, byteorder='big'))
-    else:
-      raise ValueError(f'Expected int or string, got: {x}')
-  d = m.digest()
-  hash_int = int.from_bytes(d[:4], byteorder='big')
-  return random.fold_in(rng, jnp.uint32(hash_int))
+  return random.fold_in(rng, np.uint32(_static_hash(tuple(data))))
 
 
 def is_filter_empty(filter_like: Filter) -> bool:
@@ -184,6 +259,30 @@ def in_filter(filter_like: Filter, col: str) -> bool:
   raise errors.InvalidFilterError(filter_like)
 
 
+def _compile_filter(filter_like: Filter) -> Callable[[str], bool]:
+  """Returns a predicate equivalent to `in_filter(filter_like, col)`.
+
+  Compiling a filter once avoids dispatching on its type for every collection,
+  and sequences of collections are converted to a set.
+  """
+  if isinstance(filter_like, str):
+    return lambda col: col == filter_like
+  if isinstance(filter_like, typing.Collection):
+    try:
+      cols = frozenset(filter_like)
+    except TypeError:
+      return lambda col: col in filter_like
+    return cols.__contains__
+  if isinstance(filter_like, bool):
+    return lambda col: filter_like
+  if isinstance(filter_like, DenyList):
+    deny = _compile_filter(filter_like.deny)
+    return lambda col: not deny(col)
+  def invalid_filter(col):
+    raise errors.InvalidFilterError(filter_like)
+  return invalid_filter
+
+
 def filter_to_set(x: Filter) -> Set[str]:
   """Converts a Filter into a set of collections, fails on the infinite set.
 
@@ -296,21 +395,38 @@ def group_collections(
     A sequence S with `len(S) == len(col_filters)`. Each `S[i]` is the result of
     applying filter `col_filters[i]` to the remaining keys in `xs`.
     """
-  cols = xs.keys()
+  return _group_collections(xs, [_compile_filter(f) for f in col_filters])
+
+
+@profiling.record('group_collections')
+def _group_collections(
+    xs: VariableDict,
+    col_predicates: Sequence[Callable[[str], bool]]
+) -> Sequence[MutableVariableDict]:
+  """Like `group_collections` but with filters compiled by `_compile_filter`."""
+  cols = list(xs.keys())
   groups = []
-  for col_filter in col_filters:
-    remaining_cols = []
+  for col_predicate in col_predicates:
     group = {}
-    for col in cols:
-      if in_filter(col_filter, col):
-        group[col] = jax.tree_map(lambda x: x, xs[col])
-      else:
-        remaining_cols.append(col)
-    cols = remaining_cols
+    if cols:
+      remaining_cols = []
+      for col in cols:
+        if col_predicate(col):
+          group[col] = _copy_collection(xs[col])
+        else:
+          remaining_cols.append(col)
+      cols = remaining_cols
     groups.append(group)
   return tuple(groups)
 
 
+def _copy_collection(xs: Any) -> Any:
+  # A FrozenDict is immutable, so it can safely be shared.
+  if isinstance(xs, FrozenDict):
+    return xs
+  return jax.tree_map(lambda x: x, xs)
+
+
 class Variable(Generic[T]):
   """A Variable object allows mutable access to a variable in a VariableDict.
 
@@ -351,6 +467,9 @@ class _ChildRNGSentinel:
 # used to identify that an rng counter is meant for a child scope
 child_rng_token = _ChildRNGSentinel()
 
+# returned for collections that don't exist in a scope
+_EMPTY_COLLECTION = FrozenDict()
+
 
 class Scope:
   """A Scope allows easy access to variables and manages RNGS of a neural network layer.
@@ -381,19 +500,23 @@ class Scope:
       parent: The parent scope.
       path: The path in the variable tree from the root scope to this scope.
     """
-    rngs = {k: LazyRng.create(v) for k, v in rngs.items()} if rngs else {}
+    rngs = {k: v if isinstance(v, _ChildRng) else LazyRng.create(v)
+            for k, v in rngs.items()} if rngs else {}
     self._variables = variables
     self.parent = parent
     self.name = name
     self.path = tuple(path)
-    self.rngs = rngs
+    self._rngs = rngs
+    self._rng_view = _RngView(rngs)
     self.mutable = mutable
 
     self._root = parent.root if parent else None
     self.trace_level = tracers.trace_level(tracers.current_trace())
 
-    self.rng_counters = {key: 0 for key in self.rngs}
+    self.rng_counters = {key: 0 for key in self._rngs}
     self.reservations = set()
+    # Immutable collections that don't exist in this scope.
+    self._absent_collections = set()
 
     self._invalid = False
 
@@ -412,6 +535,19 @@ class Scope:
     # see __eq__
     return hash((id(self.root._variables), self.path, id(self.rng_counters)))
 
+  @property
+  def rngs(self) -> Mapping[str, LazyRng]:
+    """The rngs used in this scope or one of the child scopes.
+
+    The rngs are read-only, assign a new mapping to replace them.
+    """
+    return self._rng_view
+
+  @rngs.setter
+  def rngs(self, rngs: Mapping[str, LazyRng]):
+    self._rngs = dict(rngs)
+    self._rng_view = _RngView(self._rngs)
+
   @property
   def root(self) -> 'Scope':
     return self._root or self
@@ -468,10 +604,11 @@ class Scope:
       emptied, and the rng counter is optionally rewound.
     """
     self._check_valid()
-    scope = Scope(self._variables, self.rngs, self.name, self.mutable,
+    scope = Scope(self._variables, self._rngs, self.name, self.mutable,
                   self.parent)
     if not rewind_rngs:
       scope.rng_counters = self.rng_counters
+    scope._absent_collections = self._absent_collections
     return scope
 
   def reserve(self, name: str):
@@ -524,7 +661,10 @@ class Scope:
       name = self.default_name(prefix)
     if not reuse or name not in self.reservations:
       self.reserve(name)
-    rngs = {key: LazyRng.create(rng, name) for key, rng in self.rngs.items()}
+    if config.flax_lazy_rng:
+      rngs = {key: LazyRng.create(rng, name) for key, rng in self._rngs.items()}
+    else:
+      rngs = {key: _ChildRng(rng, name) for key, rng in self._rngs.items()}
     rng_key = (child_rng_token, name)
     if rng_key in self.rng_counters:
       rng_counters = self.rng_counters.get(rng_key)
@@ -591,31 +731,53 @@ class Scope:
   def _mutable_collection(self, col: str) -> MutableCollection:
     """Returns the collection `col` as a mutable object."""
     assert self.is_mutable_collection(col), f'Collection {col} is not mutable'
-    if col not in self._variables:
-      if self.parent:
-        parent_col = self.parent._mutable_collection(col)
-        if self.name not in parent_col:
-          parent_col[self.name] = {}
-        self._variables[col] = parent_col[self.name]
-      else:
-        self._variables[col] = {}
-    return self._variables[col]
+    if col in self._variables:
+      return self._variables[col]
+    # Walk up to the closest scope that has resolved `col` and create the
+    # missing levels on the way back down.
+    scopes = []
+    scope = self
+    while col not in scope._variables and scope.parent:
+      scopes.append(scope)
+      scope = scope.parent
+    if col not in scope._variables:
+      scope._variables[col] = {}
+    parent_col = scope._variables[col]
+    for scope in reversed(scopes):
+      if scope.name not in parent_col:
+        parent_col[scope.name] = {}
+      parent_col = scope._variables[col] = parent_col[scope.name]
+    return parent_col
 
   def _collection(self, col: str) -> Collection:
     """Returns a collection of variables of collection `col`."""
-    if col not in self._variables:
-      if self.parent:
-        parent_col = self.parent._collection(col)
-        if self.name not in parent_col:
-          return FrozenDict()
-        self._variables[col] = parent_col[self.name]
-      else:
-        return FrozenDict()
-    return self._variables[col]
+    if col in self._variables:
+      return self._variables[col]
+    if col in self._absent_collections:
+      return _EMPTY_COLLECTION
+    # Walk up to the closest scope that has resolved `col` and cache the
+    # nested collections on the way back down.
+    scopes = []
+    scope = self
+    while col not in scope._variables and scope.parent:
+      scopes.append(scope)
+      scope = scope.parent
+    parent_col = scope._variables.get(col)
+    for scope in reversed(scopes):
+      if parent_col is None or scope.name not in parent_col:
+        parent_col = None
+        # Immutable collections can't be created later on.
+        if not scope.is_mutable_collection(col):
+          scope._absent_collections.add(col)
+        continue
+      parent_col = scope._variables[col] = parent_col[scope.name]
+    if parent_col is None:
+      return _EMPTY_COLLECTION
+    return parent_col
 
   def has_rng(self, name: str) -> bool:
     """Returns true if a PRNGSequence with name `name` exists."""
-    return name in self.rngs
+    return name in self._rngs
 
   def make_rng(self, name: str) -> PRNGKey:
     """Generates A PRNGKey from a PRNGSequence with name `name`."""
@@ -624,7 +786,8 @@ class Scope:
     self._check_valid()
     self._validate_trace_level()
     self.rng_counters[name] += 1
-    return LazyRng.create(self.rngs[name], self.rng_counters[name]).as_jax_rng()
+    rng = _materialize_rng(self._rngs[name])
+    return LazyRng.create(rng, self.rng_counters[name]).as_jax_rng()
 
   def get_variable(self, col: str, name: str, default: T = None) -> T:
     """Retrieves the value of a Variable.
@@ -710,23 +873,21 @@ class Scope:
     """
     self.reserve(name)
     if self.has_variable('params', name):
-      abs_rng = jax.ShapeDtypeStruct(_default_key_shape(), jnp.uint32)
       value = self.get_variable('params', name)
       # Validate that the shape of the init_fn output is the same as the shape
       # of the existing parameter. This is to make sure that the hparams set up
       # in a Flax Module match the shapes coming in during apply, and if not,
       # catch it with an error message.
       # NOTE: We could consider moving this to `self.`
-      abs_value = jax.eval_shape(lambda rng: init_fn(rng, *init_args), abs_rng)
-      abs_value_flat = jax.tree_leaves(abs_value)
+      abs_shapes = _abstract_init_shapes(init_fn, init_args)
       value_flat = jax.tree_leaves(value)
-      for val, abs_val in zip(value_flat, abs_value_flat):
+      for val, abs_shape in zip(value_flat, abs_shapes):
         # NOTE: We could check dtype consistency here as well but it's
         # usefuleness is less obvious. We might intentionally change the dtype
         # for inference to a half float type for example.
-        if jnp.shape(val) != jnp.shape(abs_val):
+        if jnp.shape(val) != abs_shape:
           raise errors.ScopeParamShapeError(name, self.path_text,
-              jnp.shape(val), jnp.shape(abs_val))
+              jnp.shape(val), abs_shape)
     else:
       if not self.is_mutable_collection('params'):
         if self.is_collection_empty('params'):
@@ -873,6 +1034,37 @@ def _default_key_shape():
     return (4,)
 
 
+# Shapes of the leaves of initializer outputs, per initializer and arguments.
+_init_shapes_cache = weakref.WeakKeyDictionary()
+
+
+def _abstract_init_shapes(init_fn, init_args):
+  """Returns the shapes of the leaves of a param initializer's output.
+
+  The initializer is traced with `jax.eval_shape` once per `init_fn` and
+  `init_args`, e.g. a shape tuple, instead of once per param per `apply`.
+  Initializers that can't be weakly referenced or that have unhashable
+  arguments, like arrays, are traced every time.
+  """
+  key_shape = _default_key_shape()
+  # Shapes are often passed as lists, e.g. by `LayerNorm`.
+  hashable_args = tuple(tuple(arg) if type(arg) is list else arg  # pylint: disable=unidiomatic-typecheck
+                        for arg in init_args)
+  key = (key_shape, hashable_args, tuple(type(arg) for arg in init_args))
+  try:
+    cache = _init_shapes_cache.setdefault(init_fn, {})
+    shapes = cache.get(key)
+  except TypeError:
+    cache, shapes = None, None
+  if shapes is None:
+    abs_rng = jax.ShapeDtypeStruct(key_shape, jnp.uint32)
+    abs_value = jax.eval_shape(lambda rng: init_fn(rng, *init_args), abs_rng)
+    shapes = tuple(jnp.shape(x) for x in jax.tree_leaves(abs_value))
+    if cache is not None:
+      cache[key] = shapes
+  return shapes
+
+
 def _is_valid_rng(rng: Array):
   """Checks whether rng is a valid JAX PRNGKey, also handling custom prngs."""
   # New-style JAX KeyArrays have a base type.
@@ -548,6 +548,20 @@ class InvalidCheckpointError(FlaxError):
     super().__init__(f'Trying to save an outdated checkpoint at step: "{step}" and path: "{path}".')
 
 
+class CorruptCheckpointError(FlaxError):
+  """
+  A checkpoint that was saved with ``checksum=True`` does not match its
+  checksums, e.g. because it was truncated by a preempted writer, or a blob of
+  a deduplicated checkpoint has the wrong size.
+
+  You can pass ``fallback=True`` to ``restore_checkpoint`` to restore the most
+  recent checkpoint that is intact instead, or ``verify=False`` to skip the
+  verification.
+  """
+  def __init__(self, path, reason):
+    super().__init__(f'Checkpoint at path: "{path}" is corrupt: {reason}.')
+
+
 #################################################
 # transforms.py errors                          #
 #################################################
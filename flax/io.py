@@ -0,0 +1,216 @@
+# Copyright 2022 The Flax Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Pluggable file system access for checkpoints.
+
+Paths without a scheme are handled by a pure-Python POSIX backend, so local
+checkpointing does not depend on TensorFlow.  Paths with a scheme, e.g.
+``gs://bucket/ckpt``, are handled by `tensorflow.io.gfile`, which is only
+imported on first use.  Other backends can be added with `register_backend`::
+
+  flax.io.register_backend('mem://', MyInMemoryBackend())
+
+The module level functions mirror the `tensorflow.io.gfile` API and dispatch
+on the scheme of their path argument.
+"""
+
+import abc
+import glob as glob_lib
+import os
+import re
+import shutil
+from typing import Any, Dict, List
+
+
+# Alternative schemes, e.g. on Google Cloud Storage (GCS).
+SCHEME_RE = re.compile('^(?P<scheme>[a-z][a-z0-9.+-]+://)?(?P<path>.*)', re.I)
+
+
+class StorageBackend(abc.ABC):
+  """Interface of a file system used for checkpoints."""
+
+  @abc.abstractmethod
+  def open(self, path: str, mode: str = 'rb') -> Any:
+    """Returns a file-like object, like the builtin `open`."""
+
+  @abc.abstractmethod
+  def exists(self, path: str) -> bool:
+    pass
+
+  @abc.abstractmethod
+  def isdir(self, path: str) -> bool:
+    pass
+
+  @abc.abstractmethod
+  def makedirs(self, path: str):
+    """Creates a directory and its parents, it may already exist."""
+
+  @abc.abstractmethod
+  def glob(self, pattern: str) -> List[str]:
+    pass
+
+  @abc.abstractmethod
+  def remove(self, path: str):
+    pass
+
+  @abc.abstractmethod
+  def rmtree(self, path: str):
+    pass
+
+  @abc.abstractmethod
+  def rename(self, src: str, dst: str, overwrite: bool = False):
+    """Atomically renames `src` to `dst`."""
+
+  @abc.abstractmethod
+  def getsize(self, path: str) -> int:
+    pass
+
+  def is_local(self) -> bool:
+    """Whether paths are plain local paths that support `os` file access."""
+    return False
+
+
+class LocalBackend(StorageBackend):
+  """POSIX file system backend based on `os` and builtin files."""
+
+  def open(self, path, mode='rb'):
+    return open(path, mode)  # pylint: disable=unspecified-encoding
+
+  def exists(self, path):
+    return os.path.exists(path)
+
+  def isdir(self, path):
+    return os.path.isdir(path)
+
+  def makedirs(self, path):
+    os.makedirs(path, exist_ok=True)
+
+  def glob(self, pattern):
+    return glob_lib.glob(pattern)
+
+  def remove(self, path):
+    os.remove(path)
+
+  def rmtree(self, path):
+    shutil.rmtree(path)
+
+  def rename(self, src, dst, overwrite=False):
+    if not overwrite and os.path.exists(dst):
+      raise FileExistsError(f'Cannot rename {src} to existing {dst}.')
+    os.replace(src, dst)
+
+  def getsize(self, path):
+    return os.path.getsize(path)
+
+  def is_local(self):
+    return True
+
+
+class GFileBackend(StorageBackend):
+  """Backend based on `tensorflow.io.gfile`, imported on first use."""
+
+  def __init__(self):
+    self._gfile = None
+
+  @property
+  def gfile(self):
+    if self._gfile is None:
+      from tensorflow.io import gfile  # pylint: disable=g-import-not-at-top
+      self._gfile = gfile
+    return self._gfile
+
+  def open(self, path, mode='rb'):
+    return self.gfile.GFile(path, mode)
+
+  def exists(self, path):
+    return self.gfile.exists(path)
+
+  def isdir(self, path):
+    return self.gfile.isdir(path)
+
+  def makedirs(self, path):
+    self.gfile.makedirs(path)
+
+  def glob(self, pattern):
+    return self.gfile.glob(pattern)
+
+  def remove(self, path):
+    self.gfile.remove(path)
+
+  def rmtree(self, path):
+    self.gfile.rmtree(path)
+
+  def rename(self, src, dst, overwrite=False):
+    self.gfile.rename(src, dst, overwrite=overwrite)
+
+  def getsize(self, path):
+    return self.gfile.stat(path).length
+
+
+_LOCAL_BACKEND = LocalBackend()
+_GFILE_BACKEND = GFileBackend()
+_BACKENDS: Dict[str, StorageBackend] = {}
+
+
+def register_backend(scheme: str, backend: StorageBackend):
+  """Registers the backend for paths starting with `scheme`, e.g. 'gs://'."""
+  _BACKENDS[scheme.lower()] = backend
+
+
+def get_backend(path: str) -> StorageBackend:
+  """Returns the backend responsible for `path`."""
+  scheme = SCHEME_RE.match(os.fspath(path)).group('scheme')
+  if not scheme:
+    return _LOCAL_BACKEND
+  return _BACKENDS.get(scheme.lower(), _GFILE_BACKEND)
+
+
+def GFile(path: str, mode: str = 'rb'):  # pylint: disable=invalid-name
+  return get_backend(path).open(path, mode)
+
+
+def exists(path: str) -> bool:
+  return get_backend(path).exists(path)
+
+
+def isdir(path: str) -> bool:
+  return get_backend(path).isdir(path)
+
+
+def makedirs(path: str):
+  get_backend(path).makedirs(path)
+
+
+def glob(pattern: str) -> List[str]:
+  return get_backend(pattern).glob(pattern)
+
+
+def remove(path: str):
+  get_backend(path).remove(path)
+
+
+def rmtree(path: str):
+  get_backend(path).rmtree(path)
+
+
+def rename(src: str, dst: str, overwrite: bool = False):
+  get_backend(src).rename(src, dst, overwrite=overwrite)
+
+
+def getsize(path: str) -> int:
+  return get_backend(path).getsize(path)
+
+
+def is_local(path: str) -> bool:
+  return get_backend(path).is_local()
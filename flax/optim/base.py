@@ -435,6 +435,11 @@ class _ShapeDtype:
     return cls(shape=value.shape, dtype=value.dtype, _value=value, _indices=[])
 
 
+# Maximum number of params tree structures for which a `MultiOptimizer` keeps
+# the partition of the params into its sub optimizers.
+_MAX_PARTITIONS = 16
+
+
 class MultiOptimizer(OptimizerDef):
   """
   A MultiOptimizer is subclass of :class:`OptimizerDef` and useful for applying
@@ -485,6 +490,37 @@ class MultiOptimizer(OptimizerDef):
     super().__init__(hyper_params)
     self.traversals = traversals
     self.sub_optimizers = sub_optimizers
+    # Leaf positions selected by every traversal, per params treedef and leaf
+    # shapes and dtypes.
+    self._partitions = {}
+
+  def _partition(self, params, leaves, treedef):
+    """Returns the leaf positions of the params of every sub optimizer.
+
+    The partition is computed once per tree structure and leaf shapes and dtypes
+    of the params, like the selections of `ModelParamTraversal`. It is None if
+    a traversal is not a `ModelParamTraversal` or selects values that are not
+    single leaves.
+    """
+    key = traverse_util._selection_key(leaves, treedef)  # pylint: disable=protected-access
+    try:
+      return self._partitions[key]
+    except KeyError:
+      pass
+    partition = []
+    for traversal in self.traversals:
+      indices = None
+      if isinstance(traversal, traverse_util.ModelParamTraversal):
+        indices = traversal.leaf_indices(params)
+      if indices is None or len(indices) != len(list(
+          traversal.iterate(params))):
+        partition = None
+        break
+      partition.append(indices)
+    if len(self._partitions) >= _MAX_PARTITIONS:
+      self._partitions.clear()
+    self._partitions[key] = partition
+    return partition
 
   def init_state(self, params):
     param_states = jax.tree_map(_ShapeDtype.create, params)
@@ -508,6 +544,31 @@ class MultiOptimizer(OptimizerDef):
     return OptimizerState(jnp.asarray(0, dtype=jnp.int32), param_states)
 
   def apply_gradient(self, hyper_params, params, state, grads):
+    leaves, treedef = jax.tree_flatten(params)
+    try:
+      partition = self._partition(params, leaves, treedef)
+    except TypeError:
+      # Unhashable pytree node data.
+      partition = None
+    if partition is not None:
+      grads = treedef.flatten_up_to(grads)
+      param_states = treedef.flatten_up_to(state.param_states)
+      # Params that are not optimized by any sub optimizer have a None state.
+      new_params, new_param_states = list(leaves), [None] * len(leaves)
+      it = zip(partition, self.sub_optimizers, hyper_params)
+      for indices, opt, hp in it:
+        ps = tuple(leaves[i] for i in indices)
+        gs = tuple(grads[i] for i in indices)
+        ss = tuple(param_states[i] for i in indices)
+        new_ps, new_ss = opt.apply_gradient(
+            hp, ps, OptimizerState(state.step, ss), gs)
+        for i, p, s in zip(indices, new_ps, new_ss.param_states):
+          new_params[i] = p
+          new_param_states[i] = s
+      return (treedef.unflatten(new_params),
+              OptimizerState(state.step + 1,
+                             treedef.unflatten(new_param_states)))
+
     new_params = params
     it = zip(self.traversals, self.sub_optimizers, hyper_params)
     new_param_states = jax.tree_map(_ShapeDtype.create, params)
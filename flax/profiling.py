@@ -0,0 +1,233 @@
+# Copyright 2022 The Flax Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Profiles the Python time Flax spends while tracing a model.
+
+Records the wall time and number of calls of every Module method, per Module
+path, and of the internal phases of Flax, e.g. the lifted transformations::
+
+  with flax.profiling.trace_profile() as profile:
+    jax.jit(model.apply).lower(variables, x)
+  print(profile.table())
+  profile.save_chrome_trace('/tmp/flax_trace.json')
+
+The self time of an entry excludes the time spent in nested entries.  Note that
+the self time of a lifted transformation, e.g. ``lift.vmap``, includes the time
+JAX spends tracing the transformation.  The Chrome trace can be viewed in
+``chrome://tracing`` or Perfetto.
+
+Profiling can also be enabled for the whole program with the
+``FLAX_TRACE_PROFILE`` environment variable, see `flax.config`, in which case
+`current_profile` returns the global profile. Only then are the frequently
+called Module internals, e.g. ``Module._try_setup``, recorded as well.
+"""
+
+import contextlib
+import dataclasses
+import functools
+import json
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from flax import config
+from flax import io
+from flax import traceback_util
+
+traceback_util.register_exclusion(__file__)
+
+
+@dataclasses.dataclass(frozen=True)
+class ProfileStat:
+  """Aggregated time of all calls of an entry of a `TraceProfile`.
+
+  Attributes:
+    name: the Module method, e.g. 'Dense.__call__', or internal Flax phase.
+    path: the Module path, e.g. '/Encoder_0/Dense_1', or '' if the phase
+      doesn't belong to a Module.
+    calls: the number of calls.
+    total_time: the wall time in seconds including nested entries.
+    self_time: the wall time in seconds excluding nested entries.
+  """
+  name: str
+  path: str
+  calls: int
+  total_time: float
+  self_time: float
+
+
+class TraceProfile:
+  """Time spent in Flax while profiling was enabled."""
+
+  def __init__(self):
+    # (name, path, start, duration, self time, thread id) of each call.
+    self.events = []
+    self.start_time = time.perf_counter()
+    self._local = threading.local()
+
+  def _stack(self) -> List[float]:
+    """Time spent in nested calls of the currently active calls."""
+    stack = getattr(self._local, 'stack', None)
+    if stack is None:
+      stack = self._local.stack = []
+    return stack
+
+  def summary(self, by_path: bool = True) -> List[ProfileStat]:
+    """Returns the stats of all entries, sorted by decreasing self time.
+
+    Args:
+      by_path: if false, the calls of an entry are aggregated over all Module
+        paths.
+    """
+    stats = {}
+    for name, path, _, duration, self_time, _ in self.events:
+      key = (name, path if by_path else '')
+      calls, total_time, total_self_time = stats.get(key, (0, 0., 0.))
+      stats[key] = (calls + 1, total_time + duration,
+                    total_self_time + self_time)
+    return sorted((ProfileStat(name, path, *stat)
+                   for (name, path), stat in stats.items()),
+                  key=lambda stat: stat.self_time, reverse=True)
+
+  def table(self, by_path: bool = True, limit: Optional[int] = None) -> str:
+    """Returns the stats as a table sorted by decreasing self time.
+
+    Args:
+      by_path: if false, the calls of an entry are aggregated over all Module
+        paths.
+      limit: the maximal number of rows.
+    """
+    stats = self.summary(by_path)[:limit]
+    rows = [(stat.name, stat.path, str(stat.calls),
+             f'{stat.total_time * 1e3:.2f}', f'{stat.self_time * 1e3:.2f}')
+            for stat in stats]
+    header = ('name', 'path', 'calls', 'total ms', 'self ms')
+    if not by_path:
+      header, rows = header[:1] + header[2:], [r[:1] + r[2:] for r in rows]
+    widths = [max(len(row[i]) for row in [header] + rows)
+              for i in range(len(header))]
+    def format_row(row):
+      # Left-align names and paths, right-align the numbers.
+      return '  '.join(x.ljust(w) if i < len(row) - 3 else x.rjust(w)
+                       for i, (x, w) in enumerate(zip(row, widths))).rstrip()
+    return '\n'.join([format_row(header)] + [format_row(r) for r in rows])
+
+  def chrome_trace(self) -> Dict[str, Any]:
+    """Returns the calls in the Chrome trace event format."""
+    events = []
+    for name, path, start, duration, _, thread_id in self.events:
+      events.append({
+          'name': name, 'cat': 'flax', 'ph': 'X', 'pid': 0, 'tid': thread_id,
+          'ts': (start - self.start_time) * 1e6, 'dur': duration * 1e6,
+          'args': {'path': path}})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+  def save_chrome_trace(self, path: str):
+    """Writes the Chrome trace JSON to `path`."""
+    with io.GFile(path, 'w') as fp:
+      json.dump(self.chrome_trace(), fp)
+
+
+# The active profile, None if profiling is disabled.
+_profile = TraceProfile() if config.flax_trace_profile else None
+
+
+def current_profile() -> Optional[TraceProfile]:
+  """Returns the active profile, or None if profiling is disabled."""
+  return _profile
+
+
+def enable_trace_profile() -> TraceProfile:
+  """Starts recording into a new profile and returns it."""
+  global _profile
+  _profile = TraceProfile()
+  return _profile
+
+
+def disable_trace_profile():
+  """Stops recording.
+
+  See ``enable_trace_profile``
+  """
+  global _profile
+  _profile = None
+
+
+@contextlib.contextmanager
+def trace_profile():
+  """Returns a context manager that records a new profile.
+
+  See ``enable_trace_profile``
+  """
+  global _profile
+  profile_prev = _profile
+  _profile = TraceProfile()
+  try:
+    yield _profile
+  finally:
+    _profile = profile_prev
+
+
+def call(name: str, path: str, fn: Callable[..., Any], args: Tuple[Any, ...],
+         kwargs: Dict[str, Any]) -> Any:
+  """Calls `fn` and records the call in the active profile, if any.
+
+  Args:
+    name: the name of the entry.
+    path: the Module path of the entry.
+    fn: the function to call.
+    args: the positional arguments of `fn`.
+    kwargs: the keyword arguments of `fn`.
+  Returns:
+    The result of `fn`.
+  """
+  profile = _profile
+  if profile is None:
+    return fn(*args, **kwargs)
+  stack = profile._stack()  # pylint: disable=protected-access
+  stack.append(0.)
+  start = time.perf_counter()
+  try:
+    return fn(*args, **kwargs)
+  finally:
+    duration = time.perf_counter() - start
+    nested_time = stack.pop()
+    if stack:
+      stack[-1] += duration
+    profile.events.append((name, path, start, duration,
+                           duration - nested_time, threading.get_ident()))
+
+
+def record(name: str, path_fn: Optional[Callable[..., str]] = None):
+  """Decorator that records the calls of a function in the active profile.
+
+  When profiling is disabled the decorated function only checks whether a
+  profile is active before calling `fn`.
+
+  Args:
+    name: the name of the entry.
+    path_fn: called with the arguments of the function to get the Module path
+      of the entry.
+  Returns:
+    A decorator.
+  """
+  def decorator(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+      if _profile is None:
+        return fn(*args, **kwargs)
+      path = path_fn(*args, **kwargs) if path_fn is not None else ''
+      return call(name, path, fn, args, kwargs)
+    return wrapper
+  return decorator
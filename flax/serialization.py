@@ -17,8 +17,22 @@
 All Flax classes that carry state (e.g. ,Optimizer) can be turned into a
 state dict of numpy arrays for easy serialization.
 """
+import collections
+from concurrent import futures
+import contextlib
+import dataclasses
 import enum
-from typing import Any, Dict, List
+import functools
+import lzma
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from typing import (Any, BinaryIO, Callable, Dict, Iterable, Iterator, List,
+                    Optional, Tuple, Union)
+import zlib
 
 import jax
 import msgpack
@@ -38,7 +52,7 @@ def _is_namedtuple(x):
   return isinstance(x, tuple) and hasattr(x, '_fields')
 
 
-def from_state_dict(target, state: Dict[str, Any]):
+def from_state_dict(target, state: Dict[str, Any], validate: bool = False):
   """Restores the state of the given target using a state dict.
 
   This function takes the current target as an argument. This
@@ -52,6 +66,9 @@ def from_state_dict(target, state: Dict[str, Any]):
     target: the object of which the state should be restored.
     state: a dictionary generated by `to_state_dict` with the desired new
            state for `target`.
+    validate: raise a `ValueError` listing all array leaves of the restored
+      object whose shape or dtype differs from the corresponding leaf of
+      `target`.
   Returns:
     A copy of the object with the restored state.
   """
@@ -60,9 +77,20 @@ def from_state_dict(target, state: Dict[str, Any]):
   else:
     ty = type(target)
   if ty not in _STATE_DICT_REGISTRY:
+    if isinstance(state, LazyArray):
+      return state.materialize()
     return state
   ty_from_state_dict = _STATE_DICT_REGISTRY[ty][1]
-  return ty_from_state_dict(target, state)
+  if not _bulk_conversion_enabled():
+    restored = ty_from_state_dict(target, state)
+  else:
+    restored = _from_state_dict_bulk(target, state)
+    if restored is _NOT_CONVERTED:
+      with _recursive_conversion():
+        restored = ty_from_state_dict(target, state)
+  if validate:
+    _validate_restored(target, restored)
+  return restored
 
 
 def to_state_dict(target) -> Dict[str, Any]:
@@ -75,13 +103,267 @@ def to_state_dict(target) -> Dict[str, Any]:
     return target
 
   ty_to_state_dict = _STATE_DICT_REGISTRY[ty][0]
-  state_dict = ty_to_state_dict(target)
+  if not _bulk_conversion_enabled():
+    state_dict = ty_to_state_dict(target)
+  else:
+    state_dict = _to_state_dict_bulk(target)
+    if state_dict is _NOT_CONVERTED:
+      with _recursive_conversion():
+        state_dict = ty_to_state_dict(target)
   assert isinstance(state_dict, dict), 'A state dict must be a Python dict.'
   for key in state_dict.keys():
     assert isinstance(key, str), 'A state dict must only have string keys.'
   return state_dict
 
 
+# Bulk state dict conversion
+
+# Instead of dispatching on the registry for every node of a tree, targets
+# that are pytrees are converted in bulk: the target is flattened with
+# `jax.tree_util.tree_flatten` and every leaf is mapped to its state dict path
+# with a layout that is computed once per treedef and key order, by
+# converting a copy of the target with placeholder leaves.  The layout is only
+# used if the placeholders end up in the state dict unchanged, and for
+# restoring only if `from_state_dict` rebuilds the same tree structure from
+# them.  Anything else uses the recursive conversion.  Dicts keep the key order
+# of the target, although JAX rebuilds them with sorted keys.
+
+_NOT_CONVERTED = object()
+_bulk_state = threading.local()
+
+
+def _bulk_conversion_enabled() -> bool:
+  return not getattr(_bulk_state, 'disabled', False)
+
+
+@contextlib.contextmanager
+def _recursive_conversion():
+  """Disables bulk conversion of the nodes of a recursive conversion."""
+  disabled_prev = getattr(_bulk_state, 'disabled', False)
+  _bulk_state.disabled = True
+  try:
+    yield
+  finally:
+    _bulk_state.disabled = disabled_prev
+
+
+class _Placeholder:
+  """Leaf of the tree used to compute a `_StateDictLayout`."""
+  __slots__ = ('index',)
+
+  def __init__(self, index: int):
+    self.index = index
+
+
+# Template values of state dict entries that aren't leaves of the target.
+_NONE_ENTRY = -1
+_EMPTY_DICT_ENTRY = -2
+
+
+@dataclasses.dataclass(frozen=True)
+class _StateDictLayout:
+  """State dict paths of the leaves of a tree structure."""
+  # Nested (keys, values) pairs mirroring the state dict, where every value is
+  # either a template itself, the index of a leaf or one of the entries above.
+  template: Tuple[Tuple[str, ...], Tuple[Any, ...]]
+  # Path of every leaf of the treedef, None if it isn't part of the state.
+  leaf_paths: Tuple[Optional[Tuple[str, ...]], ...]
+  # Pre-order index and keys of every dict whose keys aren't sorted.
+  unsorted: Tuple[Tuple[int, Tuple[Any, ...]], ...]
+
+
+def _layout_template(state, leaf_paths, prefix=()):
+  """Returns the template of a state dict with `_Placeholder` leaves."""
+  values = []
+  for key, value in state.items():
+    path = prefix + (key,)
+    if isinstance(value, dict) and value:
+      values.append(_layout_template(value, leaf_paths, path))
+    elif isinstance(value, dict):
+      values.append(_EMPTY_DICT_ENTRY)
+    elif value is None:
+      values.append(_NONE_ENTRY)
+    elif isinstance(value, _Placeholder) and leaf_paths[value.index] is None:
+      leaf_paths[value.index] = path
+      values.append(value.index)
+    else:
+      raise ValueError(f'Unsupported state dict entry at {path}.')
+  return tuple(state.keys()), tuple(values)
+
+
+# Treedefs sort the keys of dicts, while state dicts keep the key order of the
+# target.  So the layout of a tree is cached per treedef and key order, i.e. the
+# keys of every dict of the tree in pre-order.
+_KeyOrder = Tuple[Tuple[Any, ...], ...]
+
+
+def _flatten_with_dicts(tree) -> Tuple[List[Any], Any, List[dict]]:
+  """Flattens a tree, also returns its dicts in pre-order."""
+  nodes = []
+  # `list.append` returns None, so no node is treated as a leaf.
+  leaves, treedef = jax.tree_util.tree_flatten(tree, is_leaf=nodes.append)
+  dicts = [x for x in nodes if type(x) is dict]  # pylint: disable=unidiomatic-typecheck
+  return leaves, treedef, dicts
+
+
+def _flatten_with_key_order(tree) -> Tuple[List[Any], Any, _KeyOrder]:
+  """Flattens a tree, also returns the key order of its dicts."""
+  leaves, treedef, dicts = _flatten_with_dicts(tree)
+  return leaves, treedef, tuple([tuple(x) for x in dicts])
+
+
+def _restore_key_order(tree, unsorted):
+  """Reorders the `unsorted` dicts of a tree built by `tree_unflatten`."""
+  if not unsorted:
+    return tree
+  _, _, dicts = _flatten_with_dicts(tree)
+  for index, keys in unsorted:
+    x = dicts[index]
+    # Moves every key to the end.
+    for key in keys:
+      x[key] = x.pop(key)
+  return tree
+
+
+@functools.lru_cache(maxsize=256)
+def _state_dict_layout(treedef,
+                       key_order: _KeyOrder) -> Optional[_StateDictLayout]:
+  """Computes the layout of a treedef, None if it doesn't support bulk use."""
+  placeholders = [_Placeholder(i) for i in range(treedef.num_leaves)]
+  leaf_paths = [None] * len(placeholders)
+  unsorted = tuple((i, keys) for i, keys in enumerate(key_order)
+                   if keys != tuple(sorted(keys)))
+  try:
+    with _recursive_conversion():
+      skeleton = _restore_key_order(
+          jax.tree_util.tree_unflatten(treedef, placeholders), unsorted)
+      state = to_state_dict(skeleton)
+    template = _layout_template(state, leaf_paths)
+  except Exception:  # pylint: disable=broad-except
+    # Conversions that depend on the leaf values can't be done in bulk.
+    return None
+  return _StateDictLayout(template, tuple(leaf_paths), unsorted)
+
+
+@functools.lru_cache(maxsize=256)
+def _is_restorable(treedef, key_order: _KeyOrder) -> bool:
+  """Whether `from_state_dict` is equivalent to `tree_unflatten`."""
+  layout = _state_dict_layout(treedef, key_order)
+  if layout is None or None in layout.leaf_paths:
+    return False
+  placeholders = [_Placeholder(i) for i in range(treedef.num_leaves)]
+  try:
+    with _recursive_conversion():
+      skeleton = jax.tree_util.tree_unflatten(treedef, placeholders)
+      state = _build_state_dict(layout.template, placeholders)
+      restored = from_state_dict(skeleton, state)
+    restored_leaves, restored_treedef = jax.tree_util.tree_flatten(restored)
+  except Exception:  # pylint: disable=broad-except
+    return False
+  return restored_treedef == treedef and all(
+      leaf is placeholder
+      for leaf, placeholder in zip(restored_leaves, placeholders))
+
+
+def _flatten_for_bulk(target):
+  """Returns leaves, treedef, key order and layout of a target, or None."""
+  try:
+    leaves, treedef, key_order = _flatten_with_key_order(target)
+  except TypeError:  # unsortable keys
+    return None
+  # Leaves with registered state dict handlers need a recursive conversion.
+  if not _STATE_DICT_REGISTRY.keys().isdisjoint(map(type, leaves)):
+    return None
+  try:
+    layout = _state_dict_layout(treedef, key_order)
+  except TypeError:  # unhashable auxiliary data
+    return None
+  if layout is None:
+    return None
+  return leaves, treedef, key_order, layout
+
+
+def _build_state_dict(template, leaves):
+  keys, values = template
+  return {
+      key: (_build_state_dict(value, leaves) if type(value) is tuple else
+            leaves[value] if value >= 0 else
+            None if value == _NONE_ENTRY else {})
+      for key, value in zip(keys, values)}
+
+
+def _collect_leaves(template, state, leaves) -> bool:
+  """Stores the leaves of `state` in `leaves`, False if it doesn't match."""
+  keys, values = template
+  if not isinstance(state, dict) or len(state) != len(keys):
+    return False
+  for key, value in zip(keys, values):
+    if key not in state:
+      return False
+    x = state[key]
+    if type(value) is tuple:
+      if not _collect_leaves(value, x, leaves):
+        return False
+    elif value >= 0:
+      if isinstance(x, dict):
+        return False
+      leaves[value] = x.materialize() if isinstance(x, LazyArray) else x
+    elif value == _NONE_ENTRY:
+      if x is not None:
+        return False
+    elif not isinstance(x, dict) or x:
+      return False
+  return True
+
+
+def _to_state_dict_bulk(target):
+  flattened = _flatten_for_bulk(target)
+  if flattened is None:
+    return _NOT_CONVERTED
+  leaves, _, _, layout = flattened
+  return _build_state_dict(layout.template, leaves)
+
+
+def _from_state_dict_bulk(target, state):
+  if not isinstance(state, dict):
+    return _NOT_CONVERTED
+  flattened = _flatten_for_bulk(target)
+  if flattened is None or not _is_restorable(*flattened[1:3]):
+    return _NOT_CONVERTED
+  _, treedef, _, layout = flattened
+  leaves = [None] * treedef.num_leaves
+  if not _collect_leaves(layout.template, state, leaves):
+    return _NOT_CONVERTED
+  return _restore_key_order(jax.tree_util.tree_unflatten(treedef, leaves),
+                            layout.unsorted)
+
+
+def _validate_restored(target, restored):
+  """Raises if array leaves of `restored` don't match those of `target`."""
+  target_leaves, treedef, key_order = _flatten_with_key_order(target)
+  restored_leaves = jax.tree_util.tree_leaves(restored)
+  try:
+    layout = _state_dict_layout(treedef, key_order)
+  except TypeError:
+    layout = None
+  mismatches = []
+  for i, (x, y) in enumerate(zip(target_leaves, restored_leaves)):
+    if not hasattr(x, 'shape') or not hasattr(x, 'dtype'):
+      continue
+    if np.shape(x) != np.shape(y) or np.dtype(x.dtype) != np.result_type(y):
+      path = layout.leaf_paths[i] if layout is not None else None
+      name = '/' + '/'.join(path) if path is not None else f'leaf {i}'
+      mismatches.append(f'{name}: expected {np.dtype(x.dtype).name}'
+                        f'{list(np.shape(x))}, got '
+                        f'{np.result_type(y).name}{list(np.shape(y))}')
+  if len(target_leaves) != len(restored_leaves):
+    mismatches.append(f'expected {len(target_leaves)} leaves, got '
+                      f'{len(restored_leaves)}')
+  if mismatches:
+    raise ValueError('Restored state does not match the target: ' +
+                     ', '.join(mismatches))
+
+
 def register_serialization_state(ty, ty_to_state_dict, ty_from_state_dict,
                                  override=False):
   """Register a type for serialization.
@@ -165,6 +447,9 @@ register_serialization_state(_NamedTuple,
 #   of (shape-tuple, dtype-name (e.g. 'float32'), row-major array-bytes).
 #   Note: only simple ndarray types are supported, no objects or fields.
 #
+# - compressed ndarrays are serialized to nested msgpack-encoded string of
+#   (shape-tuple, dtype-name, codec-name (e.g. 'zlib'), compressed-bytes).
+#
 # - native complex scalars are converted to nested msgpack-encoded tuples
 #   (real, imag).
 
@@ -188,13 +473,26 @@ def _dtype_from_name(name: str):
     return np.dtype(name)
 
 
+# Above this size ndarrays are decoded as views of the msgpack payload instead
+# of copying the array bytes out of it.
+_ZERO_COPY_DECODE_SIZE = 1 << 16
+
+
 def _ndarray_from_bytes(data: bytes) -> np.ndarray:
   """Load ndarray from simple msgpack encoding."""
-  shape, dtype_name, buffer = msgpack.unpackb(data, raw=True)
-  return np.frombuffer(buffer,
-                       dtype=_dtype_from_name(dtype_name),
-                       count=-1,
-                       offset=0).reshape(shape, order='C')
+  if len(data) < _ZERO_COPY_DECODE_SIZE:
+    shape, dtype_name, buffer = msgpack.unpackb(data, raw=True)
+    return np.frombuffer(buffer,
+                         dtype=_dtype_from_name(dtype_name),
+                         count=-1,
+                         offset=0).reshape(shape, order='C')
+  decoder = _LazyMsgpackDecoder(_BufferSource(data))
+  shape, dtype, _, offset, _ = decoder.decode_ndarray(
+      _MsgpackExtType.ndarray, len(data))
+  return np.frombuffer(data,
+                       dtype=dtype,
+                       count=int(np.prod(shape, dtype=np.int64)),
+                       offset=offset).reshape(shape, order='C')
 
 
 class _MsgpackExtType(enum.IntEnum):
@@ -202,6 +500,7 @@ class _MsgpackExtType(enum.IntEnum):
   ndarray = 1
   native_complex = 2
   npscalar = 3
+  compressed_ndarray = 4
 
 
 def _msgpack_ext_pack(x):
@@ -228,9 +527,166 @@ def _msgpack_ext_unpack(code, data):
   elif code == _MsgpackExtType.npscalar:
     ar = _ndarray_from_bytes(data)
     return ar[()]  # unpack ndarray to scalar
+  elif code == _MsgpackExtType.compressed_ndarray:
+    return _compressed_ndarray_from_bytes(data)
   return msgpack.ExtType(code, data)
 
 
+# Compressed array leaves
+
+# When serializing with a `codec`, array leaves (and the chunks of chunked
+# arrays) are compressed concurrently in a thread pool, as zlib and lzma
+# release the GIL.  The codec is recorded per leaf, and leaves that don't
+# shrink are stored uncompressed, so restoring decompresses the leaves in
+# parallel as well.
+
+_CODECS: Dict[str, Tuple[Callable[[bytes], bytes], Callable[[bytes], bytes]]] = {
+    'zlib': (zlib.compress, zlib.decompress),
+    'lzma': (lzma.compress, lzma.decompress),
+}
+
+
+def _zstd_codec():
+  import zstandard  # pylint: disable=g-import-not-at-top
+  return (lambda data: zstandard.ZstdCompressor().compress(data),
+          lambda data: zstandard.ZstdDecompressor().decompress(data))
+
+
+# Codecs based on optional dependencies, registered on first use.
+_OPTIONAL_CODECS = {'zstd': _zstd_codec}
+
+
+def register_codec(name: str, compress: Callable[[bytes], bytes],
+                   decompress: Callable[[bytes], bytes]):
+  """Registers a compression codec for array leaves.
+
+  Args:
+    name: name of the codec, which is stored with every compressed leaf.
+    compress: function mapping a bytes-like object to compressed bytes.
+    decompress: inverse of `compress`.
+  """
+  _CODECS[name] = (compress, decompress)
+
+
+def _get_codec(name: str):
+  if name not in _CODECS and name in _OPTIONAL_CODECS:
+    _CODECS[name] = _OPTIONAL_CODECS[name]()
+  if name not in _CODECS:
+    raise ValueError(f'Unknown compression codec {name!r}, available codecs: '
+                     f'{sorted(set(_CODECS) | set(_OPTIONAL_CODECS))}.')
+  return _CODECS[name]
+
+
+def _default_max_workers() -> int:
+  return min(32, (os.cpu_count() or 1) + 4)
+
+
+def _compress_ndarray(arr, codec: str) -> msgpack.ExtType:
+  """Encodes an ndarray as a compressed msgpack ext object if it shrinks."""
+  compress, _ = _get_codec(codec)
+  arr = np.ascontiguousarray(np.asarray(arr))
+  if arr.dtype.hasobject or arr.dtype.isalignedstruct:
+    raise ValueError('Object and structured dtypes not supported '
+                     'for serialization of ndarrays.')
+  data = compress(arr.reshape(-1).view(np.uint8))
+  if len(data) >= arr.nbytes:
+    return msgpack.ExtType(_MsgpackExtType.ndarray, _ndarray_to_bytes(arr))
+  tpl = (arr.shape, arr.dtype.name, codec, data)
+  return msgpack.ExtType(_MsgpackExtType.compressed_ndarray,
+                         msgpack.packb(tpl, use_bin_type=True))
+
+
+def _compressed_ndarray_from_bytes(data: bytes) -> np.ndarray:
+  """Load ndarray from compressed msgpack encoding."""
+  shape, dtype_name, codec, buffer = msgpack.unpackb(data, raw=True)
+  _, decompress = _get_codec(codec.decode('utf-8'))
+  return np.frombuffer(decompress(buffer),
+                       dtype=_dtype_from_name(dtype_name)).reshape(shape)
+
+
+def _compress_ordered(arrays: Iterable[np.ndarray], codec: str,
+                      max_workers: int):
+  """Yields compressed ext objects of `arrays` in order.
+
+  At most a few leaves per worker are in flight, which bounds the memory held
+  by compressed leaves that have not been consumed yet.
+  """
+  with futures.ThreadPoolExecutor(max_workers) as pool:
+    pending = collections.deque()
+    for arr in arrays:
+      pending.append(pool.submit(_compress_ndarray, arr, codec))
+      if len(pending) > 2 * max_workers:
+        yield pending.popleft().result()
+    while pending:
+      yield pending.popleft().result()
+
+
+def _array_leaf_refs(d):
+  """Returns (container, key) pairs of all ndarray leaves in a python tree."""
+  refs = []
+  items = d.items() if isinstance(d, dict) else enumerate(d)
+  for k, v in items:
+    if isinstance(v, np.ndarray):
+      refs.append((d, k))
+    elif isinstance(v, (dict, list)):
+      refs.extend(_array_leaf_refs(v))
+  return refs
+
+
+def _compress_array_leaves_in_place(d, codec: str, max_workers: int):
+  """Replaces ndarray leaves with compressed msgpack ext objects in place."""
+  refs = _array_leaf_refs(d)
+  encoded = _compress_ordered((c[k] for c, k in refs), codec, max_workers)
+  for (container, key), ext in zip(refs, encoded):
+    container[key] = ext
+
+
+class _CompressedLeaf:
+  """Placeholder for a compressed leaf that is decompressed later."""
+
+  def __init__(self, data: bytes):
+    self.data = data
+
+
+def _deferred_ext_unpack(code, data):
+  if code == _MsgpackExtType.compressed_ndarray:
+    return _CompressedLeaf(data)
+  return _msgpack_ext_unpack(code, data)
+
+
+def _decompress_leaves_in_place(d, max_workers: int, cast=None):
+  """Replaces `_CompressedLeaf` placeholders by decompressing concurrently.
+
+  Array leaves are converted right after decompression according to the
+  `cast` function of a dtype policy, except for the chunks of chunked arrays.
+  """
+  refs = []
+  def collect(x, prefix):
+    items = x.items() if isinstance(x, dict) else enumerate(x)
+    for k, v in items:
+      path = None if prefix is None else prefix + (k,)
+      if isinstance(v, _CompressedLeaf):
+        refs.append((x, k, path))
+      elif isinstance(v, dict) and '__msgpack_chunked_array__' in v:
+        collect(v, None)
+      elif isinstance(v, (dict, list)):
+        collect(v, path)
+  if isinstance(d, _CompressedLeaf):
+    return _cast_leaf(_compressed_ndarray_from_bytes(d.data), cast, ())
+  if isinstance(d, (dict, list)):
+    collect(d, None if '__msgpack_chunked_array__' in d else ())
+  if not refs:
+    return d
+  def decompress(ref):
+    container, key, path = ref
+    arr = _compressed_ndarray_from_bytes(container[key].data)
+    return arr if path is None else _cast_leaf(arr, cast, path)
+  with futures.ThreadPoolExecutor(max(1, min(max_workers, len(refs)))) as pool:
+    for (container, key, _), arr in zip(refs, pool.map(decompress, refs)):
+      container[key] = arr
+  return d
+
+
 # Chunking array leaves
 
 # msgpack has a hard limit of 2**31 - 1 bytes per object leaf.  To circumvent
@@ -258,23 +714,61 @@ _tuple_to_dict = lambda tpl: dict([(str(x), y) for x, y in enumerate(tpl)])
 _dict_to_tuple = lambda dct: tuple(dct[str(i)] for i in range(len(dct)))
 
 
+def _iter_chunks(arr) -> Iterator[np.ndarray]:
+  """Yields the flat C-ordered chunks of an array.
+
+  Chunks of C-contiguous arrays are views, other arrays are copied one chunk
+  at a time instead of flattening the whole array first.
+  """
+  chunksize = max(1, int(MAX_CHUNK_SIZE / arr.dtype.itemsize))
+  if arr.flags.c_contiguous:
+    flatarr = arr.reshape(-1)
+    for i in range(0, flatarr.size, chunksize):
+      yield flatarr[i:i + chunksize]
+  else:
+    for i in range(0, arr.size, chunksize):
+      yield arr.flat[i:i + chunksize]
+
+
 def _chunk(arr) -> Dict[str, Any]:
   """Convert array to a canonical dictionary of chunked arrays."""
-  chunksize = max(1, int(MAX_CHUNK_SIZE / arr.dtype.itemsize))
   data = {'__msgpack_chunked_array__': True,
           'shape': _tuple_to_dict(arr.shape)}
-  flatarr = arr.reshape(-1)
-  chunks = [flatarr[i:i + chunksize] for i in range(0, flatarr.size, chunksize)]
-  data['chunks'] = _tuple_to_dict(chunks)
+  data['chunks'] = _tuple_to_dict(list(_iter_chunks(arr)))
   return data
 
 
-def _unchunk(data: Dict[str, Any]):
-  """Convert canonical dictionary of chunked arrays back into array."""
+def _unchunk(data: Dict[str, Any], cast=None, path: Tuple[str, ...] = ()):
+  """Convert canonical dictionary of chunked arrays back into array.
+
+  The array is allocated once and every chunk is copied into its slice and
+  then released, so restoring never holds two full copies of the array.  The
+  chunks are converted while they are copied according to `cast`.
+  """
   assert '__msgpack_chunked_array__' in data
   shape = _dict_to_tuple(data['shape'])
-  flatarr = np.concatenate(_dict_to_tuple(data['chunks']))
-  return flatarr.reshape(shape)
+  chunks = data['chunks']
+  if chunks and isinstance(chunks['0'], LazyArray):
+    chunks = _dict_to_tuple(chunks)
+    segments = [segment for chunk in chunks for segment in chunk.segments]
+    codecs = [codec for chunk in chunks for codec in chunk.codecs]
+    return _cast_leaf(LazyArray(chunks[0].source, shape, chunks[0].dtype,
+                                segments, codecs), cast, path)
+  num_chunks = len(chunks)
+  dtype = chunks['0'].dtype
+  if cast is not None:
+    dtype = cast(path, dtype) or dtype
+  out = np.empty(shape, dtype)
+  flatarr = out.reshape(-1)
+  pos = 0
+  for i in range(num_chunks):
+    chunk = chunks.pop(str(i))
+    flatarr[pos:pos + chunk.size] = chunk
+    pos += chunk.size
+    del chunk
+  if pos != flatarr.size:
+    raise ValueError(f'Chunked array of shape {shape} has {pos} elements.')
+  return out
 
 
 def _chunk_array_leaves_in_place(d):
@@ -292,24 +786,952 @@ def _chunk_array_leaves_in_place(d):
   return d
 
 
-def _unchunk_array_leaves_in_place(d):
-  """Convert chunked array leaves back into array leaves, in place."""
+def _unchunk_array_leaves_in_place(d, cast=None, prefix=()):
+  """Convert chunked array leaves back into array leaves, in place.
+
+  If `cast` is given, array leaves are also converted according to it.
+  """
   if isinstance(d, dict):
     if '__msgpack_chunked_array__' in d:
-      return _unchunk(d)
+      return _unchunk(d, cast, prefix)
     else:
       for k, v in d.items():
         if isinstance(v, dict) and '__msgpack_chunked_array__' in v:
-          d[k] = _unchunk(v)
+          d[k] = _unchunk(v, cast, prefix + (k,))
         elif isinstance(v, dict):
-          _unchunk_array_leaves_in_place(v)
+          _unchunk_array_leaves_in_place(v, cast, prefix + (k,))
+        elif cast is not None:
+          d[k] = _cast_leaf(v, cast, prefix + (k,))
+  elif cast is not None:
+    return _cast_leaf(d, cast, prefix)
   return d
 
 
+# Streaming msgpack encoding
+
+# Instead of assembling the whole encoded tree in memory, the streaming writer
+# emits msgpack headers for container nodes and writes array buffers directly
+# to a file-like object, one leaf at a time.  The resulting byte stream is
+# identical to the one produced by `msgpack_serialize(..., in_place=True)`.
+
+# Upper bound on the size of a single `write` call for array buffers.
+_WRITE_BLOCK_SIZE = 64 << 20
+
+
+def _bin_header(size: int) -> bytes:
+  """Returns the msgpack bin header for a payload of `size` bytes."""
+  if size <= 0xff:
+    return struct.pack('>BB', 0xc4, size)
+  elif size <= 0xffff:
+    return struct.pack('>BH', 0xc5, size)
+  else:
+    return struct.pack('>BI', 0xc6, size)
+
+
+def _ext_header(code: int, size: int) -> bytes:
+  """Returns the msgpack ext header for a payload of `size` bytes."""
+  fixext = {1: 0xd4, 2: 0xd5, 4: 0xd6, 8: 0xd7, 16: 0xd8}
+  if size in fixext:
+    header = struct.pack('>B', fixext[size])
+  elif size <= 0xff:
+    header = struct.pack('>BB', 0xc7, size)
+  elif size <= 0xffff:
+    header = struct.pack('>BH', 0xc8, size)
+  else:
+    header = struct.pack('>BI', 0xc9, size)
+  return header + struct.pack('b', code)
+
+
+def _write_buffer(fp: BinaryIO, arr: np.ndarray) -> int:
+  """Writes the C-ordered bytes of `arr` to `fp` in bounded blocks."""
+  flat = np.ascontiguousarray(arr).reshape(-1).view(np.uint8)
+  for i in range(0, flat.size, _WRITE_BLOCK_SIZE):
+    fp.write(flat[i:i + _WRITE_BLOCK_SIZE].tobytes())
+  return flat.size
+
+
+def _write_ndarray(fp: BinaryIO, arr) -> int:
+  """Writes an ndarray leaf as a msgpack ext object without copying it."""
+  if isinstance(arr, jax.xla.DeviceArray):
+    arr = np.asarray(arr)
+  if arr.dtype.hasobject or arr.dtype.isalignedstruct:
+    raise ValueError('Object and structured dtypes not supported '
+                     'for serialization of ndarrays.')
+  nbytes = arr.size * arr.dtype.itemsize
+  packer = msgpack.Packer(use_bin_type=True)
+  inner_header = b''.join((packer.pack_array_header(3),
+                           packer.pack(arr.shape),
+                           packer.pack(arr.dtype.name),
+                           _bin_header(nbytes)))
+  header = _ext_header(_MsgpackExtType.ndarray, len(inner_header) + nbytes)
+  fp.write(header)
+  fp.write(inner_header)
+  return len(header) + len(inner_header) + _write_buffer(fp, arr)
+
+
+def _as_written(x):
+  """Converts device arrays to numpy arrays."""
+  if isinstance(x, jax.xla.DeviceArray):
+    x = np.asarray(x)
+  return x
+
+
+def _is_oversized(x) -> bool:
+  return isinstance(x, np.ndarray) and x.size * x.dtype.itemsize > MAX_CHUNK_SIZE
+
+
+def _tree_arrays(x):
+  """Yields the array leaves of a python tree in the order they are written."""
+  x = _as_written(x)
+  if _is_oversized(x):
+    yield from _iter_chunks(x)
+  elif type(x) is dict:  # pylint: disable=unidiomatic-typecheck
+    for value in x.values():
+      yield from _tree_arrays(value)
+  elif type(x) is list:  # pylint: disable=unidiomatic-typecheck
+    for value in x:
+      yield from _tree_arrays(value)
+  elif isinstance(x, np.ndarray):
+    yield x
+
+
+def _write_chunked(fp: BinaryIO, packer: msgpack.Packer, arr: np.ndarray,
+                   encoded: Optional[Iterator[msgpack.ExtType]] = None) -> int:
+  """Writes the encoding of `_chunk(arr)` one chunk at a time."""
+  num_chunks = -(-arr.size // max(1, int(MAX_CHUNK_SIZE / arr.dtype.itemsize)))
+  header = b''.join((packer.pack_map_header(3),
+                     packer.pack('__msgpack_chunked_array__'),
+                     packer.pack(True),
+                     packer.pack('shape'),
+                     packer.pack(_tuple_to_dict(arr.shape)),
+                     packer.pack('chunks'),
+                     packer.pack_map_header(num_chunks)))
+  fp.write(header)
+  written = len(header)
+  for i, chunk in enumerate(_iter_chunks(arr)):
+    encoded_key = packer.pack(str(i))
+    fp.write(encoded_key)
+    written += len(encoded_key) + _write_tree(fp, packer, chunk, encoded)
+  return written
+
+
+def _write_tree(fp: BinaryIO, packer: msgpack.Packer, x,
+                encoded: Optional[Iterator[msgpack.ExtType]] = None) -> int:
+  """Recursively writes a python tree with array leaves to `fp`.
+
+  If given, `encoded` yields the pre-encoded ext objects of the array leaves
+  in the order of `_tree_arrays`.
+  """
+  x = _as_written(x)
+  if _is_oversized(x):
+    return _write_chunked(fp, packer, x, encoded)
+  elif type(x) is dict:  # pylint: disable=unidiomatic-typecheck
+    header = packer.pack_map_header(len(x))
+    fp.write(header)
+    written = len(header)
+    for key, value in x.items():
+      encoded_key = packer.pack(key)
+      fp.write(encoded_key)
+      written += len(encoded_key) + _write_tree(fp, packer, value, encoded)
+    return written
+  elif type(x) is list:  # pylint: disable=unidiomatic-typecheck
+    header = packer.pack_array_header(len(x))
+    fp.write(header)
+    return len(header) + sum(_write_tree(fp, packer, v, encoded) for v in x)
+  elif isinstance(x, np.ndarray) and encoded is not None:
+    data = packer.pack(next(encoded))
+    fp.write(data)
+    return len(data)
+  elif isinstance(x, np.ndarray):
+    return _write_ndarray(fp, x)
+  else:
+    encoded = packer.pack(x)
+    fp.write(encoded)
+    return len(encoded)
+
+
+# Lazy msgpack decoding
+
+# The lazy decoder walks the msgpack structure of an encoded state dict
+# without touching array payloads.  It records the offset of every array
+# buffer and returns `LazyArray` leaves that read their bytes on demand, e.g.
+# from a memory-mapped checkpoint file.
+
+
+class _BufferSource:
+  """Random-access byte source backed by a buffer (bytes, mmap, ...)."""
+
+  thread_safe = True
+
+  def __init__(self, buffer):
+    self._view = memoryview(buffer).cast('B')
+
+  def size(self) -> int:
+    return self._view.nbytes
+
+  def read(self, offset: int, size: int) -> bytes:
+    if offset + size > self._view.nbytes:
+      raise ValueError('Unexpected end of msgpack data.')
+    return self._view[offset:offset + size]
+
+  def readinto(self, offset: int, out: memoryview):
+    out[:] = self.read(offset, out.nbytes)
+
+
+class LazyArray:
+  """Array leaf of a serialized state dict that is read on first access.
+
+  Only the shape, dtype and location of the array bytes are known until
+  `materialize` (or `np.asarray`) is called.  `from_state_dict` materializes
+  lazy leaves automatically, so restoring a target that only covers a subtree
+  of the serialized state only reads the bytes of that subtree.
+  """
+
+  def __init__(self, source, shape, dtype, segments, codecs=None):
+    self.source = source
+    self.shape = tuple(shape)
+    self.dtype = dtype
+    # Dtype of the serialized elements, which are converted to `dtype`.
+    self.stored_dtype = dtype
+    # (offset, length) byte ranges that make up the C-ordered array buffer.
+    self.segments = tuple(segments)
+    # Per segment, None for raw bytes or a (codec name, decompressed size) pair.
+    self.codecs = (tuple(codecs) if codecs is not None
+                   else (None,) * len(self.segments))
+
+  @property
+  def ndim(self) -> int:
+    return len(self.shape)
+
+  @property
+  def size(self) -> int:
+    return math.prod(self.shape)
+
+  @property
+  def nbytes(self) -> int:
+    return self.size * np.dtype(self.dtype).itemsize
+
+  @property
+  def stored_nbytes(self) -> int:
+    return self.size * np.dtype(self.stored_dtype).itemsize
+
+  def astype(self, dtype) -> 'LazyArray':
+    """Returns a lazy array whose elements are converted while they are read."""
+    cast = LazyArray(self.source, self.shape, self.stored_dtype, self.segments,
+                     self.codecs)
+    cast.dtype = dtype
+    return cast
+
+  def materialize(self) -> np.ndarray:
+    """Reads the array bytes into a newly allocated ndarray."""
+    out = np.empty(self.shape, self.dtype)
+    for task in self._read_tasks(out, None):
+      _read_segment(*task)
+    return out
+
+  def _read_tasks(self, out: np.ndarray, chunk_size: Optional[int]):
+    """Returns the `_read_segment` arguments that fill `out`.
+
+    Raw segments are split into reads of about `chunk_size` bytes, or read as
+    a whole if `chunk_size` is None and no conversion is needed.
+    """
+    stored = np.dtype(self.stored_dtype)
+    convert = np.dtype(self.dtype) != stored
+    if convert:
+      # Every converted read allocates a temporary buffer.
+      chunk_size = min(chunk_size or _MIN_READ_CHUNK_SIZE, _MIN_READ_CHUNK_SIZE)
+    flat = out.reshape(-1)
+    view = memoryview(flat.view(np.uint8))
+    tasks = []
+    pos = 0
+    for (offset, length), codec in zip(self.segments, self.codecs):
+      size = length if codec is None else codec[1]
+      if codec is not None or chunk_size is None:
+        # Compressed segments are read and decompressed as a whole.
+        step = max(size, 1)
+      else:
+        step = max(chunk_size // stored.itemsize, 1) * stored.itemsize
+      for i in range(0, size, step):
+        n = min(step, size - i)
+        source_range = (offset + i, n) if codec is None else (offset, length)
+        if convert:
+          start = (pos + i) // stored.itemsize
+          tasks.append((self.source, *source_range, codec,
+                        flat[start:start + n // stored.itemsize], stored))
+        else:
+          tasks.append((self.source, *source_range, codec,
+                        view[pos + i:pos + i + n], None))
+      pos += size
+    if pos != self.stored_nbytes:
+      raise ValueError(f'Serialized array of shape {self.shape} and dtype '
+                       f'{self.stored_dtype} has {pos} bytes, expected '
+                       f'{self.stored_nbytes}.')
+    return tasks
+
+  def __array__(self, dtype=None):
+    arr = self.materialize()
+    return arr if dtype is None else arr.astype(dtype)
+
+  def __repr__(self):
+    return f'LazyArray(shape={self.shape}, dtype={np.dtype(self.dtype).name})'
+
+
+def _read_segment(source, offset: int, length: int, codec, out, dtype=None):
+  """Reads a raw or compressed segment of an array buffer into `out`.
+
+  `out` is a memoryview of raw bytes, or if the elements of the segment are of
+  another `dtype`, an ndarray that they are converted into.
+  """
+  if dtype is not None:
+    size = length if codec is None else codec[1]
+    buffer = np.empty(size // np.dtype(dtype).itemsize, dtype)
+    _read_segment(source, offset, length, codec,
+                  memoryview(buffer.view(np.uint8)))
+    out[...] = buffer
+  elif codec is None:
+    source.readinto(offset, out)
+  else:
+    _, decompress = _get_codec(codec[0])
+    out[:] = decompress(source.read(offset, length))
+
+
+class _LazyMsgpackDecoder:
+  """Minimal msgpack decoder producing `LazyArray` leaves for ndarrays."""
+
+  def __init__(self, source):
+    self._source = source
+    self._pos = 0
+
+  def _take(self, size: int) -> bytes:
+    data = self._source.read(self._pos, size)
+    self._pos += size
+    return data
+
+  def _unpack(self, fmt: str):
+    return struct.unpack(fmt, self._take(struct.calcsize(fmt)))[0]
+
+  def _str(self, size: int) -> str:
+    return bytes(self._take(size)).decode('utf-8')
+
+  def _map(self, size: int):
+    result = {}
+    for _ in range(size):
+      key = self.decode()
+      result[key] = self.decode()
+    return result
+
+  def _ext(self, size: int):
+    code = self._unpack('b')
+    if code not in (_MsgpackExtType.ndarray,
+                    _MsgpackExtType.compressed_ndarray):
+      return _msgpack_ext_unpack(code, bytes(self._take(size)))
+    shape, dtype, codec, offset, nbytes = self.decode_ndarray(code, size)
+    return LazyArray(_array_source(self._source), shape, dtype,
+                     [(offset, nbytes)], [codec])
+
+  def decode_ndarray(self, code: int, size: int):
+    """Decodes the payload of a (compressed) ndarray ext object of `size`.
+
+    Returns:
+      A tuple of shape, dtype, codec (None or a (name, decompressed size)
+      pair), offset and size of the array bytes.
+    """
+    end = self._pos + size
+    compressed = code == _MsgpackExtType.compressed_ndarray
+    if self.decode_header() != ('array', 4 if compressed else 3):
+      raise ValueError('Invalid msgpack encoding of ndarray.')
+    shape = self.decode()
+    dtype = _dtype_from_name(self.decode().encode())
+    codec = None
+    if compressed:
+      size = int(np.prod(shape, dtype=np.int64)) * np.dtype(dtype).itemsize
+      codec = (self.decode(), size)
+    kind, nbytes = self.decode_header()
+    if kind != 'bin' or self._pos + nbytes != end:
+      raise ValueError('Invalid msgpack encoding of ndarray.')
+    offset = self._pos
+    self._pos = end
+    return shape, dtype, codec, offset, nbytes
+
+  def decode_header(self):
+    """Decodes the next type byte, returns a (kind, value or length) pair."""
+    b = self._unpack('B')
+    if b <= 0x7f:
+      return 'value', b
+    elif b >= 0xe0:
+      return 'value', b - 0x100
+    elif 0x80 <= b <= 0x8f:
+      return 'map', b & 0x0f
+    elif 0x90 <= b <= 0x9f:
+      return 'array', b & 0x0f
+    elif 0xa0 <= b <= 0xbf:
+      return 'str', b & 0x1f
+    elif b in (0xc0, 0xc2, 0xc3):
+      return 'value', {0xc0: None, 0xc2: False, 0xc3: True}[b]
+    elif b in _FIXED_SIZE_FORMATS:
+      return 'value', self._unpack(_FIXED_SIZE_FORMATS[b])
+    elif b in _LENGTH_FORMATS:
+      kind, fmt = _LENGTH_FORMATS[b]
+      return kind, self._unpack(fmt)
+    elif 0xd4 <= b <= 0xd8:
+      return 'ext', 1 << (b - 0xd4)
+    raise ValueError(f'Invalid msgpack type byte 0x{b:02x}.')
+
+  def decode(self):
+    """Decodes the next msgpack object."""
+    kind, value = self.decode_header()
+    if kind == 'value':
+      return value
+    elif kind == 'map':
+      return self._map(value)
+    elif kind == 'array':
+      return [self.decode() for _ in range(value)]
+    elif kind == 'str':
+      return self._str(value)
+    elif kind == 'bin':
+      return bytes(self._take(value))
+    else:
+      return self._ext(value)
+
+
+_FIXED_SIZE_FORMATS = {
+    0xca: '>f', 0xcb: '>d',
+    0xcc: '>B', 0xcd: '>H', 0xce: '>I', 0xcf: '>Q',
+    0xd0: '>b', 0xd1: '>h', 0xd2: '>i', 0xd3: '>q',
+}
+
+_LENGTH_FORMATS = {
+    0xc4: ('bin', '>B'), 0xc5: ('bin', '>H'), 0xc6: ('bin', '>I'),
+    0xc7: ('ext', '>B'), 0xc8: ('ext', '>H'), 0xc9: ('ext', '>I'),
+    0xd9: ('str', '>B'), 0xda: ('str', '>H'), 0xdb: ('str', '>I'),
+    0xdc: ('array', '>H'), 0xdd: ('array', '>I'),
+    0xde: ('map', '>H'), 0xdf: ('map', '>I'),
+}
+
+
+class _FileSource:
+  """Random-access byte source backed by a seekable file-like object.
+
+  Files with a file descriptor are read with `os.pread` / `os.preadv`, which
+  don't move the file position and are safe to use from multiple threads.
+  """
+
+  def __init__(self, fp):
+    self._fp = fp
+    try:
+      self._fd = fp.fileno()
+    except (AttributeError, OSError, ValueError):
+      self._fd = None
+
+  @property
+  def thread_safe(self) -> bool:
+    return self._fd is not None
+
+  def size(self) -> int:
+    if self._fd is not None:
+      return os.fstat(self._fd).st_size
+    self._fp.seek(0, 2)
+    return self._fp.tell()
+
+  def read(self, offset: int, size: int) -> bytes:
+    if self._fd is not None:
+      data = os.pread(self._fd, size, offset)
+    else:
+      self._fp.seek(offset)
+      data = self._fp.read(size)
+    if len(data) != size:
+      raise ValueError('Unexpected end of file.')
+    return data
+
+  def readinto(self, offset: int, out: memoryview):
+    if self._fd is not None and hasattr(os, 'preadv'):
+      pos = 0
+      while pos < out.nbytes:
+        n = os.preadv(self._fd, [out[pos:]], offset + pos)
+        if n == 0:
+          raise ValueError('Unexpected end of file.')
+        pos += n
+    elif hasattr(self._fp, 'readinto'):
+      self._fp.seek(offset)
+      if self._fp.readinto(out) != out.nbytes:
+        raise ValueError('Unexpected end of file.')
+    else:
+      out[:] = self.read(offset, out.nbytes)
+
+
+class _ReadAheadSource:
+  """Caches a window of a source to serve many small header reads at once.
+
+  The window isn't guarded by a lock, so the source is only meant for the
+  sequential reads of a decoder.  Array payloads are read from the wrapped
+  `source`, see `_array_source`.
+  """
+
+  def __init__(self, source, block_size: int = 1 << 16):
+    self.source = source
+    self._block_size = block_size
+    self._size = source.size()
+    self._window_start = 0
+    self._window = b''
+
+  @property
+  def thread_safe(self) -> bool:
+    return False
+
+  def size(self) -> int:
+    return self._size
+
+  def read(self, offset: int, size: int) -> bytes:
+    start = offset - self._window_start
+    if start < 0 or start + size > len(self._window):
+      if size >= self._block_size:
+        return self.source.read(offset, size)
+      self._window_start = offset
+      self._window = memoryview(self.source.read(
+          offset, min(self._block_size, self._size - offset)))
+      start = 0
+    if start + size > len(self._window):
+      raise ValueError('Unexpected end of file.')
+    return self._window[start:start + size]
+
+  def readinto(self, offset: int, out: memoryview):
+    self.source.readinto(offset, out)
+
+
+def _array_source(source):
+  """Returns the source that `LazyArray` leaves decoded from `source` read.
+
+  Bypasses the read-ahead window, which can't be shared by the threads of
+  `materialize_parallel`.
+  """
+  if isinstance(source, _ReadAheadSource):
+    return source.source
+  return source
+
+
+def _as_source(data):
+  """Returns a byte source for a buffer or a seekable file-like object."""
+  if isinstance(data, (bytes, bytearray, memoryview, mmap.mmap)):
+    return _BufferSource(data)
+  return _ReadAheadSource(_FileSource(data))
+
+
+# Indexed format
+
+# The indexed format stores a state dict as a msgpack-encoded index followed by
+# the raw, aligned bytes of all array leaves:
+#
+#   magic (8 bytes) | index size (uint64 LE) | index | padding | payloads
+#
+# The index holds one record per leaf of the flattened state dict, keyed by the
+# same tuple paths as `traverse_util.flatten_dict(..., keep_empty_nodes=True)`.
+# Array records contain dtype, shape, offset (relative to the first payload),
+# length and CRC32 checksum of the payload, so any subset of leaves can be read
+# without touching the rest of the file.  Other leaves are stored inline.
+
+# 0xc1 is never used by msgpack, so indexed files can't be mistaken for it.
+INDEXED_FORMAT_MAGIC = b'\xc1FLAXIDX'
+_INDEXED_FORMAT_VERSION = 1
+# Alignment of array payloads in bytes.
+_INDEXED_ALIGNMENT = 64
+
+PathFilter = Union[Callable[[str, Any], bool], Iterable[Union[str, Tuple[str, ...]]]]
+
+# Dtypes of restored array leaves, either a dtype that all floating point
+# leaves are converted to, or a function `(path, dtype) -> dtype` that is
+# called with the '/'-joined path and stored dtype of every array leaf and
+# returns the dtype to convert it to (None keeps the stored dtype).
+DtypePolicy = Union[Any, Callable[[str, Any], Any]]
+
+
+def _dtype_policy(dtype: Optional[DtypePolicy]):
+  """Returns the `cast(path, dtype) -> Optional[dtype]` function of a policy.
+
+  The returned function returns None for leaves that keep their dtype.
+  """
+  if dtype is None:
+    return None
+  try:
+    new_dtype = np.dtype(dtype)
+  except TypeError:
+    if not callable(dtype):
+      raise
+    def cast(path, stored):
+      new = dtype('/' + '/'.join(map(str, path)), np.dtype(stored))
+      return None if new is None or np.dtype(new) == stored else np.dtype(new)
+    return cast
+  def cast_floating(path, stored):
+    del path
+    stored = np.dtype(stored)
+    if jax.numpy.issubdtype(stored, jax.numpy.floating) and stored != new_dtype:
+      return new_dtype
+    return None
+  return cast_floating
+
+
+def _cast_leaf(x, cast, path: Tuple[str, ...]):
+  """Converts an array leaf according to `cast`, lazy leaves on read."""
+  if cast is None or not isinstance(x, (np.ndarray, np.generic, LazyArray)):
+    return x
+  new = cast(path, x.dtype)
+  return x if new is None else x.astype(new)
+
+
+def target_dtypes(target) -> Callable[[str, Any], Any]:
+  """Returns a dtype policy that restores leaves with the dtypes of `target`.
+
+  Example::
+
+    params = serialization.from_bytes(
+        bf16_params, encoded, dtype=serialization.target_dtypes(bf16_params))
+
+  Args:
+    target: object whose state dict has array leaves of the desired dtypes.
+
+  Returns:
+    A `DtypePolicy` mapping the paths of the array leaves of `target`.
+  """
+  dtypes = {'/' + '/'.join(path): np.dtype(leaf.dtype)
+            for path, leaf in _flatten_state_dict(to_state_dict(target)).items()
+            if hasattr(leaf, 'dtype') and hasattr(leaf, 'shape')}
+  return lambda path, dtype: dtypes.get(path)
+
+
+def cast_state_dict(state_dict, dtype: Optional[DtypePolicy]):
+  """Converts the array leaves of a state dict according to a dtype policy.
+
+  `LazyArray` leaves stay lazy and are converted while they are read.
+  """
+  cast = _dtype_policy(dtype)
+  if cast is None:
+    return state_dict
+  return _unflatten_state_dict({
+      path: _cast_leaf(leaf, cast, path)
+      for path, leaf in _flatten_state_dict(state_dict).items()})
+
+
+def _align(offset: int, alignment: int = _INDEXED_ALIGNMENT) -> int:
+  return -(-offset // alignment) * alignment
+
+
+def _crc32(arr: np.ndarray) -> int:
+  return zlib.crc32(np.ascontiguousarray(arr).reshape(-1).view(np.uint8))
+
+
+def _flatten_state_dict(xs, prefix=()) -> Dict[Tuple[str, ...], Any]:
+  """Flattens a state dict into {path: leaf}, keeping empty dicts as leaves."""
+  if not isinstance(xs, dict) or not xs:
+    return {prefix: xs}
+  result = {}
+  for key, value in xs.items():
+    result.update(_flatten_state_dict(value, prefix + (key,)))
+  return result
+
+
+def _unflatten_state_dict(xs: Dict[Tuple[str, ...], Any]):
+  """Inverse of `_flatten_state_dict`."""
+  if () in xs:
+    return xs[()]
+  result = {}
+  for path, value in xs.items():
+    cursor = result
+    for key in path[:-1]:
+      cursor = cursor.setdefault(key, {})
+    cursor[path[-1]] = value
+  return result
+
+
+def _path_filter(paths: Optional[PathFilter]):
+  """Returns a predicate `(path, leaf) -> bool` for a path filter.
+
+  `paths` is either a `ModelParamTraversal`-style filter function, which
+  receives '/'-joined paths like '/params/Dense_0/kernel' and the (lazy)
+  leaf, or a collection of flattened keys (tuples or '/'-joined strings).
+  A single '/'-joined string is a collection of one key. Keys select the leaf
+  with that path as well as all leaves below it.
+  """
+  if paths is None:
+    return lambda path, leaf: True
+  if callable(paths):
+    return lambda path, leaf: paths('/' + '/'.join(path), leaf)
+  if isinstance(paths, str):
+    paths = [paths]
+  prefixes = {tuple(p.strip('/').split('/')) if isinstance(p, str) else tuple(p)
+              for p in paths}
+  def selected(path, leaf):
+    del leaf
+    return any(path[:i] in prefixes for i in range(len(path) + 1))
+  return selected
+
+
+def select_paths(state_dict, paths: PathFilter):
+  """Returns the sub-tree of `state_dict` that contains the selected leaves.
+
+  Args:
+    state_dict: nested state dict, e.g. as returned by `msgpack_restore_lazy`.
+    paths: a filter function `(path, leaf) -> bool` in the style of
+      `traverse_util.ModelParamTraversal` or a collection of flattened keys as
+      produced by `traverse_util.flatten_dict` (or their '/'-joined form).
+
+  Returns:
+    A nested state dict with only the selected leaves.
+  """
+  selected = _path_filter(paths)
+  flat = _flatten_state_dict(state_dict)
+  return _unflatten_state_dict(
+      {path: leaf for path, leaf in flat.items() if selected(path, leaf)})
+
+
+def materialize(state_dict):
+  """Replaces all `LazyArray` leaves of a state dict with ndarrays."""
+  if isinstance(state_dict, dict):
+    return {k: materialize(v) for k, v in state_dict.items()}
+  elif isinstance(state_dict, LazyArray):
+    return state_dict.materialize()
+  return state_dict
+
+
+@dataclasses.dataclass
+class ReadStats:
+  """Statistics of reading array leaves with `materialize_parallel`."""
+  num_bytes: int
+  seconds: float
+  num_threads: int
+  chunk_size: int
+
+  @property
+  def bandwidth(self) -> float:
+    """Achieved read bandwidth in bytes per second."""
+    return self.num_bytes / max(self.seconds, 1e-9)
+
+
+# Bounds of the chunk size used for parallel reads.
+_MIN_READ_CHUNK_SIZE = 8 << 20
+_MAX_READ_CHUNK_SIZE = 128 << 20
+
+
+def materialize_parallel(state_dict,
+                         open_file: Optional[Callable[[], BinaryIO]] = None,
+                         max_workers: Optional[int] = None,
+                         chunk_size: Optional[int] = None):
+  """Replaces all `LazyArray` leaves of a state dict by reading concurrently.
+
+  Every leaf is allocated once and its bytes are read straight into the
+  destination array in chunks, which are distributed over a thread pool.
+  Reads of small leaves are grouped into batches of about `chunk_size` bytes.
+
+  Args:
+    state_dict: nested state dict with `LazyArray` leaves.
+    open_file: optional function that opens the file backing the lazy leaves.
+      Sources that don't support concurrent positional reads (e.g. remote
+      files) are read through one handle per worker thread opened with this
+      function, otherwise their reads are serialized.
+    max_workers: number of reader threads, defaults to a value based on the
+      CPU count.
+    chunk_size: number of bytes per read, defaults to a value based on the
+      total size of the leaves and the number of threads.
+
+  Returns:
+    A tuple of the materialized state dict and the `ReadStats` of the read.
+  """
+  flat = _flatten_state_dict(state_dict)
+  lazy_paths = [p for p, leaf in flat.items() if isinstance(leaf, LazyArray)]
+  total = sum(flat[p].stored_nbytes for p in lazy_paths)
+  if max_workers is None:
+    max_workers = _default_max_workers()
+  if chunk_size is None:
+    chunk_size = min(max(total // (4 * max_workers), _MIN_READ_CHUNK_SIZE),
+                     _MAX_READ_CHUNK_SIZE)
+
+  tasks = []
+  for path in lazy_paths:
+    leaf = flat[path]
+    out = np.empty(leaf.shape, leaf.dtype)
+    flat[path] = out
+    tasks.extend(leaf._read_tasks(out, chunk_size))  # pylint: disable=protected-access
+
+  lock = threading.Lock()
+  local = threading.local()
+  opened = []
+
+  def read(task):
+    source, offset, length, codec, out, dtype = task
+    if source.thread_safe:
+      _read_segment(source, offset, length, codec, out, dtype)
+    elif open_file is not None:
+      if not hasattr(local, 'source'):
+        fp = open_file()
+        with lock:
+          opened.append(fp)
+        local.source = _FileSource(fp)
+      _read_segment(local.source, offset, length, codec, out, dtype)
+    elif codec is None and dtype is None:
+      with lock:
+        source.readinto(offset, out)
+    else:
+      with lock:
+        data = source.read(offset, length)
+      _read_segment(_BufferSource(data), 0, length, codec, out, dtype)
+
+  def read_batch(batch):
+    # Raw segments of a batch that lie close together in a thread-safe source
+    # are read with a single read of the byte range that spans them.
+    source = batch[0][0]
+    start = min(task[1] for task in batch)
+    end = max(task[1] + task[2] for task in batch)
+    if (len(batch) > 1 and source.thread_safe
+        and all(task[0] is source and task[3] is None and task[5] is None
+                for task in batch)
+        and end - start <= 2 * sum(task[2] for task in batch)):
+      data = memoryview(source.read(start, end - start))
+      for _, offset, length, _, out, _ in batch:
+        out[:] = data[offset - start:offset - start + length]
+    else:
+      for task in batch:
+        read(task)
+
+  # Consecutive small tasks are grouped into batches of up to `chunk_size`
+  # bytes, so trees of many small leaves don't need a task per leaf.
+  batches = []
+  batch_size = 0
+  for task in tasks:
+    if not batches or batch_size + task[2] > chunk_size:
+      batches.append([])
+      batch_size = 0
+    batches[-1].append(task)
+    batch_size += task[2]
+
+  num_threads = max(1, min(max_workers, len(batches)))
+  start = time.perf_counter()
+  try:
+    if num_threads > 1:
+      with futures.ThreadPoolExecutor(num_threads) as pool:
+        list(pool.map(read_batch, batches))
+    else:
+      for batch in batches:
+        read_batch(batch)
+  finally:
+    for fp in opened:
+      fp.close()
+  stats = ReadStats(total, time.perf_counter() - start, num_threads, chunk_size)
+  return _unflatten_state_dict(flat), stats
+
+
+def indexed_serialize_to_file(pytree, fp: BinaryIO) -> int:
+  """Save data structure to a file-like object in the indexed format.
+
+  The index is computed from the shapes and dtypes of the leaves, after which
+  the array payloads are streamed to `fp` one leaf at a time.
+
+  Args:
+    pytree: nested dict with python primitives and array leaves, usually a
+      state dict.
+    fp: writable binary file-like object.
+
+  Returns:
+    The number of bytes written to `fp`.
+  """
+  flat = _flatten_state_dict(pytree)
+  records = []
+  arrays = []
+  offset = 0
+  for path, leaf in flat.items():
+    if isinstance(leaf, (np.ndarray, jax.xla.DeviceArray)):
+      arr = np.asarray(leaf)
+      if arr.dtype.hasobject or arr.dtype.isalignedstruct:
+        raise ValueError('Object and structured dtypes not supported '
+                         'for serialization of ndarrays.')
+      offset = _align(offset)
+      records.append({'path': list(path), 'dtype': arr.dtype.name,
+                      'shape': list(arr.shape), 'offset': offset,
+                      'length': arr.nbytes,
+                      'crc32': _crc32(arr)})
+      arrays.append((offset, leaf))
+      offset += arr.nbytes
+      del arr
+    else:
+      records.append({'path': list(path), 'value': leaf})
+  index = msgpack.packb(
+      {'version': _INDEXED_FORMAT_VERSION, 'alignment': _INDEXED_ALIGNMENT,
+       'leaves': records},
+      default=_msgpack_ext_pack, strict_types=True)
+  header = INDEXED_FORMAT_MAGIC + struct.pack('<Q', len(index)) + index
+  data_start = _align(len(header))
+  fp.write(header + bytes(data_start - len(header)))
+  pos = 0
+  for offset, leaf in arrays:
+    if offset > pos:
+      fp.write(bytes(offset - pos))
+    pos = offset + _write_buffer(fp, np.asarray(leaf))
+  return data_start + pos
+
+
+def _read_index(source):
+  """Reads the index of an indexed file, returns (index, payload offset)."""
+  prefix = bytes(source.read(0, len(INDEXED_FORMAT_MAGIC) + 8))
+  if not prefix.startswith(INDEXED_FORMAT_MAGIC):
+    raise ValueError('Not a file in the indexed format.')
+  index_size, = struct.unpack('<Q', prefix[len(INDEXED_FORMAT_MAGIC):])
+  index = msgpack.unpackb(bytes(source.read(len(prefix), index_size)),
+                          ext_hook=_msgpack_ext_unpack, raw=False)
+  if index['version'] > _INDEXED_FORMAT_VERSION:
+    raise ValueError(f'Unsupported indexed format version {index["version"]}.')
+  return index, _align(len(prefix) + index_size, index['alignment'])
+
+
+def _indexed_restore_lazy(source, paths: Optional[PathFilter] = None,
+                          cast=None):
+  """Returns the lazily restored state dict of an indexed file."""
+  index, data_start = _read_index(source)
+  selected = _path_filter(paths)
+  flat = {}
+  for record in index['leaves']:
+    path = tuple(record['path'])
+    if 'value' in record:
+      leaf = record['value']
+    else:
+      leaf = LazyArray(_array_source(source), record['shape'],
+                       _dtype_from_name(record['dtype'].encode()),
+                       [(data_start + record['offset'], record['length'])])
+    if selected(path, leaf):
+      flat[path] = _cast_leaf(leaf, cast, path)
+  return _unflatten_state_dict(flat)
+
+
+def is_indexed_format(prefix: bytes) -> bool:
+  """Returns whether serialized data starting with `prefix` is indexed."""
+  return bytes(prefix[:len(INDEXED_FORMAT_MAGIC)]) == INDEXED_FORMAT_MAGIC
+
+
+def indexed_restore(fp, paths: Optional[PathFilter] = None,
+                    lazy: bool = False, dtype: Optional[DtypePolicy] = None):
+  """Restore data structure from a file in the indexed format.
+
+  Args:
+    fp: seekable binary file-like object, or a buffer such as `mmap.mmap`.
+    paths: optional filter selecting the leaves to restore, see
+      `select_paths`.  Only the byte ranges of selected leaves are read.
+    lazy: if True, array leaves are returned as `LazyArray` proxies that read
+      from `fp` on access, so `fp` must remain open while they are used.
+    dtype: optional `DtypePolicy`, array leaves are converted while they are
+      read.
+
+  Returns:
+    Nested dict with python primitive and array leaves.
+  """
+  state_dict = _indexed_restore_lazy(_as_source(fp), paths,
+                                     _dtype_policy(dtype))
+  if lazy:
+    return state_dict
+  return materialize(state_dict)
+
+
 # User-facing API calls:
 
 
-def msgpack_serialize(pytree, in_place: bool = False) -> bytes:
+def msgpack_serialize(pytree, in_place: bool = False,
+                      codec: Optional[str] = None,
+                      max_workers: Optional[int] = None) -> bytes:
   """Save data structure to bytes in msgpack format.
 
   Low-level function that only supports python trees with array leaves,
@@ -320,6 +1742,11 @@ def msgpack_serialize(pytree, in_place: bool = False) -> bytes:
     pytree: python tree of dict, list, tuple with python primitives
       and array leaves.
     in_place: boolean specifyng if pytree should be modified in place.
+    codec: optional name of the codec used to compress array leaves, e.g.
+      'zlib', 'lzma', 'zstd' (requires the `zstandard` package) or a codec
+      added with `register_codec`.  Leaves are compressed concurrently.
+    max_workers: number of compression threads, defaults to a value based on
+      the CPU count.
 
   Returns:
     msgpack-encoded bytes of pytree.
@@ -328,10 +1755,51 @@ def msgpack_serialize(pytree, in_place: bool = False) -> bytes:
     pytree = jax.tree_map(lambda x: x, pytree)
   pytree = _np_convert_in_place(pytree)
   pytree = _chunk_array_leaves_in_place(pytree)
+  if codec is not None:
+    if isinstance(pytree, np.ndarray):
+      pytree = _compress_ndarray(pytree, codec)
+    elif isinstance(pytree, (dict, list)):
+      _compress_array_leaves_in_place(
+          pytree, codec, max_workers or _default_max_workers())
   return msgpack.packb(pytree, default=_msgpack_ext_pack, strict_types=True)
 
 
-def msgpack_restore(encoded_pytree: bytes):
+def msgpack_serialize_to_file(pytree, fp: BinaryIO,
+                              codec: Optional[str] = None,
+                              max_workers: Optional[int] = None) -> int:
+  """Save data structure to a file-like object in msgpack format.
+
+  Streaming variant of `msgpack_serialize`: array leaves are written to `fp`
+  one at a time as they are encoded, so the full serialized byte string is
+  never materialized in memory.  The bytes written are identical to the
+  output of `msgpack_serialize(pytree, in_place=True)`, hence files written
+  this way can be read back with `msgpack_restore`.
+
+  Args:
+    pytree: python tree of dict, list, tuple with python primitives
+      and array leaves.
+    fp: writable binary file-like object.
+    codec: optional name of the codec used to compress array leaves, see
+      `msgpack_serialize`.  Leaves are compressed concurrently while earlier
+      leaves are written.
+    max_workers: number of compression threads, defaults to a value based on
+      the CPU count.
+
+  Returns:
+    The number of bytes written to `fp`.
+  """
+  packer = msgpack.Packer(default=_msgpack_ext_pack, strict_types=True)
+  if codec is None:
+    return _write_tree(fp, packer, pytree)
+  encoded = _compress_ordered(_tree_arrays(pytree), codec,
+                              max_workers or _default_max_workers())
+  with contextlib.closing(encoded):
+    return _write_tree(fp, packer, pytree, encoded)
+
+
+def msgpack_restore(encoded_pytree: bytes,
+                    max_workers: Optional[int] = None,
+                    dtype: Optional[DtypePolicy] = None):
   """Restore data structure from bytes in msgpack format.
 
   Low-level function that only supports python trees with array leaves,
@@ -339,17 +1807,50 @@ def msgpack_restore(encoded_pytree: bytes):
 
   Args:
     encoded_pytree: msgpack-encoded bytes of python tree.
+    max_workers: number of threads used to decompress compressed array leaves,
+      defaults to a value based on the CPU count.
+    dtype: optional `DtypePolicy`, array leaves are converted as they are
+      decoded, so no full copy in their stored dtype is allocated.
 
   Returns:
     Python tree of dict, list, tuple with python primitive
     and array leaves.
   """
+  cast = _dtype_policy(dtype)
   state_dict = msgpack.unpackb(
-      encoded_pytree, ext_hook=_msgpack_ext_unpack, raw=False)
-  return _unchunk_array_leaves_in_place(state_dict)
+      encoded_pytree, ext_hook=_deferred_ext_unpack, raw=False)
+  state_dict = _decompress_leaves_in_place(
+      state_dict, max_workers or _default_max_workers(), cast)
+  return _unchunk_array_leaves_in_place(state_dict, cast)
 
 
-def from_bytes(target, encoded_bytes: bytes):
+def msgpack_restore_lazy(encoded_pytree,
+                         dtype: Optional[DtypePolicy] = None):
+  """Restore data structure from msgpack data with lazily read arrays.
+
+  Only the msgpack structure is decoded: array leaves are returned as
+  `LazyArray` proxies that copy their bytes out of `encoded_pytree` when
+  materialized.  Combined with a memory-mapped file this makes opening a
+  checkpoint independent of its size, and only the leaves that are actually
+  used are ever read.
+
+  Args:
+    encoded_pytree: buffer (e.g. bytes or `mmap.mmap`) or seekable binary
+      file-like object holding the msgpack-encoded python tree.  It must stay
+      valid as long as the returned lazy arrays are in use.
+    dtype: optional `DtypePolicy`, array leaves are converted while they are
+      read.
+
+  Returns:
+    Python tree of dict, list, tuple with python primitive
+    and `LazyArray` leaves.
+  """
+  state_dict = _LazyMsgpackDecoder(_as_source(encoded_pytree)).decode()
+  return _unchunk_array_leaves_in_place(state_dict, _dtype_policy(dtype))
+
+
+def from_bytes(target, encoded_bytes: bytes,
+               dtype: Optional[DtypePolicy] = None):
   """Restore optimizer or other object from msgpack-serialized state-dict.
 
   Args:
@@ -357,24 +1858,49 @@ def from_bytes(target, encoded_bytes: bytes):
       the structure being deserialized from `encoded_bytes`.
     encoded_bytes: msgpack serialized object structurally isomorphic to
       `target`.  Typically a flax model or optimizer.
+    dtype: optional `DtypePolicy` for the restored array leaves, e.g.
+      `jnp.bfloat16` or `target_dtypes(target)`.  Leaves are converted as they
+      are decoded.
 
   Returns:
     A new object structurally isomorphic to `target` containing the updated
     leaf data from saved data.
   """
-  state_dict = msgpack_restore(encoded_bytes)
+  state_dict = msgpack_restore(encoded_bytes, dtype=dtype)
   return from_state_dict(target, state_dict)
 
 
-def to_bytes(target) -> bytes:
+def to_bytes(target, codec: Optional[str] = None) -> bytes:
   """Save optimizer or other object as msgpack-serialized state-dict.
 
   Args:
     target: template object with state-dict registrations to be
       serialized to msgpack format.  Typically a flax model or optimizer.
+    codec: optional name of the codec used to compress array leaves, see
+      `msgpack_serialize`.
 
   Returns:
     Bytes of msgpack-encoded state-dict of `target` object.
   """
   state_dict = to_state_dict(target)
-  return msgpack_serialize(state_dict, in_place=True)
+  return msgpack_serialize(state_dict, in_place=True, codec=codec)
+
+
+def to_file(target, fp: BinaryIO, codec: Optional[str] = None) -> int:
+  """Save optimizer or other object as msgpack-serialized state-dict to a file.
+
+  Streaming variant of `to_bytes` that writes array leaves to `fp` as they are
+  encoded, which keeps peak host memory close to the size of `target` itself.
+
+  Args:
+    target: template object with state-dict registrations to be
+      serialized to msgpack format.  Typically a flax model or optimizer.
+    fp: writable binary file-like object.
+    codec: optional name of the codec used to compress array leaves, see
+      `msgpack_serialize`.
+
+  Returns:
+    The number of bytes written to `fp`.
+  """
+  state_dict = to_state_dict(target)
+  return msgpack_serialize_to_file(state_dict, fp, codec=codec)
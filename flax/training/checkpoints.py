@@ -19,16 +19,28 @@ other numerical metric in filename.  Cleans up older / worse-performing
 checkpoint files.
 """
 
+from concurrent import futures
 from concurrent.futures import thread
+import hashlib
+import json
+import mmap
 import os
 import re
-from typing import Any, Iterable, List, Optional, Union
+import struct
+import threading
+import zlib
+from typing import (Any, Callable, Dict, Iterable, List, Optional, Set, Tuple,
+                    Union)
 
 from absl import logging
 from flax import core
 from flax import errors
+from flax import io
 from flax import serialization
-from tensorflow.io import gfile
+from flax import traverse_util
+import jax
+from jax.experimental import multihost_utils
+import numpy as np
 
 
 # Single-group reg-exps for int or float numerical substrings.
@@ -85,7 +97,7 @@ def natural_sort(file_list: Iterable[str], signed: bool = True) -> List[str]:
 
 
 def safe_normpath(path: str) -> str:
-  """Normalizes path safely to get around `gfile.glob()` limitations."""
+  """Normalizes path safely to get around `io.glob()` limitations."""
   d = SCHEME_RE.match(path).groupdict()
   return (d['scheme'] or '') + os.path.normpath(d['path'])
 
@@ -96,7 +108,14 @@ def save_checkpoint(ckpt_dir: Union[str, os.PathLike],
                     prefix: str = 'checkpoint_',
                     keep: int = 1,
                     overwrite: bool = False,
-                    keep_every_n_steps: Optional[int] = None) -> str:
+                    keep_every_n_steps: Optional[int] = None,
+                    indexed: bool = False,
+                    dedup: bool = False,
+                    codec: Optional[str] = None,
+                    delta: bool = False,
+                    dirty_paths: Optional[serialization.PathFilter] = None,
+                    compact_every: Optional[int] = None,
+                    checksum: bool = False) -> str:
   """Save a checkpoint of the model.
 
   Attempts to be pre-emption safe by writing to temporary before
@@ -112,50 +131,242 @@ def save_checkpoint(ckpt_dir: Union[str, os.PathLike],
       at the current or a later step already exits (default: False).
     keep_every_n_steps: if defined, keep every checkpoints every n steps (in
       addition to keeping the last 'keep' checkpoints).
+    indexed: write the checkpoint in the indexed format, which supports
+      restoring a subset of the leaves by only reading their bytes (see the
+      `paths` argument of `restore_checkpoint`).
+    dedup: store every array leaf once in a content-addressed blob area of
+      `ckpt_dir` and only write a small manifest of leaf digests per
+      checkpoint. Leaves that are identical to a leaf of an earlier checkpoint,
+      e.g. frozen parameters, are not written again.
+    codec: compress the array leaves of the (default) msgpack checkpoint with
+      this codec, e.g. 'zlib' (see `serialization.msgpack_serialize`). Leaves
+      are compressed concurrently and decompressed concurrently on restore.
+    delta: save a delta checkpoint that only stores the leaves that changed
+      since the last full (base) checkpoint, together with all non-array
+      leaves such as the step. If the previous checkpoint is not part of a
+      delta chain, a new base is written. `restore_checkpoint` composes the
+      base and the delta transparently, and bases of retained deltas are not
+      removed.
+    dirty_paths: in delta mode, the leaves that changed since the base
+      checkpoint, in the format of the `paths` argument of
+      `restore_checkpoint`. Defaults to comparing content hashes of all array
+      leaves with those of the base.
+    compact_every: in delta mode, write a new base checkpoint instead of
+      another delta once this many deltas refer to the current base (default:
+      never).
+    checksum: write the CRC32 checksums of the checkpoint file to a small
+      file next to it, which `restore_checkpoint` verifies. For deduplicated
+      checkpoints only the manifest is covered.
   Returns:
     Filename of saved checkpoint.
   """
+  if codec is not None and (indexed or dedup):
+    raise ValueError('Compression is only supported for msgpack checkpoints.')
+  if delta and (indexed or dedup):
+    raise ValueError('Delta checkpoints can not be indexed or deduplicated.')
   ckpt_dir = os.fspath(ckpt_dir)  # Pathlib -> str
   # Write temporary checkpoint file.
   logging.info('Saving checkpoint at step: %s', step)
-  # normalize path because gfile.glob() can modify path './', '//' ...
+  ckpt_tmp_path, ckpt_path, checkpoint_files, info = _prepare_save(
+      ckpt_dir, step, prefix, overwrite)
+
+  # The blobs of an overwritten checkpoint may become garbage.
+  replaced = (_checkpoint_info(info, ckpt_path)
+              if overwrite and io.exists(ckpt_path) else {})
+  base, blobs = None, []
+  with io.GFile(ckpt_tmp_path, 'wb') as fp:
+    if checksum:
+      fp = _ChecksumWriter(fp)
+    if dedup:
+      blobs = _write_dedup(fp, _blob_dir(os.path.dirname(ckpt_path), prefix),
+                           target)
+    elif delta:
+      index = checkpoint_files.index(ckpt_path)
+      base = _write_delta(fp, checkpoint_files[index - 1] if index else None,
+                          target, dirty_paths, compact_every, codec)
+    elif indexed:
+      serialization.indexed_serialize_to_file(
+          serialization.to_state_dict(target), fp)
+    else:
+      serialization.to_file(target, fp, codec=codec)
+
+  # The checksums are in place before the checkpoint appears.
+  if checksum:
+    _write_checksums(ckpt_path, fp.checksums())
+  elif io.exists(_checksum_path(ckpt_path)):
+    io.remove(_checksum_path(ckpt_path))
+
+  info[os.path.basename(ckpt_path)] = {'base': base, 'blobs': blobs}
+  # The manifest lists the checkpoint before it appears, so that it is rescanned
+  # if we are preempted before the checkpoint is renamed into place.
+  _write_manifest(os.path.dirname(ckpt_path), prefix, checkpoint_files, info,
+                  keep, keep_every_n_steps)
+  # Rename once serialization and writing finished.
+  io.rename(ckpt_tmp_path, ckpt_path, overwrite=overwrite)
+  logging.info('Saved checkpoint at %s', ckpt_path)
+
+  checkpoint_files = _remove_old_checkpoints(
+      checkpoint_files, info, ckpt_path, prefix, keep, overwrite,
+      keep_every_n_steps, replaced.get('blobs', ()))
+  _write_manifest(os.path.dirname(ckpt_path), prefix, checkpoint_files, info,
+                  keep, keep_every_n_steps)
+  return ckpt_path
+
+
+def _prepare_save(ckpt_dir: str, step: int, prefix: str, overwrite: bool):
+  """Validates a new checkpoint step against the existing checkpoints.
+
+  Returns:
+    A tuple of the temporary checkpoint path, the final checkpoint path, the
+    naturally sorted checkpoint files including the new one and their info
+    from the directory manifest (see `_read_manifest`).
+  """
+  # normalize path because io.glob() can modify path './', '//' ...
   ckpt_dir = safe_normpath(ckpt_dir)
   ckpt_tmp_path = _checkpoint_path(ckpt_dir, 'tmp', prefix)
   ckpt_path = _checkpoint_path(ckpt_dir, step, prefix)
-  gfile.makedirs(os.path.dirname(ckpt_path))
-  base_path = os.path.join(ckpt_dir, prefix)
-  checkpoint_files = gfile.glob(base_path + '*')
+  io.makedirs(os.path.dirname(ckpt_path))
+  # Note: a temporary checkpoint left behind by a job that was preempted after
+  # writing but before renaming it is never listed.
+  checkpoint_files, info = _read_manifest(ckpt_dir, prefix)
 
   if ckpt_path in checkpoint_files:
     if not overwrite:
       raise errors.InvalidCheckpointError(ckpt_path, step)
   else:
-    checkpoint_files.append(ckpt_path)
+    checkpoint_files = natural_sort(checkpoint_files + [ckpt_path])
 
-  checkpoint_files = natural_sort(checkpoint_files)
-  # Handle the case if the job was preempted after the temporary checkpoint was
-  # written, but before it was renamed to the final checkpoint name
-  if checkpoint_files[-1] == ckpt_tmp_path:
-    checkpoint_files.pop(-1)
   if ckpt_path != checkpoint_files[-1]:
     if not overwrite:
       raise errors.InvalidCheckpointError(ckpt_path, step)
+  return ckpt_tmp_path, ckpt_path, checkpoint_files, info
 
-  with gfile.GFile(ckpt_tmp_path, 'wb') as fp:
-    fp.write(serialization.to_bytes(target))
 
-  # Rename once serialization and writing finished.
-  gfile.rename(ckpt_tmp_path, ckpt_path, overwrite=overwrite)
-  logging.info('Saved checkpoint at %s', ckpt_path)
+# Directory manifest
+
+# Listing a directory with thousands of checkpoints can dominate the save
+# latency on slow file systems.  Instead, every save atomically rewrites a
+# small manifest `.<prefix>manifest` in the checkpoint directory that lists the
+# existing checkpoints, naturally sorted, together with the retention settings
+# of the last save.  Temporary checkpoints are never listed.  The directory is
+# only rescanned if the manifest is missing, unreadable or stale, i.e. if its
+# latest checkpoint no longer exists.  A new checkpoint is added to the
+# manifest before it is renamed into place, so a save that is preempted in
+# between leaves a stale manifest rather than an unlisted checkpoint.
+#
+# The manifest also records the info of every checkpoint that retention needs,
+# i.e. the name of the base of a delta checkpoint and the digests of the blobs
+# of a deduplicated checkpoint, so that a save doesn't open all retained
+# checkpoints.  Checkpoints without info, e.g. after a rescan, are
+# opened once and their info is recorded by the next save.
+
+_MANIFEST_VERSION = 1
+
+
+def _manifest_path(ckpt_dir: str, prefix: str) -> str:
+  return os.path.join(ckpt_dir, f'.{prefix}manifest')
+
+
+def _scan_checkpoints(ckpt_dir: str, prefix: str) -> List[str]:
+  """Lists the checkpoint files of a directory, naturally sorted."""
+  glob_path = os.path.join(ckpt_dir, f'{prefix}*')
+  checkpoint_files = natural_sort(io.glob(glob_path))
+  ckpt_tmp_path = _checkpoint_path(ckpt_dir, 'tmp', prefix)
+  return [f for f in checkpoint_files if f != ckpt_tmp_path]
+
+
+def _read_manifest(
+    ckpt_dir: str,
+    prefix: str) -> Tuple[List[str], Dict[str, Dict[str, Any]]]:
+  """Lists the checkpoint files from the manifest, rescanning if needed.
 
+  Returns:
+    A tuple of the naturally sorted checkpoint files and a dict that maps the
+    names of checkpoints to their recorded info, which is empty after a rescan.
+  """
+  manifest_path = _manifest_path(ckpt_dir, prefix)
+  if io.exists(manifest_path):
+    with io.GFile(manifest_path, 'rb') as fp:
+      try:
+        manifest = json.loads(fp.read())
+      except ValueError:
+        manifest = {}
+    if manifest.get('version') == _MANIFEST_VERSION:
+      checkpoint_files = [os.path.join(ckpt_dir, name)
+                          for name in manifest['checkpoints']]
+      if checkpoint_files and io.exists(checkpoint_files[-1]):
+        return checkpoint_files, manifest.get('info', {})
+    logging.info('Rescanning %s, checkpoint manifest is stale.', ckpt_dir)
+  return _scan_checkpoints(ckpt_dir, prefix), {}
+
+
+def _list_checkpoints(ckpt_dir: str, prefix: str) -> List[str]:
+  """Lists the checkpoint files from the manifest, rescanning if needed."""
+  return _read_manifest(ckpt_dir, prefix)[0]
+
+
+def _write_manifest(ckpt_dir: str, prefix: str, checkpoint_files: List[str],
+                    info: Dict[str, Dict[str, Any]], keep: int,
+                    keep_every_n_steps: Optional[int]):
+  """Atomically replaces the manifest of a checkpoint directory."""
+  names = [os.path.basename(f) for f in checkpoint_files]
+  manifest = {
+      'version': _MANIFEST_VERSION,
+      'checkpoints': names,
+      'info': {name: info[name] for name in names if name in info},
+      'keep': keep,
+      'keep_every_n_steps': keep_every_n_steps,
+  }
+  manifest_path = _manifest_path(ckpt_dir, prefix)
+  with io.GFile(manifest_path + '.tmp', 'wb') as fp:
+    fp.write(json.dumps(manifest).encode('utf-8'))
+  io.rename(manifest_path + '.tmp', manifest_path, overwrite=True)
+
+
+def _remove_checkpoint(path: str):
+  """Removes a checkpoint file with its shard directory and checksums."""
+  logging.info('Removing checkpoint at %s', path)
+  shard_dir = _shard_dir(path)
+  if io.exists(shard_dir):
+    io.rmtree(shard_dir)
+  if io.exists(path):
+    io.remove(path)
+  if io.exists(_checksum_path(path)):
+    io.remove(_checksum_path(path))
+
+
+def _checkpoint_info(info: Dict[str, Dict[str, Any]], path: str):
+  """Returns the info of a checkpoint, reading and recording missing info."""
+  entry = info.setdefault(os.path.basename(path), {})
+  if 'base' not in entry:
+    base_path = _delta_base(path)
+    entry['base'] = os.path.basename(base_path) if base_path else None
+  if 'blobs' not in entry:
+    entry['blobs'] = sorted(_blob_refs(path))
+  return entry
+
+
+def _remove_old_checkpoints(checkpoint_files: List[str],
+                            info: Dict[str, Dict[str, Any]], ckpt_path: str,
+                            prefix: str, keep: int, overwrite: bool,
+                            keep_every_n_steps: Optional[int],
+                            replaced_blobs: Iterable[str] = ()) -> List[str]:
+  """Removes checkpoints newer than `ckpt_path` and exceeding `keep`.
+
+  Blobs of deduplicated checkpoints that are no longer referenced by any of
+  the remaining checkpoints are removed as well, including the
+  `replaced_blobs` of the checkpoint that was overwritten by `ckpt_path`.
+  Missing info of the retained checkpoints is recorded in `info`.
+
+  Returns:
+    The remaining checkpoint files.
+  """
+  removed = []
   # Remove newer checkpoints
   if overwrite:
     ind = checkpoint_files.index(ckpt_path) + 1
-    newer_ckpts = checkpoint_files[ind:]
+    removed.extend(checkpoint_files[ind:])
     checkpoint_files = checkpoint_files[:ind]
-    for path in newer_ckpts:
-      logging.info('Removing checkpoint at %s', path)
-      gfile.remove(path)
 
   # Remove old checkpoint files.
   last_kept = -float('inf')
@@ -171,12 +382,762 @@ def save_checkpoint(ckpt_dir: Union[str, os.PathLike],
                         path, last_kept, keep_every_n_steps)
           last_kept = step_number
           continue
-      logging.info('Removing checkpoint at %s', path)
-      gfile.remove(path)
+      removed.append(path)
+  if removed:
+    # Bases of retained delta checkpoints are retained as well.
+    bases = {_checkpoint_info(info, path)['base'] for path in checkpoint_files
+             if path not in removed}
+    removed = [path for path in removed
+               if os.path.basename(path) not in bases]
+  checkpoint_files = [f for f in checkpoint_files if f not in removed]
+
+  blob_dir = _blob_dir(os.path.dirname(ckpt_path), prefix)
+  garbage = set(replaced_blobs)
+  garbage.update(*(_checkpoint_info(info, path)['blobs'] for path in removed))
+  if garbage:
+    # Blobs are only garbage once no remaining checkpoint refers to them.
+    garbage.difference_update(*(_checkpoint_info(info, path)['blobs']
+                                for path in checkpoint_files))
+  for path in removed:
+    _remove_checkpoint(path)
+  for digest in garbage:
+    # Blobs may already be gone if an earlier save was preempted.
+    if io.exists(os.path.join(blob_dir, digest)):
+      io.remove(os.path.join(blob_dir, digest))
+  return checkpoint_files
+
+
+# Sharded checkpoints
+
+# In multi-process jobs every process writes the leaves, or slices along the
+# first axis of large leaves, that it owns into its own shard file in the
+# indexed format.  The ownership is a deterministic function of the tree
+# structure, so processes only synchronize twice: once all processes wrote
+# their shards, process 0 commits the final checkpoint file, a small manifest
+# that maps every leaf to its shard(s), and all processes return once it is
+# committed.  Every process replaces its shard of an earlier, failed attempt
+# before the first barrier, so stale shards are never committed:
+#
+#   <ckpt_dir>/checkpoint_<step>                              manifest
+#   <ckpt_dir>/.checkpoint_<step>.shards/shard-00000-of-00002
+#   <ckpt_dir>/.checkpoint_<step>.shards/shard-00001-of-00002
+
+SHARDED_MANIFEST_MAGIC = b'\xc1FLAXSHD'
+# Leaves of at least this many bytes are sliced across all processes.
+SHARD_SLICE_BYTES = 64 << 20
+
+
+def _shard_dir(ckpt_path: str) -> str:
+  head, tail = os.path.split(ckpt_path)
+  return os.path.join(head, f'.{tail}.shards')
+
 
+def _shard_path(ckpt_path: str, index: int, count: int) -> str:
+  return os.path.join(_shard_dir(ckpt_path),
+                      f'shard-{index:05d}-of-{count:05d}')
+
+
+def _sync_processes(name: str):
+  """Blocks until all processes reached the barrier `name`."""
+  if jax.process_count() > 1:
+    multihost_utils.sync_global_devices(name)
+
+
+def _shard_layout(state_dict: PyTree, process_count: int):
+  """Assigns the leaves of a state dict to processes.
+
+  Returns:
+    A list of manifest records, one per flattened leaf. Array records list
+    the `(process, start, stop)` slices along the first axis that make up the
+    leaf (`start` and `stop` are None for unsliced leaves).
+  """
+  flat = traverse_util.flatten_dict(state_dict, keep_empty_nodes=True)
+  loads = [0] * process_count
+  records = []
+  for path, leaf in flat.items():
+    if leaf is traverse_util.empty_node:
+      records.append({'path': list(path), 'value': {}})
+    elif isinstance(leaf, (np.ndarray, jax.xla.DeviceArray)):
+      shape = list(np.shape(leaf))
+      dtype = np.dtype(leaf.dtype)
+      nbytes = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+      if nbytes >= SHARD_SLICE_BYTES and shape and shape[0] >= process_count:
+        bounds = np.linspace(0, shape[0], process_count + 1).astype(int)
+        slices = [[i, int(bounds[i]), int(bounds[i + 1])]
+                  for i in range(process_count)]
+        for i in range(process_count):
+          loads[i] += nbytes // process_count
+      else:
+        owner = loads.index(min(loads))
+        loads[owner] += nbytes
+        slices = [[owner, None, None]]
+      records.append({'path': list(path), 'dtype': dtype.name,
+                      'shape': shape, 'slices': slices})
+    else:
+      records.append({'path': list(path), 'value': leaf})
+  return records
+
+
+def save_sharded_checkpoint(ckpt_dir: Union[str, os.PathLike],
+                            target: PyTree,
+                            step: int,
+                            prefix: str = 'checkpoint_',
+                            keep: int = 1,
+                            overwrite: bool = False,
+                            keep_every_n_steps: Optional[int] = None,
+                            process_index: Optional[int] = None,
+                            process_count: Optional[int] = None) -> str:
+  """Save the part of a checkpoint owned by this process.
+
+  Must be called by every process with the same (replicated) target.  Each
+  process only writes the leaves, or slices of large leaves, that it owns into
+  its own shard file, instead of every process writing the full checkpoint.
+  Once all processes wrote their shards, process 0 commits the checkpoint,
+  which makes it visible to `latest_checkpoint` and `restore_checkpoint`, and
+  all processes return once it is committed.  Sharded checkpoints can be
+  restored with any number of processes.  `restore_checkpoint` returns the full
+  state on every process, so every process reads the restored leaves from all
+  shards. Use its `paths` argument to read only some of the leaves.
+
+  Args:
+    ckpt_dir: str or pathlib-like path to store checkpoint files in.
+    target: serializable flax object, usually a flax optimizer.
+    step: int or float: training step number or other metric number.
+    prefix: str: checkpoint file name prefix.
+    keep: number of past checkpoints to keep.
+    overwrite: overwrite existing checkpoint files if a checkpoint
+      at the current or a later step already exits (default: False).
+    keep_every_n_steps: if defined, keep every checkpoints every n steps (in
+      addition to keeping the last 'keep' checkpoints).
+    process_index: index of this process, defaults to `jax.process_index()`.
+    process_count: number of processes, defaults to `jax.process_count()`.
+  Returns:
+    Filename of the checkpoint manifest.
+  """
+  if process_index is None:
+    process_index = jax.process_index()
+  if process_count is None:
+    process_count = jax.process_count()
+  ckpt_dir = os.fspath(ckpt_dir)  # Pathlib -> str
+  logging.info('Saving shard %d of %d of checkpoint at step: %s',
+               process_index, process_count, step)
+  _, ckpt_path, checkpoint_files, info = _prepare_save(
+      ckpt_dir, step, prefix, overwrite)
+  state_dict = serialization.to_state_dict(target)
+  records = _shard_layout(state_dict, process_count)
+
+  shard = {}
+  for i, record in enumerate(records):
+    for owner, start, stop in record.get('slices', ()):
+      if owner == process_index:
+        leaf = state_dict
+        for key in record['path']:
+          leaf = leaf[key]
+        shard[str(i)] = np.asarray(leaf if start is None else leaf[start:stop])
+  io.makedirs(_shard_dir(ckpt_path))
+  shard_path = _shard_path(ckpt_path, process_index, process_count)
+  with io.GFile(shard_path + '.tmp', 'wb') as fp:
+    serialization.indexed_serialize_to_file(shard, fp)
+  io.rename(shard_path + '.tmp', shard_path, overwrite=True)
+  del shard
+
+  _sync_processes(f'flax_sharded_checkpoint_shards_{ckpt_path}')
+  if process_index == 0:
+    # Shards written by an earlier attempt with another number of processes.
+    shard_paths = {_shard_path(ckpt_path, i, process_count)
+                   for i in range(process_count)}
+    for path in io.glob(os.path.join(_shard_dir(ckpt_path), '*')):
+      if path not in shard_paths:
+        io.remove(path)
+    manifest = {'version': 1, 'process_count': process_count,
+                'leaves': records}
+    manifest_tmp_path = os.path.join(_shard_dir(ckpt_path), 'manifest.tmp')
+    with io.GFile(manifest_tmp_path, 'wb') as fp:
+      fp.write(SHARDED_MANIFEST_MAGIC + serialization.msgpack_serialize(
+          manifest, in_place=True))
+    info[os.path.basename(ckpt_path)] = {'base': None, 'blobs': []}
+    _write_manifest(os.path.dirname(ckpt_path), prefix, checkpoint_files, info,
+                    keep, keep_every_n_steps)
+    io.rename(manifest_tmp_path, ckpt_path, overwrite=True)
+    logging.info('Saved sharded checkpoint at %s', ckpt_path)
+    checkpoint_files = _remove_old_checkpoints(
+        checkpoint_files, info, ckpt_path, prefix, keep, overwrite,
+        keep_every_n_steps)
+    _write_manifest(os.path.dirname(ckpt_path), prefix, checkpoint_files, info,
+                    keep, keep_every_n_steps)
+  _sync_processes(f'flax_sharded_checkpoint_commit_{ckpt_path}')
   return ckpt_path
 
 
+def _select_records(records, paths: Optional[serialization.PathFilter]):
+  """Applies a path filter to the leaf records of a checkpoint manifest.
+
+  Returns:
+    A tuple of the flat skeleton state dict, with `jax.ShapeDtypeStruct`
+    placeholders for arrays, and the set of selected flat paths.
+  """
+  skeleton = {}
+  for record in records:
+    if 'value' in record:
+      skeleton[tuple(record['path'])] = record['value']
+    else:
+      skeleton[tuple(record['path'])] = jax.ShapeDtypeStruct(
+          tuple(record['shape']), serialization._dtype_from_name(  # pylint: disable=protected-access
+              record['dtype'].encode()))
+  if paths is not None:
+    selected = serialization.select_paths(
+        traverse_util.unflatten_dict(skeleton), paths)
+    selected = set(traverse_util.flatten_dict(selected, keep_empty_nodes=True))
+  else:
+    selected = set(skeleton)
+  return skeleton, selected
+
+
+def _restore_sharded(ckpt_path: str, paths: Optional[serialization.PathFilter],
+                     dtype: Optional[serialization.DtypePolicy] = None):
+  """Restores the state dict of a sharded checkpoint.
+
+  Like for the other formats, every process restores the full (replicated)
+  state dict, so every process reads the selected leaves from the shards of all
+  processes. Only the shards that hold selected leaves are opened, and only
+  the bytes of those leaves are read from them.
+  """
+  cast = serialization._dtype_policy(dtype)  # pylint: disable=protected-access
+  with io.GFile(ckpt_path, 'rb') as fp:
+    manifest = serialization.msgpack_restore(
+        fp.read()[len(SHARDED_MANIFEST_MAGIC):])
+  records = manifest['leaves']
+  process_count = manifest['process_count']
+  skeleton, selected = _select_records(records, paths)
+
+  # Leaf ids to read from every shard, shards without any are skipped.
+  wanted = [[] for _ in range(process_count)]
+  for i, record in enumerate(records):
+    if tuple(record['path']) in selected and 'slices' in record:
+      for owner, _, _ in record['slices']:
+        wanted[owner].append((str(i),))
+
+  def read_shard(index):
+    if not wanted[index]:
+      return {}
+    with io.GFile(_shard_path(ckpt_path, index, process_count), 'rb') as fp:
+      return serialization.indexed_restore(fp, paths=wanted[index])
+
+  with thread.ThreadPoolExecutor(min(32, process_count)) as pool:
+    shards = list(pool.map(read_shard, range(process_count)))
+
+  flat = {}
+  for i, record in enumerate(records):
+    path = tuple(record['path'])
+    if path not in selected:
+      continue
+    leaf = skeleton[path]
+    if 'slices' in record:
+      new_dtype = cast(path, leaf.dtype) if cast else None
+      owner, start, _ = record['slices'][0]
+      if start is None:
+        leaf = shards[owner].pop(str(i))
+        if new_dtype is not None:
+          leaf = leaf.astype(new_dtype)
+      else:
+        # Slices are converted while they are copied into the leaf.
+        leaf = np.empty(leaf.shape, new_dtype or leaf.dtype)
+        for owner, start, stop in record['slices']:
+          leaf[start:stop] = shards[owner].pop(str(i))
+    flat[path] = leaf
+  return traverse_util.unflatten_dict(flat)
+
+
+# Deduplicated checkpoints
+
+# With `dedup=True` every array leaf is stored in a content-addressed blob area
+# under the hex SHA-256 digest of its bytes, and the checkpoint file is a small
+# manifest that maps every leaf to its blob.  Leaves that did not change since
+# an earlier checkpoint, e.g. frozen embeddings, are not written again:
+#
+#   <ckpt_dir>/checkpoint_<step>                  manifest
+#   <ckpt_dir>/.checkpoint_blobs/<sha256 digest>  raw array bytes
+#
+# Blobs are reference counted by the manifests of the retained checkpoints
+# and removed together with the last checkpoint that refers to them.
+
+DEDUP_MANIFEST_MAGIC = b'\xc1FLAXDDP'
+
+
+def _blob_dir(ckpt_dir: str, prefix: str) -> str:
+  return os.path.join(ckpt_dir, f'.{prefix}blobs')
+
+
+def _write_dedup(fp, blob_dir: str, target: PyTree) -> List[str]:
+  """Writes missing blobs and the manifest of a deduplicated checkpoint.
+
+  Returns:
+    The sorted digests of the blobs referenced by the checkpoint.
+  """
+  flat = traverse_util.flatten_dict(
+      serialization.to_state_dict(target), keep_empty_nodes=True)
+  io.makedirs(blob_dir)
+  records = []
+  num_bytes, num_written, bytes_written = 0, 0, 0
+  for path, leaf in flat.items():
+    if leaf is traverse_util.empty_node:
+      records.append({'path': list(path), 'value': {}})
+    elif isinstance(leaf, (np.ndarray, jax.xla.DeviceArray)):
+      arr = np.ascontiguousarray(np.asarray(leaf))
+      data = arr.reshape(-1).view(np.uint8)
+      digest = hashlib.sha256(data).hexdigest()
+      blob_path = os.path.join(blob_dir, digest)
+      num_bytes += data.nbytes
+      if not io.exists(blob_path):
+        with io.GFile(blob_path + '.tmp', 'wb') as blob_fp:
+          blob_fp.write(data)
+        io.rename(blob_path + '.tmp', blob_path, overwrite=True)
+        num_written += 1
+        bytes_written += data.nbytes
+      records.append({'path': list(path), 'dtype': arr.dtype.name,
+                      'shape': list(arr.shape), 'blob': digest})
+    else:
+      records.append({'path': list(path), 'value': leaf})
+  logging.info('Wrote %d new blobs (%.1f of %.1f MiB) to %s', num_written,
+               bytes_written / 2**20, num_bytes / 2**20, blob_dir)
+  manifest = {'version': 1, 'blob_dir': os.path.basename(blob_dir),
+              'leaves': records}
+  fp.write(DEDUP_MANIFEST_MAGIC + serialization.msgpack_serialize(
+      manifest, in_place=True))
+  return sorted({record['blob'] for record in records if 'blob' in record})
+
+
+def _read_dedup_manifest(ckpt_path: str):
+  """Returns the manifest of a deduplicated checkpoint or None."""
+  with io.GFile(ckpt_path, 'rb') as fp:
+    data = fp.read(len(DEDUP_MANIFEST_MAGIC))
+    if data != DEDUP_MANIFEST_MAGIC:
+      return None
+    return serialization.msgpack_restore(fp.read())
+
+
+def _blob_refs(ckpt_path: str) -> Set[str]:
+  """Returns the digests of the blobs referenced by a checkpoint."""
+  manifest = _read_dedup_manifest(ckpt_path) if io.exists(ckpt_path) else None
+  if manifest is None:
+    return set()
+  return {record['blob'] for record in manifest['leaves'] if 'blob' in record}
+
+
+def _restore_dedup(ckpt_path: str, paths: Optional[serialization.PathFilter],
+                   parallel: bool, place: Optional[Callable[[Any], Any]],
+                   dtype: Optional[serialization.DtypePolicy] = None):
+  """Restores the state dict of a deduplicated checkpoint."""
+  cast = serialization._dtype_policy(dtype)  # pylint: disable=protected-access
+  manifest = _read_dedup_manifest(ckpt_path)
+  blob_dir = os.path.join(os.path.dirname(ckpt_path), manifest['blob_dir'])
+  records = manifest['leaves']
+  skeleton, selected = _select_records(records, paths)
+  blob_records = [record for record in records
+                  if 'blob' in record and tuple(record['path']) in selected]
+
+  def read_blob(record):
+    leaf = skeleton[tuple(record['path'])]
+    with io.GFile(os.path.join(blob_dir, record['blob']), 'rb') as fp:
+      data = fp.read()
+    nbytes = int(np.prod(leaf.shape)) * leaf.dtype.itemsize
+    if len(data) != nbytes:
+      raise errors.CorruptCheckpointError(
+          ckpt_path,
+          f'blob {record["blob"]} has {len(data)} bytes, expected {nbytes}')
+    arr = np.frombuffer(data, leaf.dtype).reshape(leaf.shape)
+    new_dtype = cast(tuple(record['path']), arr.dtype) if cast else None
+    if new_dtype is not None:
+      arr = arr.astype(new_dtype)
+    return arr if place is None else _place_leaf(place, arr)
+
+  # Streaming to devices reads one leaf at a time to bound host memory.
+  max_workers = 32 if parallel and place is None else 1
+  with thread.ThreadPoolExecutor(max_workers) as pool:
+    arrays = list(pool.map(read_blob, blob_records))
+  flat = {path: skeleton[path] for path in skeleton if path in selected}
+  for record, arr in zip(blob_records, arrays):
+    flat[tuple(record['path'])] = arr
+  return traverse_util.unflatten_dict(flat)
+
+
+# Delta checkpoints
+
+# With `delta=True` a checkpoint only stores the array leaves that differ from
+# the last full (base) checkpoint, plus all non-array leaves:
+#
+#   magic (8 bytes) | header size (uint64 LE) | msgpack header | msgpack state
+#
+# The header of a base records the content digest, dtype and shape of every
+# array leaf. The header of a delta records the name of its base, its depth
+# (the number of deltas since the base, including itself) and the paths of
+# all leaves, so leaves that were removed from the tree are not restored.
+
+DELTA_MAGIC = b'\xc1FLAXDLT'
+
+
+def _array_digest(arr: np.ndarray) -> str:
+  """Returns the hex SHA-256 digest of the C-ordered bytes of an array."""
+  data = np.ascontiguousarray(arr).reshape(-1).view(np.uint8)
+  return hashlib.sha256(data).hexdigest()
+
+
+def _read_delta_header(ckpt_path: str):
+  """Returns the header of a delta or base checkpoint, or None."""
+  if not io.exists(ckpt_path):
+    return None
+  with io.GFile(ckpt_path, 'rb') as fp:
+    prefix = fp.read(len(DELTA_MAGIC) + 8)
+    if prefix[:len(DELTA_MAGIC)] != DELTA_MAGIC:
+      return None
+    header_size, = struct.unpack('<Q', prefix[len(DELTA_MAGIC):])
+    return serialization.msgpack_restore(fp.read(header_size))
+
+
+def _delta_base(ckpt_path: str) -> Optional[str]:
+  """Returns the path of the base of a delta checkpoint, or None."""
+  header = _read_delta_header(ckpt_path)
+  if header is None or header['base'] is None:
+    return None
+  return os.path.join(os.path.dirname(ckpt_path), header['base'])
+
+
+def _write_delta(fp, prev_path: Optional[str], target: PyTree,
+                 dirty_paths: Optional[serialization.PathFilter],
+                 compact_every: Optional[int],
+                 codec: Optional[str]) -> Optional[str]:
+  """Writes a delta checkpoint against the base of `prev_path`, or a base.
+
+  Returns:
+    The name of the base of the delta, or None if a base was written.
+  """
+  state_dict = serialization.to_state_dict(target)
+  flat = traverse_util.flatten_dict(state_dict, keep_empty_nodes=True)
+  prev = _read_delta_header(prev_path) if prev_path else None
+  base_path, base = None, None
+  if prev is not None and prev['base'] is None:
+    base_path, base, depth = prev_path, prev, 1
+  elif prev is not None:
+    base_path = os.path.join(os.path.dirname(prev_path), prev['base'])
+    base, depth = _read_delta_header(base_path), prev['depth'] + 1
+  if base is None or (compact_every is not None and depth > compact_every):
+    digests = []
+    for path, leaf in flat.items():
+      if isinstance(leaf, (np.ndarray, jax.xla.DeviceArray)):
+        arr = np.asarray(leaf)
+        digests.append([list(path), _array_digest(arr), arr.dtype.name,
+                        list(arr.shape)])
+    header = {'version': 1, 'base': None, 'depth': 0, 'digests': digests}
+    delta_state = state_dict
+    logging.info('Writing base checkpoint for deltas.')
+  else:
+    base_digests = {tuple(path): (digest, dtype, tuple(shape))
+                    for path, digest, dtype, shape in base['digests']}
+    if dirty_paths is not None:
+      dirty = set(traverse_util.flatten_dict(
+          serialization.select_paths(state_dict, dirty_paths),
+          keep_empty_nodes=True))
+    changed = {}
+    for path, leaf in flat.items():
+      if (not isinstance(leaf, (np.ndarray, jax.xla.DeviceArray)) or
+          path not in base_digests):
+        changed[path] = leaf
+      elif dirty_paths is not None:
+        if path in dirty:
+          changed[path] = leaf
+      else:
+        arr = np.asarray(leaf)
+        if base_digests[path] != (_array_digest(arr), arr.dtype.name,
+                                  arr.shape):
+          changed[path] = leaf
+    header = {'version': 1, 'base': os.path.basename(base_path),
+              'depth': depth, 'paths': [list(path) for path in flat]}
+    delta_state = traverse_util.unflatten_dict(changed)
+    logging.info('Writing delta %d against %s with %d of %d leaves.', depth,
+                 base_path, len(changed), len(flat))
+  encoded = serialization.msgpack_serialize(header, in_place=True)
+  fp.write(DELTA_MAGIC + struct.pack('<Q', len(encoded)) + encoded)
+  serialization.msgpack_serialize_to_file(delta_state, fp, codec=codec)
+  return header['base']
+
+
+def _read_delta_state(ckpt_path: str,
+                      dtype: Optional[serialization.DtypePolicy] = None):
+  """Returns the header and the stored state dict of a delta checkpoint."""
+  with io.GFile(ckpt_path, 'rb') as fp:
+    prefix = fp.read(len(DELTA_MAGIC) + 8)
+    header_size, = struct.unpack('<Q', prefix[len(DELTA_MAGIC):])
+    header = serialization.msgpack_restore(fp.read(header_size))
+    return header, serialization.msgpack_restore(fp.read(), dtype=dtype)
+
+
+def _restore_delta(ckpt_path: str,
+                   dtype: Optional[serialization.DtypePolicy] = None) -> PyTree:
+  """Restores the state dict of a delta checkpoint composed with its base."""
+  header, state_dict = _read_delta_state(ckpt_path, dtype)
+  if header['base'] is None:
+    return state_dict
+  base_path = os.path.join(os.path.dirname(ckpt_path), header['base'])
+  _, base_state = _read_delta_state(base_path, dtype)
+  base_flat = traverse_util.flatten_dict(base_state, keep_empty_nodes=True)
+  del base_state
+  flat = traverse_util.flatten_dict(state_dict, keep_empty_nodes=True)
+  for path in map(tuple, header['paths']):
+    if path not in flat:
+      flat[path] = base_flat[path]
+  return traverse_util.unflatten_dict(flat)
+
+
+# Checksums
+
+# With `checksum=True` a small JSON file `.<name>.crc32` is written next to the
+# checkpoint before the checkpoint is renamed into place.  It records the size
+# of the checkpoint file and the CRC32 of every block of
+# `_CHECKSUM_BLOCK_SIZE` bytes, which are computed while the checkpoint is
+# written.  On restore a truncated file is detected before it is parsed, and
+# the blocks are verified by a thread pool concurrently with the restore.
+
+_CHECKSUM_VERSION = 1
+_CHECKSUM_BLOCK_SIZE = 8 << 20
+
+
+def _checksum_path(ckpt_path: str) -> str:
+  head, tail = os.path.split(ckpt_path)
+  return os.path.join(head, f'.{tail}.crc32')
+
+
+class _ChecksumWriter:
+  """Wraps a file and computes the block checksums of the written bytes."""
+
+  def __init__(self, fp, block_size: int = _CHECKSUM_BLOCK_SIZE):
+    self._fp = fp
+    self._block_size = block_size
+    self._crc = 0
+    self._filled = 0
+    self.size = 0
+    self.crcs = []
+
+  def write(self, data):
+    result = self._fp.write(data)
+    view = memoryview(data)
+    if not view.c_contiguous:
+      view = memoryview(view.tobytes())
+    view = view.cast('B')
+    self.size += view.nbytes
+    while view.nbytes:
+      n = min(view.nbytes, self._block_size - self._filled)
+      self._crc = zlib.crc32(view[:n], self._crc)
+      self._filled += n
+      view = view[n:]
+      if self._filled == self._block_size:
+        self.crcs.append(self._crc)
+        self._crc, self._filled = 0, 0
+    return result
+
+  def checksums(self):
+    crcs = self.crcs + ([self._crc] if self._filled else [])
+    return {'version': _CHECKSUM_VERSION, 'size': self.size,
+            'block_size': self._block_size, 'crc32': crcs}
+
+
+def _write_checksums(ckpt_path: str, checksums):
+  with io.GFile(_checksum_path(ckpt_path), 'wb') as fp:
+    fp.write(json.dumps(checksums).encode('utf-8'))
+
+
+def _read_checksums(ckpt_path: str):
+  """Returns the checksums of a checkpoint, or None if it has none."""
+  checksum_path = _checksum_path(ckpt_path)
+  if not io.exists(checksum_path):
+    return None
+  with io.GFile(checksum_path, 'rb') as fp:
+    try:
+      checksums = json.loads(fp.read())
+    except ValueError as e:
+      raise errors.CorruptCheckpointError(
+          ckpt_path, 'its checksum file is unreadable') from e
+  if checksums.get('version') != _CHECKSUM_VERSION:
+    logging.warning('Not verifying %s, unknown checksum version.', ckpt_path)
+    return None
+  return checksums
+
+
+def _verify_checksums(ckpt_path: str, checksums,
+                      pool: futures.Executor) -> List[futures.Future]:
+  """Checks the file size and submits the verification of every block.
+
+  Returns:
+    Futures that raise `CorruptCheckpointError` for corrupt blocks.
+  """
+  size = io.getsize(ckpt_path)
+  if size != checksums['size']:
+    raise errors.CorruptCheckpointError(
+        ckpt_path, f'it has {size} bytes, expected {checksums["size"]}')
+  block_size = checksums['block_size']
+
+  def verify(index, crc):
+    with io.GFile(ckpt_path, 'rb') as fp:
+      fp.seek(index * block_size)
+      if zlib.crc32(fp.read(block_size)) != crc:
+        raise errors.CorruptCheckpointError(
+            ckpt_path, f'checksum mismatch at byte {index * block_size}')
+
+  return [pool.submit(verify, index, crc)
+          for index, crc in enumerate(checksums['crc32'])]
+
+
+# Streaming restore to devices
+
+def _placement_fn(placement) -> Optional[Callable[[Any], Any]]:
+  """Returns a function that transfers a host array according to `placement`."""
+  if placement is None or callable(placement):
+    return placement
+  if isinstance(placement, (list, tuple)):
+    devices = list(placement)
+    return lambda x: jax.device_put_replicated(x, devices)
+  return lambda x: jax.device_put(x, placement)
+
+
+def _place_leaf(place: Callable[[Any], Any], leaf):
+  """Reads a leaf, transfers it and waits so its host buffer can be freed."""
+  placed = place(np.asarray(leaf))
+  for x in jax.tree_util.tree_leaves(placed):
+    x.block_until_ready()
+  return placed
+
+
+def _place_leaves(state_dict: PyTree, place: Callable[[Any], Any]) -> PyTree:
+  """Transfers the array leaves of a (lazy) state dict one at a time."""
+  flat = traverse_util.flatten_dict(state_dict, keep_empty_nodes=True)
+  for path, leaf in flat.items():
+    if isinstance(leaf, (serialization.LazyArray, np.ndarray, np.generic)):
+      flat[path] = _place_leaf(place, leaf)
+  return traverse_util.unflatten_dict(flat)
+
+
+def _host_snapshot(target: PyTree) -> PyTree:
+  """Returns a host copy of the state dict of `target`."""
+  state_dict = serialization.to_state_dict(target)
+  # Copy numpy leaves so that the caller may keep updating them in place.
+  state_dict = jax.tree_map(
+      lambda x: np.array(x) if isinstance(x, np.ndarray) else x, state_dict)
+  return jax.device_get(state_dict)
+
+
+class AsyncCheckpointer:
+  """Saves checkpoints in a background thread.
+
+  `save_checkpoint` takes a host snapshot of the target and returns
+  immediately, while serialization, the write to a temporary file, the final
+  rename and the removal of old checkpoints happen in a background worker.
+  Saves are executed one at a time in submission order, so concurrent saves
+  never observe a partially updated checkpoint directory.
+
+  Example::
+
+    with checkpoints.AsyncCheckpointer() as checkpointer:
+      for step in range(num_steps):
+        state = train_step(state, batch)
+        if step % save_every == 0:
+          checkpointer.save_checkpoint(ckpt_dir, state, step, keep=3)
+
+  Leaving the ``with`` block waits for the pending saves and stops the
+  background worker, like `close`.
+
+  Note that `restore_checkpoint` and `latest_checkpoint` only see a checkpoint
+  once its save has finished. Once a save failed, the following delta saves
+  fail as well until a save with ``delta=False`` succeeded, because the
+  checkpoint they would refer to, or the leaves changed since it, are
+  missing.
+  """
+
+  def __init__(self):
+    self._executor = thread.ThreadPoolExecutor(
+        max_workers=1, thread_name_prefix='flax_checkpoint')
+    self._lock = threading.Lock()
+    self._pending = []
+    # The error of the last failed save, reset by a successful full save.
+    # Only accessed by the worker.
+    self._error = None
+
+  def __enter__(self) -> 'AsyncCheckpointer':
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def _save(self, *args, delta: bool, **kwargs) -> str:
+    """Saves a checkpoint in the worker."""
+    if delta and self._error is not None:
+      raise ValueError('Can not save a delta checkpoint after a failed save, '
+                       'save a full checkpoint first.') from self._error
+    try:
+      filename = save_checkpoint(*args, delta=delta, **kwargs)
+    except BaseException as e:
+      self._error = e
+      raise
+    if not delta:
+      self._error = None
+    return filename
+
+  def save_checkpoint(self,
+                      ckpt_dir: Union[str, os.PathLike],
+                      target: PyTree,
+                      step: int,
+                      prefix: str = 'checkpoint_',
+                      keep: int = 1,
+                      overwrite: bool = False,
+                      keep_every_n_steps: Optional[int] = None,
+                      indexed: bool = False,
+                      dedup: bool = False,
+                      codec: Optional[str] = None,
+                      delta: bool = False,
+                      dirty_paths: Optional[serialization.PathFilter] = None,
+                      compact_every: Optional[int] = None,
+                      checksum: bool = False) -> futures.Future:
+    """Asynchronously saves a checkpoint, see `save_checkpoint` for the args.
+
+    Returns:
+      A future that resolves to the filename of the saved checkpoint, or
+      raises the error that occurred while saving.
+    """
+    snapshot = _host_snapshot(target)
+    future = self._executor.submit(
+        self._save, ckpt_dir, snapshot, step, prefix=prefix, keep=keep,
+        overwrite=overwrite, keep_every_n_steps=keep_every_n_steps,
+        indexed=indexed, dedup=dedup, codec=codec, delta=delta,
+        dirty_paths=dirty_paths, compact_every=compact_every,
+        checksum=checksum)
+    with self._lock:
+      # Keep failed saves around so `wait_until_finished` can report them.
+      self._pending = [f for f in self._pending
+                       if not f.done() or f.exception() is not None]
+      self._pending.append(future)
+    return future
+
+  def wait_until_finished(self):
+    """Blocks until all submitted saves finished.
+
+    Raises:
+      The first error raised by any of the pending saves.
+    """
+    with self._lock:
+      pending, self._pending = self._pending, []
+    for future in pending:
+      future.result()
+
+  def close(self):
+    """Waits for all submitted saves and stops the background worker.
+
+    Raises:
+      The first error raised by any of the pending saves.
+    """
+    try:
+      self.wait_until_finished()
+    finally:
+      self._executor.shutdown()
+
+
 def latest_checkpoint(ckpt_dir: Union[str, os.PathLike],
                       prefix: str = 'checkpoint_') -> Optional[str]:
   """Retrieve the path of the latest checkpoint in a directory.
@@ -189,21 +1150,25 @@ def latest_checkpoint(ckpt_dir: Union[str, os.PathLike],
     The latest checkpoint path or None if no checkpoints were found.
   """
   ckpt_dir = os.fspath(ckpt_dir)  # Pathlib -> str
-  glob_path = os.path.join(ckpt_dir, f'{prefix}*')
-  checkpoint_files = natural_sort(gfile.glob(glob_path))
-  ckpt_tmp_path = _checkpoint_path(ckpt_dir, 'tmp', prefix)
-  checkpoint_files = [f for f in checkpoint_files if f != ckpt_tmp_path]
+  checkpoint_files = _list_checkpoints(ckpt_dir, prefix)
   if checkpoint_files:
     return checkpoint_files[-1]
   else:
     return None
 
 
-def restore_checkpoint(ckpt_dir: Union[str, os.PathLike],
-                       target: Optional[PyTree],
-                       step: Optional[int] = None,
-                       prefix: str = 'checkpoint_',
-                       parallel: bool = True) -> PyTree:
+def restore_checkpoint(
+    ckpt_dir: Union[str, os.PathLike],
+    target: Optional[PyTree],
+    step: Optional[int] = None,
+    prefix: str = 'checkpoint_',
+    parallel: bool = True,
+    lazy: bool = False,
+    paths: Optional[serialization.PathFilter] = None,
+    placement: Any = None,
+    dtype: Optional[serialization.DtypePolicy] = None,
+    verify: Optional[bool] = None,
+    fallback: bool = False) -> PyTree:
   """Restore last/best checkpoint from checkpoints in path.
 
   Sorts the checkpoint files naturally, returning the highest-valued
@@ -222,7 +1187,41 @@ def restore_checkpoint(ckpt_dir: Union[str, os.PathLike],
     step: int: step number to load or None to load latest. If specified,
       ckpt_dir must be a directory.
     prefix: str: name prefix of checkpoint files.
-    parallel: bool: whether to load seekable checkpoints in parallel, for speed.
+    parallel: bool: whether to read array leaves with multiple threads, for
+      speed.
+    lazy: bool: memory-map the checkpoint file and only read the array leaves
+      that are restored into `target`. If `target` is None, the returned
+      state-dict has `serialization.LazyArray` leaves that are read on access.
+      Only supported for checkpoints on the local filesystem. Sharded,
+      deduplicated and delta checkpoints are always restored eagerly.
+    paths: only restore the selected leaves, given as a filter function in the
+      style of `traverse_util.ModelParamTraversal` (called with paths like
+      '/params/Dense_0/kernel' relative to the state-dict root and the lazy
+      leaf) or as a list of `traverse_util.flatten_dict` keys, which also
+      select all leaves below them. The remaining leaves of `target` are left
+      unchanged, or dropped if `target` is None. For checkpoints saved with
+      `indexed=True` only the bytes of the selected leaves are read.
+    placement: stream the array leaves to devices instead of returning host
+      arrays. Either a device (`jax.device_put`), a list of devices to
+      replicate every leaf to (like `jax_utils.replicate`) or a function that
+      transfers a host array, e.g. with a custom sharding. Every leaf is read,
+      transferred and released before the next one is read, so the peak host
+      memory is bounded by the largest leaf instead of the whole checkpoint
+      (sharded checkpoints are transferred after the restore).
+    dtype: convert the restored array leaves, either to a dtype (e.g.
+      `jnp.bfloat16`) that all floating point leaves are converted to, or per
+      leaf with a function `(path, dtype) -> dtype` such as
+      `serialization.target_dtypes(target)`. Leaves are converted as they are
+      read, so no full copy in the stored dtype is allocated (except for
+      sharded checkpoints, which convert every leaf after reading it).
+    verify: verify checkpoints saved with `checksum=True` against their
+      checksums and raise `errors.CorruptCheckpointError` if they don't match.
+      The size is checked before parsing and the blocks of the file are
+      verified concurrently with the restore. Defaults to verifying unless
+      `lazy` is set, as verification reads the whole file.
+    fallback: if the latest checkpoint in `ckpt_dir` is corrupt, restore the
+      most recent earlier checkpoint that is intact instead. Only applies if
+      `step` is None and `ckpt_dir` is a directory.
 
   Returns:
     Restored `target` updated from checkpoint file, or if no step specified and
@@ -235,13 +1234,13 @@ def restore_checkpoint(ckpt_dir: Union[str, os.PathLike],
   ckpt_dir = safe_normpath(ckpt_dir)
   if step is not None:
     ckpt_path = _checkpoint_path(ckpt_dir, step, prefix)
-    if not gfile.exists(ckpt_path):
+    if not io.exists(ckpt_path):
       raise ValueError(f'Matching checkpoint not found: {ckpt_path}')
   else:
-    if not gfile.exists(ckpt_dir):
+    if not io.exists(ckpt_dir):
       logging.info('Found no checkpoint at %s', ckpt_dir)
       return target
-    if not gfile.isdir(ckpt_dir):
+    if not io.isdir(ckpt_dir):
       ckpt_path = ckpt_dir
     else:
       ckpt_path = latest_checkpoint(ckpt_dir, prefix)
@@ -249,38 +1248,152 @@ def restore_checkpoint(ckpt_dir: Union[str, os.PathLike],
         logging.info('Found no checkpoint files in %s', ckpt_dir)
         return target
 
+  if verify is None:
+    verify = not lazy
+  fallback = fallback and step is None and ckpt_path != ckpt_dir
+  while True:
+    try:
+      return _restore_checkpoint_file(ckpt_path, target, parallel, lazy, paths,
+                                      placement, dtype, verify)
+    except errors.CorruptCheckpointError as e:
+      if not fallback:
+        raise
+      checkpoint_files = _list_checkpoints(ckpt_dir, prefix)
+      if ckpt_path not in checkpoint_files or ckpt_path == checkpoint_files[0]:
+        raise
+      previous = checkpoint_files[checkpoint_files.index(ckpt_path) - 1]
+      logging.warning('%s Falling back to %s.', e, previous)
+      ckpt_path = previous
+
+
+# msgpack checkpoints up to this size are read at once and decoded by
+# `serialization.msgpack_restore` instead of being read leaf by leaf.
+_SMALL_CHECKPOINT_BYTES = 64 << 20
+
+# Number of threads verifying the checksums of a checkpoint.
+_VERIFY_THREADS = 4
+
+
+def _restore_checkpoint_file(ckpt_path: str, target: Optional[PyTree],
+                             parallel: bool, lazy: bool,
+                             paths: Optional[serialization.PathFilter],
+                             placement: Any,
+                             dtype: Optional[serialization.DtypePolicy],
+                             verify: bool) -> PyTree:
+  """Restores a checkpoint file, verifying its checksums if `verify`."""
   logging.info('Restoring checkpoint from %s', ckpt_path)
-  with gfile.GFile(ckpt_path, 'rb') as fp:
-    if parallel and fp.seekable():
-      buf_size = 128 << 20  # 128M buffer.
-      num_bufs = fp.size() / buf_size
-      logging.debug('num_bufs: %d', num_bufs)
-      checkpoint_contents = bytearray(fp.size())
-
-      def read_chunk(i):
-        # NOTE: We have to re-open the file to read each chunk, otherwise the
-        # parallelism has no effect. But we could reuse the file pointers
-        # within each thread.
-        with gfile.GFile(ckpt_path, 'rb') as f:
-          f.seek(i * buf_size)
-          buf = f.read(buf_size)
-          if buf:
-            checkpoint_contents[i * buf_size:i * buf_size + len(buf)] = buf
-          return len(buf) / buf_size
-
-      pool_size = 32
-      pool = thread.ThreadPoolExecutor(pool_size)
-      results = pool.map(read_chunk, range(int(num_bufs) + 1))
-      results = list(results)
-      pool.shutdown(wait=False)
-      logging.debug('results: %s', results)
+  checksums = _read_checksums(ckpt_path) if verify else None
+  if checksums is None:
+    return _read_checkpoint(ckpt_path, target, parallel, lazy, paths,
+                            placement, dtype)
+  with thread.ThreadPoolExecutor(_VERIFY_THREADS) as pool:
+    verification = _verify_checksums(ckpt_path, checksums, pool)
+    base_path = None
+    with io.GFile(ckpt_path, 'rb') as fp:
+      if fp.read(len(DELTA_MAGIC)) == DELTA_MAGIC:
+        base_path = _delta_base(ckpt_path)
+    base_checksums = _read_checksums(base_path) if base_path else None
+    if base_checksums is not None:
+      verification += _verify_checksums(base_path, base_checksums, pool)
+    try:
+      return _read_checkpoint(ckpt_path, target, parallel, lazy, paths,
+                              placement, dtype)
+    finally:
+      # A corrupt checkpoint is reported instead of any error of the restore.
+      for future in verification:
+        future.result()
+
+
+def _read_checkpoint(ckpt_path: str, target: Optional[PyTree], parallel: bool,
+                     lazy: bool, paths: Optional[serialization.PathFilter],
+                     placement: Any,
+                     dtype: Optional[serialization.DtypePolicy]) -> PyTree:
+  """Restores a checkpoint file in any of the checkpoint formats."""
+  with io.GFile(ckpt_path, 'rb') as fp:
+    magic = fp.read(len(SHARDED_MANIFEST_MAGIC))
+  place = _placement_fn(placement)
+  if magic == SHARDED_MANIFEST_MAGIC:
+    state_dict = _restore_sharded(ckpt_path, paths, dtype)
+    if place is not None:
+      state_dict = _place_leaves(state_dict, place)
+    return _restore_target(target, state_dict, partial=paths is not None)
+  if magic == DEDUP_MANIFEST_MAGIC:
+    state_dict = _restore_dedup(ckpt_path, paths, parallel, place, dtype)
+    return _restore_target(target, state_dict, partial=paths is not None)
+  if magic == DELTA_MAGIC:
+    state_dict = _restore_delta(ckpt_path, dtype)
+    if paths is not None:
+      state_dict = serialization.select_paths(state_dict, paths)
+    if place is not None:
+      state_dict = _place_leaves(state_dict, place)
+    return _restore_target(target, state_dict, partial=paths is not None)
+
+  if lazy:
+    if not io.is_local(ckpt_path):
+      raise ValueError('Lazy restore requires a checkpoint on the local '
+                       f'filesystem, got: {ckpt_path}')
+    with open(ckpt_path, 'rb') as fp:
+      # The mapping stays valid after the file is closed.
+      checkpoint_contents = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    if serialization.is_indexed_format(checkpoint_contents):
+      state_dict = serialization.indexed_restore(
+          checkpoint_contents, paths, lazy=True, dtype=dtype)
     else:
-      checkpoint_contents = fp.read()
+      state_dict = serialization.msgpack_restore_lazy(checkpoint_contents,
+                                                      dtype=dtype)
+      if paths is not None:
+        state_dict = serialization.select_paths(state_dict, paths)
+    if place is not None:
+      state_dict = _place_leaves(state_dict, place)
+    return _restore_target(target, state_dict, partial=paths is not None)
 
-    if target is None:
-      return serialization.msgpack_restore(checkpoint_contents)
+  if (not serialization.is_indexed_format(magic)
+      and io.getsize(ckpt_path) <= _SMALL_CHECKPOINT_BYTES):
+    # Small checkpoints, e.g. of many small leaves, are decoded faster in one
+    # pass by the msgpack C extension than leaf by leaf.
+    with io.GFile(ckpt_path, 'rb') as fp:
+      state_dict = serialization.msgpack_restore(
+          fp.read(), max_workers=None if parallel else 1, dtype=dtype)
+    if paths is not None:
+      state_dict = serialization.select_paths(state_dict, paths)
+    if place is not None:
+      state_dict = _place_leaves(state_dict, place)
+    return _restore_target(target, state_dict, partial=paths is not None)
+
+  with io.GFile(ckpt_path, 'rb') as fp:
+    if serialization.is_indexed_format(magic):
+      state_dict = serialization.indexed_restore(fp, paths, lazy=True,
+                                                 dtype=dtype)
     else:
-      return serialization.from_bytes(target, checkpoint_contents)
+      state_dict = serialization.msgpack_restore_lazy(fp, dtype=dtype)
+      if paths is not None:
+        state_dict = serialization.select_paths(state_dict, paths)
+    if place is not None:
+      state_dict = _place_leaves(state_dict, place)
+      return _restore_target(target, state_dict, partial=paths is not None)
+    # Array leaves are read straight into their final buffers.
+    state_dict, stats = serialization.materialize_parallel(
+        state_dict, open_file=lambda: io.GFile(ckpt_path, 'rb'),
+        max_workers=None if parallel else 1)
+  logging.info('Read %.1f MiB in %.2f s (%.1f MiB/s) with %d threads.',
+               stats.num_bytes / 2**20, stats.seconds,
+               stats.bandwidth / 2**20, stats.num_threads)
+  return _restore_target(target, state_dict, partial=paths is not None)
+
+
+def _restore_target(target: Optional[PyTree], state_dict: PyTree,
+                    partial: bool) -> PyTree:
+  """Restores `target` from a (possibly lazy and partial) state dict."""
+  if target is None:
+    return state_dict
+  if partial:
+    # Restored leaves replace the corresponding leaves of the target state.
+    flat_state = traverse_util.flatten_dict(
+        serialization.to_state_dict(target), keep_empty_nodes=True)
+    flat_state.update(
+        traverse_util.flatten_dict(state_dict, keep_empty_nodes=True))
+    state_dict = traverse_util.unflatten_dict(flat_state)
+  return serialization.from_state_dict(target, state_dict)
 
 
 def convert_pre_linen(params: PyTree) -> PyTree:
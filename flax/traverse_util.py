@@ -41,12 +41,17 @@ returns a copy of the data including the provided updates.
 """
 
 import abc
+import bisect
 import copy
 import dataclasses
+import functools
+import re
+from typing import Any, Dict, Optional, Sequence, Tuple
 
 import jax
 import flax
 
+from . import serialization
 from . import struct
 
 
@@ -58,6 +63,201 @@ class _EmptyNode:
 empty_node = _EmptyNode()
 
 
+class PathIndex:
+  """Index of the flat paths of a nested dictionary.
+
+  A `PathIndex` is computed once per tree structure (see `path_index`) and maps
+  the flat paths produced by `flatten_dict` to the positions of the leaves in
+  `jax.tree_util.tree_leaves`, so that flattening and unflattening a dictionary
+  with this structure reduces to indexing a list of leaves::
+
+    index = traverse_util.path_index(params)
+    leaves = jax.tree_util.tree_leaves(params)
+    kernels = [leaves[i] for i in index.match(r'/kernel$')]
+
+  Paths are ordered like the leaves, i.e. with the keys of every dictionary
+  sorted, so all the paths sharing a prefix are contiguous.
+
+  Attributes:
+    treedef: the tree structure of the indexed dictionary.
+    paths: the flat paths of the leaves, in leaf order.
+    empty_paths: the flat paths of the empty dictionaries.
+  """
+
+  def __init__(self, treedef, paths, items):
+    self.treedef = treedef
+    self.paths: Tuple[Tuple[Any, ...], ...] = paths
+    # `(path, position)` of all leaves and empty dictionaries in depth first
+    # order, the position of empty dictionaries is `len(paths)`.
+    self._items = items
+    self.empty_paths = tuple(path for path, i in items if i == len(paths))
+    self.positions: Dict[Tuple[Any, ...], int] = {
+        path: i for i, path in enumerate(paths)}
+    self._names = None
+    self._keys = {}
+    self._matches = {}
+
+  def __len__(self):
+    return len(self.paths)
+
+  def _flat_keys(self, keep_empty_nodes, sep):
+    cache_key = (keep_empty_nodes, sep)
+    if cache_key not in self._keys:
+      if keep_empty_nodes and self.empty_paths:
+        paths = tuple(path for path, _ in self._items)
+      else:
+        paths = self.paths
+      if sep is not None:
+        paths = tuple(sep.join(path) for path in paths)
+      self._keys[cache_key] = paths
+    return self._keys[cache_key]
+
+  def flatten(self, leaves: Sequence[Any], keep_empty_nodes: bool = False,
+              sep: Optional[str] = None) -> Dict[Any, Any]:
+    """Returns the flat dictionary of the leaves, with keys in leaf order."""
+    keys = self._flat_keys(keep_empty_nodes, sep)
+    if len(keys) == len(leaves):
+      return dict(zip(keys, leaves))
+    leaves = list(leaves) + [empty_node]
+    return {key: leaves[i] for key, (_, i) in zip(keys, self._items)}
+
+  def unflatten(self, leaves: Sequence[Any]) -> Any:
+    """Rebuilds the indexed dictionary from its leaves."""
+    return jax.tree_util.tree_unflatten(self.treedef, leaves)
+
+  def prefix(self, prefix: Tuple[Any, ...]) -> range:
+    """Returns the positions of the leaves whose path starts with `prefix`."""
+    prefix = tuple(prefix)
+    start = bisect.bisect_left(self.paths, prefix)
+    stop = start
+    while (stop < len(self.paths) and
+           self.paths[stop][:len(prefix)] == prefix):
+      stop += 1
+    return range(start, stop)
+
+  def match(self, pattern) -> Tuple[int, ...]:
+    """Returns the positions of the leaves whose name matches `pattern`.
+
+    Args:
+      pattern: a regular expression that is searched for in the names of the
+        leaves. Like in `ModelParamTraversal`, the name of a leaf is its
+        '/'-joined path with a leading '/', e.g. '/encoder/dense/kernel'.
+    Returns:
+      The matching positions in increasing order. The result is cached per
+      pattern.
+    """
+    if pattern not in self._matches:
+      if self._names is None:
+        self._names = ['/' + '/'.join(map(str, path)) for path in self.paths]
+      search = re.compile(pattern).search
+      self._matches[pattern] = tuple(
+          i for i, name in enumerate(self._names) if search(name))
+    return self._matches[pattern]
+
+
+def _is_dict(xs):
+  return isinstance(xs, (flax.core.FrozenDict, dict))
+
+
+@functools.lru_cache(maxsize=256)
+def _treedef_path_index(treedef) -> Optional[PathIndex]:
+  """Returns the `PathIndex` of a treedef, None if it is not a nested dict."""
+  try:
+    skeleton = jax.tree_util.tree_unflatten(
+        treedef, range(treedef.num_leaves))
+  except Exception:  # pylint: disable=broad-except
+    return None
+  if not _is_dict(skeleton):
+    return None
+  paths = []
+  items = []
+  num_leaves = treedef.num_leaves
+
+  def visit(node, prefix):
+    if _is_dict(node):
+      if not node:
+        items.append((prefix, num_leaves))
+        return True
+      return all(visit(value, prefix + (key,)) for key, value in node.items())
+    # Other pytree nodes and None, which `flatten_dict` treats as leaves, are
+    # not supported.
+    if type(node) is not int or node != len(paths):  # pylint: disable=unidiomatic-typecheck
+      return False
+    items.append((prefix, node))
+    paths.append(prefix)
+    return True
+
+  if not visit(skeleton, ()):
+    return None
+  return PathIndex(treedef, tuple(paths), tuple(items))
+
+
+def _flatten_with_index(xs):
+  """Returns the leaves and `PathIndex` of `xs`, or None if not supported."""
+  try:
+    leaves, treedef = jax.tree_util.tree_flatten(xs)
+    index = _treedef_path_index(treedef)
+  except (TypeError, ValueError):
+    # Unsortable keys or unhashable pytree node data.
+    return None, None
+  return leaves, index
+
+
+@functools.lru_cache(maxsize=256)
+def _flat_layout(treedef, key_order, keep_empty_nodes, sep):
+  """Returns the keys of `flatten_dict` and the positions of their values.
+
+  Args:
+    treedef: the tree structure of a nested dictionary with a `PathIndex`.
+    key_order: the keys of every dict of the dictionary in pre-order.
+    keep_empty_nodes: see `flatten_dict`.
+    sep: see `flatten_dict`.
+  Returns:
+    The flat keys in the depth first order of the dictionary and the
+    positions of their values in its leaves, where empty dictionaries are at
+    position `treedef.num_leaves`.
+  """
+  unsorted = tuple((i, keys) for i, keys in enumerate(key_order)
+                   if keys != tuple(sorted(keys)))
+  skeleton = serialization._restore_key_order(  # pylint: disable=protected-access
+      jax.tree_util.tree_unflatten(treedef, range(treedef.num_leaves)),
+      unsorted)
+  keys, positions = [], []
+
+  def visit(node, prefix):
+    if _is_dict(node):
+      if not node and keep_empty_nodes:
+        keys.append(prefix)
+        positions.append(treedef.num_leaves)
+      for key, value in node.items():
+        visit(value, prefix + (key,))
+    else:
+      keys.append(prefix)
+      positions.append(node)
+
+  visit(skeleton, ())
+  if sep is not None:
+    keys = [sep.join(path) for path in keys]
+  return tuple(keys), tuple(positions)
+
+
+def path_index(xs) -> PathIndex:
+  """Returns the cached `PathIndex` of a nested dictionary.
+
+  Args:
+    xs: a nested dictionary. Leaves must not be pytree nodes themselves (e.g.
+      lists or None) and the keys of every dictionary must be sortable.
+  Returns:
+    The `PathIndex` of the structure of `xs`, which is computed once and reused
+    for all dictionaries with the same structure.
+  """
+  _, index = _flatten_with_index(xs)
+  if index is None:
+    raise ValueError('Expected a nested dictionary with sortable keys and '
+                     f'no pytree node leaves, got {type(xs)}.')
+  return index
+
+
 def flatten_dict(xs, keep_empty_nodes=False, is_leaf=None, sep=None):
   """Flatten a nested dictionary.
 
@@ -78,6 +278,12 @@ def flatten_dict(xs, keep_empty_nodes=False, is_leaf=None, sep=None):
   Note that empty dictionaries are ignored and
   will not be restored by `unflatten_dict`.
 
+  Unless `is_leaf` is given, the paths of dictionaries
+  whose leaves are not pytree nodes are cached per tree
+  structure and key order. The flattened keys are in
+  the depth first order of the dictionary, like without
+  the cache.
+
   Args:
     xs: a nested dictionary
     keep_empty_nodes: replaces empty dictionaries
@@ -95,6 +301,24 @@ def flatten_dict(xs, keep_empty_nodes=False, is_leaf=None, sep=None):
     The flattened dictionary.
   """
   assert isinstance(xs, (flax.core.FrozenDict, dict)), 'expected (frozen)dict'
+  if is_leaf is None:
+    try:
+      leaves, treedef, key_order = serialization._flatten_with_key_order(xs)  # pylint: disable=protected-access
+      index = _treedef_path_index(treedef)
+    except (TypeError, ValueError):
+      # Unsortable keys or unhashable pytree node data.
+      index = None
+    if index is not None:
+      keys, positions = _flat_layout(treedef, key_order, keep_empty_nodes, sep)
+      if len(positions) != len(leaves):
+        leaves = leaves + [empty_node]
+      return dict(zip(keys, [leaves[i] for i in positions]))
+  return _flatten_dict_recursive(xs, keep_empty_nodes, is_leaf, sep)
+
+
+def _flatten_dict_recursive(xs, keep_empty_nodes=False, is_leaf=None,
+                            sep=None):
+  """Implementation of `flatten_dict` without a `PathIndex`."""
 
   def _key(path):
     if sep is None:
@@ -117,6 +341,52 @@ def flatten_dict(xs, keep_empty_nodes=False, is_leaf=None, sep=None):
   return _flatten(xs, ())
 
 
+@functools.lru_cache(maxsize=256)
+def _unflatten_layout(keys, sep):
+  """Returns the treedef and leaf order of a nested dict with flat `keys`.
+
+  Args:
+    keys: the flat keys of the nested dict.
+    sep: see `unflatten_dict`.
+  Returns:
+    The treedef of the nested dict and the positions of its leaves in `keys`,
+    or None if it has conflicting paths or dicts whose keys aren't sorted.
+  """
+  result = {}
+  for i, path in enumerate(keys):
+    if sep is not None:
+      path = tuple(path.split(sep))
+    if not path:
+      return None
+    cursor = result
+    for key in path[:-1]:
+      cursor = cursor.setdefault(key, {})
+      if not isinstance(cursor, dict):
+        return None
+    if path[-1] in cursor:
+      return None
+    cursor[path[-1]] = i
+  try:
+    order, treedef = jax.tree_util.tree_flatten(result)
+  except (TypeError, ValueError):
+    # Unsortable keys.
+    return None
+  if len(order) != len(keys):
+    return None
+  if order == list(range(len(keys))):
+    order = None
+
+  def is_sorted(node):
+    return list(node) == sorted(node) and all(
+        is_sorted(value) for value in node.values() if isinstance(value, dict))
+
+  # `tree_unflatten` sorts the keys, dicts with other key orders are built
+  # by `_unflatten_dict_recursive`.
+  if not is_sorted(result):
+    return None
+  return treedef, order
+
+
 def unflatten_dict(xs, sep=None):
   """Unflatten a dictionary.
 
@@ -135,6 +405,11 @@ def unflatten_dict(xs, sep=None):
     #   'bar': {'a': 2}
     # }
 
+  If the keys of every nested dictionary are sorted, the nested structure is
+  cached per tuple of flat keys, so unflattening dictionaries with the same
+  keys again only places the values. Otherwise the nested dictionaries are
+  built one key at a time, in the order of the flat keys.
+
   Args:
     xs: a flattened dictionary
     sep: separator (same as used with `flatten_dict()`).
@@ -142,6 +417,24 @@ def unflatten_dict(xs, sep=None):
     The nested dictionary.
   """
   assert isinstance(xs, dict), 'input is not a dict'
+  try:
+    layout = _unflatten_layout(tuple(xs), sep)
+  except TypeError:
+    # Unhashable keys.
+    layout = None
+  if layout is not None:
+    treedef, order = layout
+    values = list(xs.values())
+    if order is not None:
+      values = [values[i] for i in order]
+    if any(value is empty_node for value in values):
+      values = [{} if value is empty_node else value for value in values]
+    return jax.tree_util.tree_unflatten(treedef, values)
+  return _unflatten_dict_recursive(xs, sep)
+
+
+def _unflatten_dict_recursive(xs, sep=None):
+  """Implementation of `unflatten_dict` without a cached layout."""
   result = {}
   for path, value in xs.items():
     if sep is not None:
@@ -380,26 +673,65 @@ class TraverseTree(Traversal):
     yield from jax.tree_leaves(inputs)
 
 
-def _get_params_dict(inputs):
-  if isinstance(inputs, (dict, flax.core.FrozenDict)):
-    return flax.core.unfreeze(inputs)
-  else:
+def _check_params_dict(inputs):
+  if not isinstance(inputs, (dict, flax.core.FrozenDict)):
     raise ValueError(
         'Can only traverse a flax Model instance or a nested dict, not '
         f'{type(inputs)}')
 
 
+def _get_params_dict(inputs):
+  _check_params_dict(inputs)
+  return flax.core.unfreeze(inputs)
+
+
 def _sorted_items(x):
   """Returns items of a dict ordered by keys."""
   return sorted(x.items(), key=lambda x: x[0])
 
 
+@dataclasses.dataclass(frozen=True)
+class _Selection:
+  """The leaves selected by a `ModelParamTraversal` for a tree structure.
+
+  Attributes:
+    leaf_indices: positions of the leaves of all selected values in the leaves
+      of the traversed tree.
+    values_treedef: the treedef of the list of selected values.
+    num_values: the number of selected values.
+  """
+  leaf_indices: Tuple[int, ...]
+  values_treedef: Any
+  num_values: int
+
+
+# Maximum number of tree structures for which a `ModelParamTraversal` keeps its
+# compiled selection.
+_MAX_SELECTIONS = 16
+
+
+def _selection_key(leaves, treedef):
+  """Returns the key of the compiled selections of a tree.
+
+  Filters are called with the values of the tree, so besides the tree
+  structure the key includes the shape and dtype, or type, of every leaf.
+  """
+  return treedef, tuple((getattr(leaf, 'shape', None),
+                         getattr(leaf, 'dtype', type(leaf)))
+                        for leaf in leaves)
+
+
 class ModelParamTraversal(Traversal):
   """Select model parameters using a name filter.
 
   This traversal operates on a nested dictionary of parameters and selects a
   subset based on the `filter_fn` argument.
 
+  `filter_fn` is evaluated once per tree structure and leaf shapes and dtypes,
+  the selection is compiled into the positions of the selected leaves in
+  `jax.tree_util.tree_leaves` and reused by `iterate`, `update` and `set` for
+  trees with the same structure, shapes and dtypes.
+
   See :class:`flax.optim.MultiOptimizer` for an example of how to use
   :class:`ModelParamTraversal` to update subsets of the parameter tree with a
   specific optimizer.
@@ -412,11 +744,119 @@ class ModelParamTraversal(Traversal):
       filter_fn: a function that takes a parameter's full name and its value and
         returns whether this parameter should be selected or not. The name of a
         parameter is determined by the module hierarchy and the parameter name
-        (for example: '/module/sub_module/parameter_name').
+        (for example: '/module/sub_module/parameter_name'). Its result is
+        cached per tree structure and leaf shapes and dtypes, so it may look at
+        the shape and dtype of a value but not at its contents.
     """
     self._filter_fn = filter_fn
+    self._selections = {}
+
+  def _compile(self, inputs, treedef) -> Optional[_Selection]:
+    """Evaluates `filter_fn` on the values of `inputs` with structure `treedef`."""
+    leaf_indices = []
+    values = []
+    num_leaves = 0
+
+    def visit(xs, prefix):
+      nonlocal num_leaves
+      # Sorted like the leaves of `jax.tree_util.tree_flatten`.
+      for key, value in _sorted_items(xs):
+        path = prefix + (key,)
+        if isinstance(value, (dict, flax.core.FrozenDict)):
+          visit(value, path)
+          continue
+        start = num_leaves
+        num_leaves += jax.tree_util.tree_structure(value).num_leaves
+        if self._filter_fn('/' + '/'.join(path), value):
+          leaf_indices.extend(range(start, num_leaves))
+          values.append(value)
+
+    visit(inputs, ())
+    if num_leaves != treedef.num_leaves:
+      return None
+    return _Selection(tuple(leaf_indices),
+                      jax.tree_util.tree_structure(values), len(values))
+
+  def _select(self, inputs) -> Tuple[Any, Any, Optional[_Selection]]:
+    """Returns the leaves, treedef and compiled selection of `inputs`.
+
+    The selection is None if `inputs` can't be traversed by leaf positions, in
+    which case the traversal falls back to flattening `inputs` with
+    `flatten_dict`.
+    """
+    _check_params_dict(inputs)
+    try:
+      leaves, treedef = jax.tree_util.tree_flatten(inputs)
+      key = _selection_key(leaves, treedef)
+      selection = self._selections.get(key, False)
+    except (TypeError, ValueError):
+      # Unsortable keys or unhashable pytree node data.
+      return None, None, None
+    if selection is False:
+      selection = self._compile(inputs, treedef)
+      if len(self._selections) >= _MAX_SELECTIONS:
+        self._selections.clear()
+      self._selections[key] = selection
+    return leaves, treedef, selection
+
+  def leaf_indices(self, inputs) -> Optional[Tuple[int, ...]]:
+    """Returns the positions of the selected leaves.
+
+    Args:
+      inputs: a nested dictionary of parameters.
+    Returns:
+      The positions of the leaves of all selected values in
+      `jax.tree_util.tree_leaves(inputs)`, in the order of `iterate`, or None
+      if `inputs` can't be traversed by leaf positions.
+    """
+    _, _, selection = self._select(inputs)
+    if selection is None:
+      return None
+    return selection.leaf_indices
+
+  def _gather(self, leaves, selection):
+    return jax.tree_util.tree_unflatten(
+        selection.values_treedef,
+        [leaves[i] for i in selection.leaf_indices])
+
+  def _scatter(self, leaves, treedef, selection, values):
+    """Replaces the selected values, returns None if their structure changed."""
+    new_leaves, values_treedef = jax.tree_util.tree_flatten(list(values))
+    if values_treedef != selection.values_treedef:
+      return None
+    leaves = list(leaves)
+    for i, leaf in zip(selection.leaf_indices, new_leaves):
+      leaves[i] = leaf
+    return jax.tree_util.tree_unflatten(treedef, leaves)
 
   def iterate(self, inputs):
+    leaves, _, selection = self._select(inputs)
+    if selection is None:
+      yield from self._iterate_flat(inputs)
+    else:
+      yield from self._gather(leaves, selection)
+
+  def update(self, fn, inputs):
+    leaves, treedef, selection = self._select(inputs)
+    if selection is not None:
+      values = [fn(value) for value in self._gather(leaves, selection)]
+      outputs = self._scatter(leaves, treedef, selection, values)
+      if outputs is not None:
+        return outputs
+      # The new values have a different structure than the old ones, e.g.
+      # optimizer states replacing parameters.
+      fn = lambda _: values.pop(0)
+    return self._update_flat(fn, inputs)
+
+  def set(self, values, inputs):
+    leaves, treedef, selection = self._select(inputs)
+    if selection is not None and len(values) == selection.num_values:
+      outputs = self._scatter(leaves, treedef, selection, values)
+      if outputs is not None:
+        return outputs
+    return super().set(values, inputs)
+
+  def _iterate_flat(self, inputs):
     params = _get_params_dict(inputs)
     flat_dict = flatten_dict(params)
     for key, value in _sorted_items(flat_dict):
@@ -424,7 +864,7 @@ class ModelParamTraversal(Traversal):
       if self._filter_fn(path, value):
         yield value
 
-  def update(self, fn, inputs):
+  def _update_flat(self, fn, inputs):
     params = _get_params_dict(inputs)
     flat_dict = flatten_dict(params, keep_empty_nodes=True)
     new_dict = {}
@@ -0,0 +1,487 @@
+# Copyright 2022 The Flax Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for flax.training.checkpoints."""
+
+from concurrent import futures
+import os
+import threading
+from unittest import mock
+
+from absl.testing import absltest
+from flax import errors
+from flax import io
+from flax import serialization
+from flax.training import checkpoints
+import jax
+import numpy as np
+
+# Parse absl flags test_srcdir and test_tmpdir.
+jax.config.parse_flags_with_absl()
+
+
+def _example_state(step):
+  return {
+      'params': {'kernel': np.full((4, 3), step, np.float32),
+                 'bias': np.arange(3, dtype=np.int32) + step},
+      'opt_state': {'mu': np.zeros((4, 3), np.float32)},
+      'step': step,
+  }
+
+
+def assert_tree_equal(actual, expected):
+  jax.tree_util.tree_map(np.testing.assert_array_equal, actual, expected)
+
+
+class CheckpointsTest(absltest.TestCase):
+
+  def test_save_restore_checkpoints(self):
+    tmp_dir = self.create_tempdir().full_path
+    for step in (1, 2, 3):
+      checkpoints.save_checkpoint(tmp_dir, _example_state(step), step, keep=2)
+    self.assertEqual(checkpoints.latest_checkpoint(tmp_dir),
+                     f'{tmp_dir}/checkpoint_3')
+    restored = checkpoints.restore_checkpoint(tmp_dir, _example_state(0))
+    assert_tree_equal(restored, _example_state(3))
+    with self.assertRaises(ValueError):
+      checkpoints.restore_checkpoint(tmp_dir, None, step=1)
+
+  def test_manifest(self):
+    tmp_dir = self.create_tempdir().full_path
+    for step in (1, 2):
+      checkpoints.save_checkpoint(tmp_dir, _example_state(step), step, keep=2)
+    self.assertTrue(os.path.exists(f'{tmp_dir}/.checkpoint_manifest'))
+    # Listings and retention are served by the manifest.
+    with mock.patch.object(io, 'glob', side_effect=AssertionError):
+      checkpoints.save_checkpoint(tmp_dir, _example_state(10), 10, keep=2)
+      self.assertEqual(checkpoints.latest_checkpoint(tmp_dir),
+                       f'{tmp_dir}/checkpoint_10')
+    self.assertFalse(os.path.exists(f'{tmp_dir}/checkpoint_1'))
+    # A stale manifest falls back to listing the directory.
+    os.remove(f'{tmp_dir}/checkpoint_10')
+    self.assertEqual(checkpoints.latest_checkpoint(tmp_dir),
+                     f'{tmp_dir}/checkpoint_2')
+
+  def test_manifest_preempted(self):
+    tmp_dir = self.create_tempdir().full_path
+    for step in (1, 2):
+      checkpoints.save_checkpoint(tmp_dir, _example_state(step), step, keep=2)
+    # Preempted after the rename, before the manifest was rewritten.
+    with mock.patch.object(checkpoints, '_remove_old_checkpoints',
+                           side_effect=KeyboardInterrupt):
+      with self.assertRaises(KeyboardInterrupt):
+        checkpoints.save_checkpoint(tmp_dir, _example_state(3), 3, keep=2)
+    self.assertEqual(checkpoints.latest_checkpoint(tmp_dir),
+                     f'{tmp_dir}/checkpoint_3')
+    checkpoints.save_checkpoint(tmp_dir, _example_state(4), 4, keep=2)
+    self.assertFalse(os.path.exists(f'{tmp_dir}/checkpoint_2'))
+    # Preempted before the rename.
+    rename = io.rename
+    def rename_manifest_only(src, dst, overwrite=False):
+      if not dst.endswith('manifest'):
+        raise KeyboardInterrupt
+      rename(src, dst, overwrite=overwrite)
+    with mock.patch.object(io, 'rename', side_effect=rename_manifest_only):
+      with self.assertRaises(KeyboardInterrupt):
+        checkpoints.save_checkpoint(tmp_dir, _example_state(5), 5, keep=2)
+    self.assertEqual(checkpoints.latest_checkpoint(tmp_dir),
+                     f'{tmp_dir}/checkpoint_4')
+    checkpoints.save_checkpoint(tmp_dir, _example_state(5), 5, keep=2)
+    self.assertEqual(checkpoints.latest_checkpoint(tmp_dir),
+                     f'{tmp_dir}/checkpoint_5')
+    self.assertFalse(os.path.exists(f'{tmp_dir}/checkpoint_3'))
+
+  def test_save_restore_compressed(self):
+    tmp_dir = self.create_tempdir().full_path
+    checkpoints.save_checkpoint(tmp_dir, _example_state(1), 1, codec='zlib')
+    restored = checkpoints.restore_checkpoint(tmp_dir, _example_state(0))
+    assert_tree_equal(restored, _example_state(1))
+    restored = checkpoints.restore_checkpoint(tmp_dir, None, lazy=True)
+    assert_tree_equal(serialization.materialize(restored), _example_state(1))
+
+  def test_restore_compressed_parallel(self):
+    tmp_dir = self.create_tempdir().full_path
+    # Many small leaves, whose compressed bytes are read by several threads.
+    rng = np.random.RandomState(0)
+    state = {f'leaf_{i}': rng.randint(0, 4, (2048,)).astype(np.uint8)
+             for i in range(400)}
+    checkpoints.save_checkpoint(tmp_dir, state, 1, codec='zlib')
+    with mock.patch.object(serialization, '_default_max_workers', lambda: 16), \
+         mock.patch.object(checkpoints, '_SMALL_CHECKPOINT_BYTES', 0):
+      for _ in range(20):
+        restored = checkpoints.restore_checkpoint(tmp_dir, None)
+        assert_tree_equal(restored, state)
+    # Lazy leaves don't share the read-ahead window of the decoder.
+    with open(f'{tmp_dir}/checkpoint_1', 'rb') as fp:
+      lazy = serialization.msgpack_restore_lazy(fp)
+      self.assertTrue(lazy['leaf_0'].source.thread_safe)
+
+  def test_restore_small_checkpoint(self):
+    tmp_dir = self.create_tempdir().full_path
+    checkpoints.save_checkpoint(tmp_dir, _example_state(1), 1)
+    # Small checkpoints are decoded at once, larger ones leaf by leaf.
+    with mock.patch.object(serialization, 'msgpack_restore_lazy',
+                           side_effect=AssertionError):
+      restored = checkpoints.restore_checkpoint(tmp_dir, _example_state(0))
+    assert_tree_equal(restored, _example_state(1))
+    with mock.patch.object(checkpoints, '_SMALL_CHECKPOINT_BYTES', 0), \
+         mock.patch.object(serialization, 'msgpack_restore',
+                           side_effect=AssertionError):
+      restored = checkpoints.restore_checkpoint(tmp_dir, _example_state(0))
+    assert_tree_equal(restored, _example_state(1))
+
+  def test_restore_lazy(self):
+    tmp_dir = self.create_tempdir().full_path
+    checkpoints.save_checkpoint(tmp_dir, _example_state(1), 1)
+    lazy = checkpoints.restore_checkpoint(tmp_dir, None, lazy=True)
+    self.assertIsInstance(lazy['opt_state']['mu'], serialization.LazyArray)
+    target = {'params': _example_state(0)['params']}
+    restored = checkpoints.restore_checkpoint(tmp_dir, target, lazy=True)
+    assert_tree_equal(restored, {'params': _example_state(1)['params']})
+
+  def test_restore_paths(self):
+    tmp_dir = self.create_tempdir().full_path
+    checkpoints.save_checkpoint(tmp_dir, _example_state(1), 1, indexed=True)
+    checkpoints.save_checkpoint(tmp_dir, _example_state(2), 2, keep=2)
+    for step in (1, 2):
+      restored = checkpoints.restore_checkpoint(
+          tmp_dir, _example_state(0), step=step, paths=[('params',)])
+      expected = _example_state(0)
+      expected['params'] = _example_state(step)['params']
+      assert_tree_equal(restored, expected)
+      restored = checkpoints.restore_checkpoint(
+          tmp_dir, None, step=step, paths=lambda path, _: 'bias' in path)
+      assert_tree_equal(
+          restored, {'params': {'bias': _example_state(step)['params']['bias']}})
+
+  def test_dedup(self):
+    tmp_dir = self.create_tempdir().full_path
+    blob_dir = f'{tmp_dir}/.checkpoint_blobs'
+    for step in (1, 2, 3):
+      checkpoints.save_checkpoint(tmp_dir, _example_state(step), step, keep=2,
+                                  dedup=True)
+      # The frozen 'mu' leaf is shared by all checkpoints.
+      self.assertLen(os.listdir(blob_dir), 1 + 2 * min(step, 2))
+    restored = checkpoints.restore_checkpoint(tmp_dir, _example_state(0))
+    assert_tree_equal(restored, _example_state(3))
+    restored = checkpoints.restore_checkpoint(
+        tmp_dir, None, step=2, paths=[('params', 'bias')])
+    assert_tree_equal(
+        restored, {'params': {'bias': _example_state(2)['params']['bias']}})
+    # A regular save still garbage collects the unreferenced blobs, whose
+    # references are read from the directory manifest.
+    with mock.patch.object(checkpoints, '_blob_refs',
+                           side_effect=AssertionError):
+      checkpoints.save_checkpoint(tmp_dir, _example_state(4), 4, keep=1)
+    self.assertEmpty(os.listdir(blob_dir))
+
+  def test_dedup_overwrite(self):
+    tmp_dir = self.create_tempdir().full_path
+    blob_dir = f'{tmp_dir}/.checkpoint_blobs'
+    checkpoints.save_checkpoint(tmp_dir, _example_state(1), 1, dedup=True)
+    # The blobs of the overwritten checkpoint are garbage collected.
+    checkpoints.save_checkpoint(tmp_dir, _example_state(2), 1, overwrite=True,
+                                dedup=True)
+    self.assertLen(os.listdir(blob_dir), 3)
+    checkpoints.save_checkpoint(tmp_dir, _example_state(2), 1, overwrite=True)
+    self.assertEmpty(os.listdir(blob_dir))
+    # Also if the manifest was rescanned.
+    checkpoints.save_checkpoint(tmp_dir, _example_state(1), 1, overwrite=True,
+                                dedup=True)
+    os.remove(f'{tmp_dir}/.checkpoint_manifest')
+    checkpoints.save_checkpoint(tmp_dir, _example_state(2), 1, overwrite=True,
+                                dedup=True)
+    self.assertLen(os.listdir(blob_dir), 3)
+    assert_tree_equal(checkpoints.restore_checkpoint(tmp_dir, None),
+                      _example_state(2))
+
+  def test_dedup_corrupt_blob(self):
+    tmp_dir = self.create_tempdir().full_path
+    checkpoints.save_checkpoint(tmp_dir, _example_state(1), 1, dedup=True)
+    checkpoints.save_checkpoint(tmp_dir, _example_state(2), 2, keep=2,
+                                dedup=True)
+    kernel = np.full((4, 3), 2, np.float32)
+    blob_path = os.path.join(tmp_dir, '.checkpoint_blobs',
+                             checkpoints._array_digest(kernel))
+    with open(blob_path, 'r+b') as fp:
+      fp.truncate(kernel.nbytes - 4)
+    with self.assertRaisesRegex(errors.CorruptCheckpointError, 'bytes'):
+      checkpoints.restore_checkpoint(tmp_dir, _example_state(0))
+    restored = checkpoints.restore_checkpoint(tmp_dir, _example_state(0),
+                                              fallback=True)
+    assert_tree_equal(restored, _example_state(1))
+
+  def test_delta(self):
+    tmp_dir = self.create_tempdir().full_path
+    def state(step):
+      result = _example_state(1)
+      result['params']['bias'] = _example_state(step)['params']['bias']
+      result['step'] = step
+      return result
+    for step in (1, 2, 3, 4):
+      checkpoints.save_checkpoint(tmp_dir, state(step), step, keep=4,
+                                  delta=True, compact_every=2)
+      restored = checkpoints.restore_checkpoint(tmp_dir, _example_state(0))
+      assert_tree_equal(restored, state(step))
+    # Steps 2 and 3 are deltas against 1, step 4 is a new base.
+    header = checkpoints._read_delta_header(f'{tmp_dir}/checkpoint_3')
+    self.assertEqual((header['base'], header['depth']), ('checkpoint_1', 2))
+    _, stored = checkpoints._read_delta_state(f'{tmp_dir}/checkpoint_3')
+    self.assertEqual(set(stored['params']), {'bias'})
+    self.assertIsNone(checkpoints._read_delta_header(
+        f'{tmp_dir}/checkpoint_4')['base'])
+    restored = checkpoints.restore_checkpoint(tmp_dir, None, step=2)
+    assert_tree_equal(restored, state(2))
+    # Bases are removed together with their last delta.
+    checkpoints.save_checkpoint(tmp_dir, state(5), 5, delta=True)
+    self.assertEqual(sorted(os.listdir(tmp_dir)),
+                     ['.checkpoint_manifest', 'checkpoint_4', 'checkpoint_5'])
+
+  def test_delta_dirty_paths(self):
+    tmp_dir = self.create_tempdir().full_path
+    checkpoints.save_checkpoint(tmp_dir, _example_state(1), 1, delta=True)
+    checkpoints.save_checkpoint(tmp_dir, _example_state(2), 2, delta=True,
+                                dirty_paths=[('params', 'kernel')])
+    # The base is kept as long as the delta refers to it.
+    self.assertTrue(os.path.exists(f'{tmp_dir}/checkpoint_1'))
+    restored = checkpoints.restore_checkpoint(tmp_dir, None)
+    expected = _example_state(2)
+    # Only the dirty leaves and non-array leaves are stored.
+    expected['params']['bias'] = _example_state(1)['params']['bias']
+    assert_tree_equal(restored, expected)
+
+  def test_delta_manifest(self):
+    tmp_dir = self.create_tempdir().full_path
+    checkpoints.save_checkpoint(tmp_dir, _example_state(1), 1, delta=True)
+    # Retention reads the bases of the retained deltas from the manifest.
+    with mock.patch.object(checkpoints, '_delta_base',
+                           side_effect=AssertionError):
+      for step in (2, 3):
+        checkpoints.save_checkpoint(tmp_dir, _example_state(step), step,
+                                    delta=True)
+    self.assertTrue(os.path.exists(f'{tmp_dir}/checkpoint_1'))
+    # After a rescan the bases are read from the checkpoints once.
+    os.remove(f'{tmp_dir}/.checkpoint_manifest')
+    checkpoints.save_checkpoint(tmp_dir, _example_state(4), 4, keep=2,
+                                delta=True)
+    self.assertEqual(sorted(os.listdir(tmp_dir)),
+                     ['.checkpoint_manifest', 'checkpoint_1', 'checkpoint_3',
+                      'checkpoint_4'])
+    with mock.patch.object(checkpoints, '_delta_base',
+                           side_effect=AssertionError):
+      checkpoints.save_checkpoint(tmp_dir, _example_state(5), 5, keep=3,
+                                  delta=True)
+    assert_tree_equal(checkpoints.restore_checkpoint(tmp_dir, None),
+                      _example_state(5))
+
+  def test_restore_placement(self):
+    tmp_dir = self.create_tempdir().full_path
+    checkpoints.save_checkpoint(tmp_dir, _example_state(1), 1)
+    device = jax.devices()[0]
+    restored = checkpoints.restore_checkpoint(
+        tmp_dir, _example_state(0), placement=device)
+    self.assertIsInstance(restored['params']['kernel'], jax.xla.DeviceArray)
+    assert_tree_equal(restored, _example_state(1))
+    restored = checkpoints.restore_checkpoint(
+        tmp_dir, None, placement=[device], paths=[('params',)])
+    self.assertEqual(restored['params']['kernel'].shape, (1, 4, 3))
+    placed = []
+    def place(x):
+      placed.append(x.shape)
+      return jax.device_put(x, device)
+    checkpoints.save_checkpoint(tmp_dir, _example_state(2), 2, dedup=True)
+    restored = checkpoints.restore_checkpoint(tmp_dir, None, placement=place)
+    self.assertCountEqual(placed, [(4, 3), (3,), (4, 3)])
+    assert_tree_equal(restored, _example_state(2))
+
+  def test_restore_dtype(self):
+    tmp_dir = self.create_tempdir().full_path
+    target = _example_state(0)
+    target['opt_state']['mu'] = np.zeros((4, 3), np.float16)
+    dtypes = serialization.target_dtypes(target)
+    saves = [{}, {'indexed': True}, {'dedup': True}, {'delta': True},
+             {'codec': 'zlib'}]
+    for step, kwargs in enumerate(saves, 1):
+      checkpoints.save_checkpoint(tmp_dir, _example_state(step), step,
+                                  keep=len(saves), **kwargs)
+      for lazy in (False, True):
+        restored = checkpoints.restore_checkpoint(
+            tmp_dir, None, lazy=lazy, dtype=jax.numpy.bfloat16)
+        self.assertEqual(restored['params']['kernel'].dtype,
+                         jax.numpy.bfloat16)
+        self.assertEqual(restored['params']['bias'].dtype, np.int32)
+        assert_tree_equal(jax.tree_map(np.asarray, restored),
+                          _example_state(step))
+        restored = checkpoints.restore_checkpoint(
+            tmp_dir, target, lazy=lazy, dtype=dtypes)
+        self.assertEqual(restored['params']['kernel'].dtype, np.float32)
+        self.assertEqual(restored['opt_state']['mu'].dtype, np.float16)
+        assert_tree_equal(restored, _example_state(step))
+
+  def test_checksum(self):
+    tmp_dir = self.create_tempdir().full_path
+    for step in (1, 2, 3, 4):
+      # Checkpoint 3 is the base of the delta checkpoint 4.
+      checkpoints.save_checkpoint(tmp_dir, _example_state(step), step, keep=3,
+                                  checksum=True, delta=step >= 3)
+    self.assertEqual(
+        sorted(os.listdir(tmp_dir)),
+        ['.checkpoint_2.crc32', '.checkpoint_3.crc32', '.checkpoint_4.crc32',
+         '.checkpoint_manifest', 'checkpoint_2', 'checkpoint_3',
+         'checkpoint_4'])
+    restored = checkpoints.restore_checkpoint(tmp_dir, _example_state(0))
+    assert_tree_equal(restored, _example_state(4))
+    # Corrupt the base in place, which is detected when restoring the delta.
+    with open(f'{tmp_dir}/checkpoint_3', 'r+b') as fp:
+      data = fp.read()
+      fp.seek(data.index(np.zeros((4, 3), np.float32).tobytes()))
+      fp.write(np.full((4, 3), 7, np.float32).tobytes())
+    with self.assertRaisesRegex(errors.CorruptCheckpointError, 'mismatch'):
+      checkpoints.restore_checkpoint(tmp_dir, _example_state(0))
+    restored = checkpoints.restore_checkpoint(tmp_dir, _example_state(0),
+                                              step=3, verify=False)
+    self.assertEqual(restored['opt_state']['mu'][0, 0], 7)
+    with open(f'{tmp_dir}/checkpoint_4', 'r+b') as fp:
+      fp.truncate(os.path.getsize(f'{tmp_dir}/checkpoint_4') - 1)
+    with self.assertRaisesRegex(errors.CorruptCheckpointError, 'bytes'):
+      checkpoints.restore_checkpoint(tmp_dir, _example_state(0), step=4)
+    restored = checkpoints.restore_checkpoint(tmp_dir, _example_state(0),
+                                              fallback=True)
+    assert_tree_equal(restored, _example_state(2))
+    # Checksums are removed together with their checkpoints.
+    checkpoints.save_checkpoint(tmp_dir, _example_state(5), 5)
+    self.assertEqual(sorted(os.listdir(tmp_dir)),
+                     ['.checkpoint_manifest', 'checkpoint_5'])
+
+  def test_async_save(self):
+    tmp_dir = self.create_tempdir().full_path
+    checkpointer = checkpoints.AsyncCheckpointer()
+    state = _example_state(1)
+    future = checkpointer.save_checkpoint(tmp_dir, state, 1)
+    # The checkpoint holds a snapshot, later in-place updates are not saved.
+    state['params']['kernel'] += 1
+    self.assertEqual(future.result(), f'{tmp_dir}/checkpoint_1')
+    restored = checkpoints.restore_checkpoint(tmp_dir, _example_state(0))
+    assert_tree_equal(restored, _example_state(1))
+    for step in (2, 3):
+      checkpointer.save_checkpoint(tmp_dir, _example_state(step), step, keep=2)
+    checkpointer.wait_until_finished()
+    self.assertFalse(os.path.exists(f'{tmp_dir}/checkpoint_1'))
+    for step in (2, 3):
+      restored = checkpoints.restore_checkpoint(
+          tmp_dir, _example_state(0), step=step)
+      assert_tree_equal(restored, _example_state(step))
+
+  def test_async_save_error(self):
+    tmp_dir = self.create_tempdir().full_path
+    checkpointer = checkpoints.AsyncCheckpointer()
+    checkpointer.save_checkpoint(tmp_dir, _example_state(2), 2)
+    checkpointer.save_checkpoint(tmp_dir, _example_state(1), 1)
+    with self.assertRaises(errors.InvalidCheckpointError):
+      checkpointer.wait_until_finished()
+
+  def test_async_delta_save_after_error(self):
+    tmp_dir = self.create_tempdir().full_path
+    with checkpoints.AsyncCheckpointer() as checkpointer:
+      checkpointer.save_checkpoint(tmp_dir, _example_state(2), 2, delta=True)
+      failed = checkpointer.save_checkpoint(tmp_dir, _example_state(1), 1)
+      delta = checkpointer.save_checkpoint(tmp_dir, _example_state(3), 3,
+                                           delta=True)
+      with self.assertRaises(errors.InvalidCheckpointError):
+        failed.result()
+      with self.assertRaises(ValueError):
+        delta.result()
+      # A full save starts a new delta chain.
+      for step, is_delta in ((3, False), (4, True)):
+        checkpointer.save_checkpoint(tmp_dir, _example_state(step), step,
+                                     keep=3, delta=is_delta)
+      with self.assertRaises(errors.InvalidCheckpointError):
+        checkpointer.wait_until_finished()
+    # The worker is stopped when leaving the block.
+    with self.assertRaises(RuntimeError):
+      checkpointer.save_checkpoint(tmp_dir, _example_state(5), 5)
+    restored = checkpoints.restore_checkpoint(tmp_dir, _example_state(0))
+    assert_tree_equal(restored, _example_state(4))
+
+  @mock.patch.object(checkpoints, 'SHARD_SLICE_BYTES', 32)
+  def _save_sharded(self, tmp_dir, state, step, process_count, **kwargs):
+    # Simulates the processes by threads that synchronize at barriers.
+    barrier = threading.Barrier(process_count)
+    committed = []
+    def sync(name):
+      barrier.wait(timeout=60)
+      if 'commit' in name:
+        committed.append(checkpoints.latest_checkpoint(tmp_dir))
+    def save(process_index):
+      return checkpoints.save_sharded_checkpoint(
+          tmp_dir, state, step, process_index=process_index,
+          process_count=process_count, **kwargs)
+    with mock.patch.object(checkpoints, '_sync_processes', sync), \
+         futures.ThreadPoolExecutor(process_count) as pool:
+      list(pool.map(save, range(process_count)))
+    # All processes return once the checkpoint is committed.
+    self.assertEqual(committed,
+                     [f'{tmp_dir}/checkpoint_{step}'] * process_count)
+
+  def test_sharded_checkpoint(self):
+    tmp_dir = self.create_tempdir().full_path
+    for step in (1, 2):
+      self._save_sharded(tmp_dir, _example_state(step), step, 3)
+    self.assertEqual(sorted(os.listdir(tmp_dir)),
+                     ['.checkpoint_2.shards', '.checkpoint_manifest',
+                      'checkpoint_2'])
+    self.assertLen(os.listdir(f'{tmp_dir}/.checkpoint_2.shards'), 3)
+    restored = checkpoints.restore_checkpoint(tmp_dir, _example_state(0))
+    assert_tree_equal(restored, _example_state(2))
+    restored = checkpoints.restore_checkpoint(tmp_dir, None, paths=['params'])
+    assert_tree_equal(restored, {'params': _example_state(2)['params']})
+    # Only the shard that owns the selected leaf is read.
+    with mock.patch.object(checkpoints.io, 'GFile',
+                           wraps=checkpoints.io.GFile) as gfile:
+      restored = checkpoints.restore_checkpoint(
+          tmp_dir, None, paths=[('params', 'bias')])
+    assert_tree_equal(restored, {'params': {'bias': _example_state(2)[
+        'params']['bias']}})
+    shard_reads = [c for c in gfile.call_args_list if 'shard-' in c.args[0]]
+    self.assertLen(shard_reads, 1)
+    restored = checkpoints.restore_checkpoint(tmp_dir, None, dtype=np.float16)
+    self.assertEqual(restored['params']['kernel'].dtype, np.float16)
+    self.assertEqual(restored['params']['bias'].dtype, np.int32)
+    assert_tree_equal(restored, _example_state(2))
+
+  def test_sharded_checkpoint_stale_shards(self):
+    tmp_dir = self.create_tempdir().full_path
+    # An attempt that was preempted after process 1 wrote its shard.
+    with mock.patch.object(checkpoints, '_sync_processes',
+                           side_effect=KeyboardInterrupt):
+      with self.assertRaises(KeyboardInterrupt):
+        checkpoints.save_sharded_checkpoint(
+            tmp_dir, _example_state(7), 1, process_index=1, process_count=2)
+      with self.assertRaises(KeyboardInterrupt):
+        checkpoints.save_sharded_checkpoint(
+            tmp_dir, _example_state(7), 1, process_index=0, process_count=3)
+    self.assertIsNone(checkpoints.latest_checkpoint(tmp_dir))
+    # Only process 0 commits, after every process replaced its stale shard.
+    with mock.patch.object(checkpoints, '_remove_old_checkpoints',
+                           wraps=checkpoints._remove_old_checkpoints) as commit:
+      self._save_sharded(tmp_dir, _example_state(1), 1, 2)
+    commit.assert_called_once()
+    self.assertEqual(sorted(os.listdir(f'{tmp_dir}/.checkpoint_1.shards')),
+                     ['shard-00000-of-00002', 'shard-00001-of-00002'])
+    restored = checkpoints.restore_checkpoint(tmp_dir, _example_state(0))
+    assert_tree_equal(restored, _example_state(1))
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -29,6 +29,19 @@ class FrozenDictTest(absltest.TestCase):
     xs['b']['c'] += 1
     self.assertEqual(unfreeze(frozen), {'a': 1, 'b': {'c': 2}})
 
+  def test_frozen_dict_shares_nested_dicts(self):
+    frozen = freeze({'a': {'b': {'c': 1}}, 'd': 2})
+    nested = frozen['a']['b']
+    self.assertIsInstance(nested, FrozenDict)
+    self.assertIs(nested._dict, frozen._dict['a']['b'])
+    with self.assertRaises(ValueError):
+      nested['c'] = 2
+    rest, _ = frozen.pop('d')
+    self.assertIs(rest._dict['a'], frozen._dict['a'])
+    mutable = unfreeze(nested)
+    mutable['c'] = 2
+    self.assertEqual(frozen['a']['b']['c'], 1)
+
   def test_frozen_dict_maps(self):
     xs = {'a': 1, 'b': {'c': 2}}
     frozen = FrozenDict(xs)
@@ -80,6 +93,18 @@ class FrozenDictTest(absltest.TestCase):
     self.assertEqual(before, after)
     self.assertEqual(after, {'a': {'b': 1, 'c': 2}})
 
+  def test_frozen_dict_copy_shares_entries(self):
+    variables = freeze({'params': {'w': 1}, 'batch_stats': {'mean': 0}})
+    batch_stats = freeze({'mean': 1})
+    new_variables = variables.copy({'batch_stats': batch_stats})
+    self.assertIs(new_variables._dict['params'], variables._dict['params'])
+    self.assertIs(new_variables._dict['batch_stats'], batch_stats._dict)
+    self.assertEqual(variables['batch_stats'], {'mean': 0})
+    cache = {'index': {'i': 0}}
+    new_variables = new_variables.copy({'cache': cache})
+    cache['index']['i'] = 1
+    self.assertEqual(new_variables['cache'], {'index': {'i': 0}})
+
   def test_frozen_dict_copy_reserved_name(self):
     result = FrozenDict({'a': 1}).copy({'cls': 2})
     self.assertEqual(result, {'a': 1, 'cls': 2})
@@ -14,6 +14,7 @@
 
 from flax import errors
 from flax.core import Scope, init, apply, lift, nn, FrozenDict, unfreeze
+from flax.core import scope as scope_lib
 
 import jax
 from jax import random
@@ -110,5 +111,33 @@ class LiftTest(absltest.TestCase):
     y_t = apply(f)(params, x)
     np.testing.assert_allclose(y_t, jnp.ones_like(x))
 
+  def test_dedup_scopes(self):
+    root = Scope({})
+    a = root.push('a')
+    b = a.push('b')
+    c = b.push('c')
+    d = root.push('d').push('e')
+    scopes, paths = lift._dedup_scopes([c, d, b, a, c])
+    self.assertEqual(scopes, (d, a))
+    self.assertEqual(paths, ((a, ('b', 'c')), (d, ()), (a, ('b',)), (a, ()),
+                             (a, ('b', 'c'))))
+    self.assertEqual(lift._dedup_scopes([c]), ((c,), ((c, ()),)))
+    # Duplicated scopes with a common path prefix share their parents.
+    dup_c, dup_d, dup_b, dup_a, _ = lift._dup_scopes(scopes, scopes, paths)
+    self.assertIs(dup_c.parent, dup_b)
+    self.assertIs(dup_b.parent, dup_a)
+    self.assertIs(dup_d, d)
+
+  def test_compiled_filters(self):
+    filters = [True, False, 'params', ['params', 'cache'], set(),
+               scope_lib.DenyList('params'), scope_lib.DenyList(True)]
+    for col_filter in filters:
+      predicate = scope_lib._compile_filter(col_filter)
+      for col in ('params', 'cache', 'batch_stats'):
+        self.assertEqual(predicate(col), scope_lib.in_filter(col_filter, col))
+    predicate = scope_lib._compile_filter(1.)
+    with self.assertRaises(errors.InvalidFilterError):
+      predicate('params')
+
 if __name__ == '__main__':
   absltest.main()
@@ -111,6 +111,44 @@ class ScopeTest(absltest.TestCase):
     with self.assertRaisesRegex(errors.ScopeParamShapeError, msg):
       apply(f)(freeze({'params': {'test': np.ones((2,))}}))
 
+  def test_param_shapes_traced_once(self):
+    traced_shapes = []
+    def init_fn(rng, shape, *unused_args):
+      traced_shapes.append(shape)
+      return jnp.ones(shape)
+    def f(scope, *init_args):
+      scope.param('test', init_fn, *init_args)
+
+    variables = freeze({'params': {'test': np.ones((2,))}})
+    for _ in range(3):
+      apply(f)(variables, (2,))
+    self.assertEqual(traced_shapes, [(2,)])
+    with self.assertRaises(errors.ScopeParamShapeError):
+      apply(f)(variables, (4,))
+    for _ in range(2):
+      apply(f)(variables, [2])
+    self.assertEqual(traced_shapes, [(2,), (4,), [2]])
+    # Unhashable arguments are traced on every call.
+    for _ in range(2):
+      apply(f)(variables, (2,), np.zeros(()))
+    self.assertEqual(traced_shapes, [(2,), (4,), [2], (2,), (2,)])
+
+  def test_nested_collection_lookup(self):
+    variables = freeze({'params': {'a': {'b': {'w': 1}}}})
+    root = scope.bind(variables, mutable='batch_stats')
+    leaf = root.push('a').push('b')
+    self.assertEqual(leaf.get_variable('params', 'w'), 1)
+    self.assertFalse(leaf.has_variable('params', 'v'))
+    self.assertFalse(leaf.has_variable('cache', 'v'))
+    self.assertFalse(leaf.rewound().has_variable('cache', 'v'))
+    self.assertFalse(leaf.has_variable('batch_stats', 'mean'))
+    leaf.put_variable('batch_stats', 'mean', 2)
+    self.assertEqual(leaf.rewound().get_variable('batch_stats', 'mean'), 2)
+    self.assertEqual(root.variables(), freeze({
+        'params': {'a': {'b': {'w': 1}}},
+        'batch_stats': {'a': {'b': {'mean': 2}}}}))
+    self.assertEqual(root.push('c').variables(), freeze({}))
+
   def test_apply_variables_bad_pytree(self):
     def f(scope):
       scope.param('kernel', nn.initializers.ones, (4,))
@@ -185,6 +223,34 @@ class ScopeTest(absltest.TestCase):
     b = root.child(f)()
     self.assertFalse(jnp.allclose(a, b))
 
+  def test_child_rng_matches_eager_fold_in(self):
+    rng = random.PRNGKey(0)
+    root = Scope({}, {'params': rng, 'dropout': random.PRNGKey(1)})
+    leaf = root.push('a').push('b')
+    self.assertTrue(leaf.has_rng('dropout'))
+    expected = LazyRng.create(LazyRng.create(LazyRng.create(rng), 'a'), 'b')
+    self.assertTrue(np.all(leaf.rngs['params'].as_jax_rng() ==
+                           expected.as_jax_rng()))
+    self.assertTrue(np.all(
+        leaf.make_rng('params') ==
+        LazyRng.create(expected, 1).as_jax_rng()))
+    # The rng of a rewound scope is derived from the same parent rng.
+    self.assertTrue(np.all(leaf.rewound(rewind_rngs=True).make_rng('params') ==
+                           LazyRng.create(expected, 1).as_jax_rng()))
+
+  def test_rngs_are_read_only(self):
+    root = Scope({}, {'params': random.PRNGKey(0)})
+    leaf = root.push('a')
+    self.assertIs(leaf.rngs, leaf.rngs)
+    self.assertIn('params', leaf.rngs)
+    self.assertEqual(list(leaf.rngs), ['params'])
+    with self.assertRaises(TypeError):
+      leaf.rngs['dropout'] = random.PRNGKey(1)
+    self.assertNotIn('dropout', leaf.rngs)
+    leaf.rngs = {**leaf.rngs, 'dropout': LazyRng.create(random.PRNGKey(1))}
+    self.assertIn('dropout', leaf.rngs)
+    self.assertTrue(leaf.has_rng('dropout'))
+
   def test_empty_col_error(self):
     root = Scope({})
     with self.assertRaises(errors.ScopeCollectionNotFound):
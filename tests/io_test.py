@@ -0,0 +1,62 @@
+# Copyright 2022 The Flax Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for flax.io."""
+
+import os
+from unittest import mock
+
+from absl.testing import absltest
+from flax import io
+import jax
+
+# Parse absl flags test_srcdir and test_tmpdir.
+jax.config.parse_flags_with_absl()
+
+
+class IoTest(absltest.TestCase):
+
+  def test_get_backend(self):
+    self.assertIsInstance(io.get_backend('/tmp/ckpt'), io.LocalBackend)
+    self.assertIsInstance(io.get_backend('gs://bucket/ckpt'), io.GFileBackend)
+    backend = io.LocalBackend()
+    with mock.patch.dict(io._BACKENDS):
+      io.register_backend('mem://', backend)
+      self.assertIs(io.get_backend('MEM://ckpt'), backend)
+
+  def test_local_backend(self):
+    tmp_dir = self.create_tempdir().full_path
+    path = os.path.join(tmp_dir, 'a', 'b')
+    io.makedirs(os.path.dirname(path))
+    io.makedirs(os.path.dirname(path))
+    with io.GFile(path, 'wb') as fp:
+      fp.write(b'abc')
+    self.assertTrue(io.exists(path))
+    self.assertEqual(io.getsize(path), 3)
+    self.assertEqual(io.glob(os.path.join(tmp_dir, 'a', '*')), [path])
+    with io.GFile(path + '.tmp', 'wb') as fp:
+      fp.write(b'de')
+    with self.assertRaises(FileExistsError):
+      io.rename(path + '.tmp', path)
+    io.rename(path + '.tmp', path, overwrite=True)
+    with io.GFile(path, 'rb') as fp:
+      self.assertEqual(fp.read(), b'de')
+    io.remove(path)
+    self.assertFalse(io.exists(path))
+    io.rmtree(os.path.join(tmp_dir, 'a'))
+    self.assertFalse(io.isdir(os.path.join(tmp_dir, 'a')))
+
+
+if __name__ == '__main__':
+  absltest.main()
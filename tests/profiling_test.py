@@ -0,0 +1,93 @@
+# Copyright 2022 The Flax Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for flax.profiling."""
+
+import json
+import os
+
+from absl.testing import absltest
+from flax import linen as nn
+from flax import profiling
+import jax
+import jax.numpy as jnp
+
+# Parse absl flags test_srcdir and test_tmpdir.
+jax.config.parse_flags_with_absl()
+
+
+class MLP(nn.Module):
+
+  @nn.compact
+  def __call__(self, x):
+    x = nn.vmap(nn.Dense, variable_axes={'params': 0},
+                split_rngs={'params': True})(3)(x)
+    return nn.Dense(2)(x)
+
+
+class ProfilingTest(absltest.TestCase):
+
+  def test_trace_profile(self):
+    model = MLP()
+    x = jnp.ones((4, 2))
+    variables = model.init(jax.random.PRNGKey(0), x)
+    self.assertIsNone(profiling.current_profile())
+    with profiling.trace_profile() as profile:
+      self.assertIs(profiling.current_profile(), profile)
+      jax.jit(model.apply).lower(variables, x)
+    self.assertIsNone(profiling.current_profile())
+
+    stats = {(s.name, s.path): s for s in profile.summary()}
+    self.assertEqual(stats['MLP.__call__', '/'].calls, 1)
+    self.assertEqual(stats['Dense.__call__', '/Dense_0'].calls, 1)
+    self.assertEqual(stats['Dense.__call__', '/vmap(VmapDense_0)'].calls, 1)
+    self.assertIn(('lift.vmap', '/VmapDense_0'), stats)
+    self.assertIn(('group_collections', ''), stats)
+    # The self time excludes the nested calls.
+    root = stats['MLP.__call__', '/']
+    self.assertLess(root.self_time, root.total_time)
+
+    by_name = {s.name: s for s in profile.summary(by_path=False)}
+    self.assertEqual(by_name['Dense.__call__'].calls, 2)
+    table = profile.table(limit=3).splitlines()
+    self.assertLen(table, 4)
+    self.assertEqual(table[0].split(), ['name', 'path', 'calls', 'total',
+                                        'ms', 'self', 'ms'])
+
+    path = os.path.join(self.create_tempdir().full_path, 'trace.json')
+    profile.save_chrome_trace(path)
+    with open(path) as fp:
+      events = json.load(fp)['traceEvents']
+    self.assertLen(events, len(profile.events))
+    self.assertEqual(events[0]['ph'], 'X')
+
+  def test_disabled(self):
+    calls = []
+    @profiling.record('f')
+    def f(x):
+      calls.append(x)
+      return x
+    self.assertEqual(f(1), 1)
+    profile = profiling.enable_trace_profile()
+    try:
+      self.assertEqual(f(2), 2)
+    finally:
+      profiling.disable_trace_profile()
+    self.assertEqual(f(3), 3)
+    self.assertEqual(calls, [1, 2, 3])
+    self.assertEqual([s.calls for s in profile.summary()], [1])
+
+
+if __name__ == '__main__':
+  absltest.main()
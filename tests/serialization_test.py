@@ -0,0 +1,284 @@
+# Copyright 2022 The Flax Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for flax.serialization."""
+
+import io
+from typing import Any, NamedTuple
+from unittest import mock
+
+from absl.testing import absltest
+from flax import serialization
+from flax import struct
+from flax.core import freeze
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+# Parse absl flags test_srcdir and test_tmpdir.
+jax.config.parse_flags_with_absl()
+
+
+def _example_tree():
+  return {
+      'params': {
+          'kernel': np.arange(12, dtype=np.float32).reshape((3, 4)),
+          'bias': jnp.ones((4,), jnp.bfloat16),
+          'scale': np.float32(2.),
+      },
+      'step': 3,
+      'name': 'model',
+      'pair': complex(1., 2.),
+      'strided': np.arange(20, dtype=np.int64)[::3],
+  }
+
+
+class _Pair(NamedTuple):
+  first: Any
+  second: Any
+
+
+@struct.dataclass
+class _State:
+  step: int
+  params: Any
+  extra: Any = None
+
+
+def _nested_tree():
+  params = freeze({'dense': {'kernel': np.ones((2, 3)), 'bias': np.zeros(3)},
+                   'empty': {}})
+  return _State(step=1, params=params,
+                extra=_Pair([np.arange(3), (4, None)], {'b': 2., 'a': 1.}))
+
+
+class SerializationTest(absltest.TestCase):
+
+  def test_bulk_state_dict_matches_recursive(self):
+    tree = _nested_tree()
+    state = serialization.to_state_dict(tree)
+    with serialization._recursive_conversion():
+      expected = serialization.to_state_dict(tree)
+    jax.tree_util.tree_map(np.testing.assert_array_equal, state, expected)
+    self.assertEqual(state['params']['empty'], {})
+    self.assertEqual(state['extra']['first']['1'], {'0': 4, '1': None})
+    state['params']['dense']['bias'] = np.ones(3)
+    state['extra']['second']['a'] = serialization.msgpack_restore_lazy(
+        serialization.to_bytes(np.arange(2.)))
+    restored = serialization.from_state_dict(tree, state)
+    with serialization._recursive_conversion():
+      expected = serialization.from_state_dict(tree, state)
+    self.assertEqual(jax.tree_util.tree_structure(restored),
+                     jax.tree_util.tree_structure(tree))
+    jax.tree_util.tree_map(np.testing.assert_array_equal, restored, expected)
+    self.assertIsInstance(restored.extra.second['a'], np.ndarray)
+
+  def test_bulk_state_dict_key_order(self):
+    for tree in ({'b': 1, 'a': {'d': np.ones(2), 'c': 3}},
+                 {'a': {'c': 3, 'd': np.ones(2)}, 'b': 1},
+                 freeze({'b': 1, 'a': {'d': np.ones(2), 'c': 3}})):
+      state = serialization.to_state_dict(tree)
+      # Dicts keep the key order of the target, as with the recursive
+      # conversion.
+      self.assertEqual(list(state), list(tree))
+      self.assertEqual(list(state['a']), list(tree['a']))
+      restored = serialization.from_state_dict(tree, state)
+      self.assertEqual(list(restored), list(tree))
+      self.assertEqual(list(restored['a']), list(tree['a']))
+      restored = serialization.msgpack_restore(serialization.to_bytes(tree))
+      self.assertEqual(list(restored['a']), list(tree['a']))
+
+  def test_bulk_state_dict_mismatch(self):
+    tree = _nested_tree()
+    state = serialization.to_state_dict(tree)
+    state['unknown'] = 1
+    with self.assertRaisesRegex(ValueError, 'Unknown field'):
+      serialization.from_state_dict(tree, state)
+    state = serialization.to_state_dict(tree)
+    del state['step']
+    with self.assertRaisesRegex(ValueError, 'Missing field step'):
+      serialization.from_state_dict(tree, state)
+
+  def test_from_state_dict_validate(self):
+    tree = _nested_tree()
+    state = serialization.to_state_dict(tree)
+    state['params']['dense']['kernel'] = np.ones((3, 2))
+    state['params']['dense']['bias'] = np.zeros(3, np.float32)
+    serialization.from_state_dict(tree, state)
+    with self.assertRaisesRegex(
+        ValueError, r'/params/dense/bias: expected float64\[3\], got '
+        r'float32\[3\], /params/dense/kernel: expected float64\[2, 3\]'):
+      serialization.from_state_dict(tree, state, validate=True)
+
+  def test_msgpack_serialize_to_file_matches_bytes(self):
+    tree = _example_tree()
+    fp = io.BytesIO()
+    size = serialization.msgpack_serialize_to_file(tree, fp)
+    expected = serialization.msgpack_serialize(dict(tree), in_place=True)
+    self.assertEqual(fp.getvalue(), expected)
+    self.assertEqual(size, len(expected))
+
+  def test_to_file_restore(self):
+    tree = _example_tree()
+    fp = io.BytesIO()
+    serialization.to_file(tree, fp)
+    restored = serialization.from_bytes(tree, fp.getvalue())
+    jax.tree_util.tree_map(np.testing.assert_array_equal, restored, tree)
+
+  def test_to_file_chunked(self):
+    tree = {'a': np.arange(1000, dtype=np.float32).reshape((10, 100))}
+    with mock.patch.object(serialization, 'MAX_CHUNK_SIZE', 1024):
+      fp = io.BytesIO()
+      serialization.to_file(tree, fp)
+      self.assertEqual(fp.getvalue(), serialization.to_bytes(tree))
+    restored = serialization.msgpack_restore(fp.getvalue())
+    np.testing.assert_array_equal(restored['a'], tree['a'])
+
+  def test_chunked_non_contiguous(self):
+    tree = {'a': np.arange(1000, dtype=np.float32).reshape((10, 100)).T}
+    with mock.patch.object(serialization, 'MAX_CHUNK_SIZE', 1024):
+      encoded = serialization.to_bytes(tree)
+      fp = io.BytesIO()
+      serialization.to_file(tree, fp)
+    self.assertEqual(fp.getvalue(), encoded)
+    restored = serialization.msgpack_restore(encoded)
+    self.assertTrue(restored['a'].flags.writeable)
+    np.testing.assert_array_equal(restored['a'], tree['a'])
+
+  def test_msgpack_restore_lazy(self):
+    tree = _example_tree()
+    encoded = serialization.to_bytes(tree)
+    lazy = serialization.msgpack_restore_lazy(encoded)
+    self.assertIsInstance(lazy['params']['kernel'], serialization.LazyArray)
+    self.assertEqual(lazy['params']['kernel'].shape, (3, 4))
+    self.assertEqual(lazy['params']['bias'].dtype, jnp.bfloat16)
+    self.assertEqual(lazy['step'], 3)
+    restored = serialization.from_state_dict(tree, lazy)
+    jax.tree_util.tree_map(np.testing.assert_array_equal, restored, tree)
+
+  def test_msgpack_restore_lazy_chunked(self):
+    tree = {'a': np.arange(1000, dtype=np.float32).reshape((10, 100))}
+    with mock.patch.object(serialization, 'MAX_CHUNK_SIZE', 1024):
+      encoded = serialization.to_bytes(tree)
+    lazy = serialization.msgpack_restore_lazy(encoded)
+    self.assertEqual(lazy['a'].shape, (10, 100))
+    np.testing.assert_array_equal(np.asarray(lazy['a']), tree['a'])
+
+  def test_indexed_roundtrip(self):
+    tree = _example_tree()
+    tree['empty'] = {}
+    fp = io.BytesIO()
+    size = serialization.indexed_serialize_to_file(tree, fp)
+    self.assertEqual(size, len(fp.getvalue()))
+    self.assertTrue(serialization.is_indexed_format(fp.getvalue()))
+    restored = serialization.indexed_restore(fp)
+    self.assertEqual(restored['empty'], {})
+    jax.tree_util.tree_map(np.testing.assert_array_equal, restored, tree)
+
+  def test_indexed_restore_paths(self):
+    tree = _example_tree()
+    fp = io.BytesIO()
+    serialization.indexed_serialize_to_file(tree, fp)
+    restored = serialization.indexed_restore(
+        fp, paths=[('params', 'kernel'), 'strided'])
+    self.assertEqual(set(restored), {'params', 'strided'})
+    self.assertEqual(set(restored['params']), {'kernel'})
+    np.testing.assert_array_equal(restored['params']['kernel'],
+                                  tree['params']['kernel'])
+    # A string is a single path, not a collection of one character paths.
+    restored = serialization.indexed_restore(fp, paths='params/kernel')
+    self.assertEqual(set(restored), {'params'})
+    self.assertEqual(set(restored['params']), {'kernel'})
+    lazy = serialization.indexed_restore(
+        fp.getvalue(), paths=lambda path, _: path.startswith('/params/'),
+        lazy=True)
+    self.assertEqual(set(lazy['params']), {'kernel', 'bias', 'scale'})
+    self.assertIsInstance(lazy['params']['bias'], serialization.LazyArray)
+
+  def test_materialize_parallel(self):
+    tree = {'a': np.arange(1000, dtype=np.float32).reshape((10, 100)),
+            'b': {'c': np.ones((7,), np.int8), 'd': 'foo'}}
+    with mock.patch.object(serialization, 'MAX_CHUNK_SIZE', 1024):
+      encoded = serialization.to_bytes(tree)
+    for fp in (encoded, io.BytesIO(encoded)):
+      lazy = serialization.msgpack_restore_lazy(fp)
+      restored, stats = serialization.materialize_parallel(
+          lazy, open_file=lambda: io.BytesIO(encoded), max_workers=4,
+          chunk_size=512)
+      jax.tree_util.tree_map(np.testing.assert_array_equal, restored, tree)
+      self.assertEqual(stats.num_bytes, 4007)
+      self.assertEqual(stats.num_threads, 4)
+
+  def test_compressed(self):
+    tree = _example_tree()
+    tree['zeros'] = np.zeros((1000,), np.float32)
+    for codec in ('zlib', 'lzma'):
+      encoded = serialization.to_bytes(tree, codec=codec)
+      self.assertLess(len(encoded), len(serialization.to_bytes(tree)))
+      fp = io.BytesIO()
+      serialization.to_file(tree, fp, codec=codec)
+      self.assertEqual(fp.getvalue(), encoded)
+      restored = serialization.from_bytes(tree, encoded)
+      jax.tree_util.tree_map(np.testing.assert_array_equal, restored, tree)
+      lazy = serialization.msgpack_restore_lazy(encoded)
+      self.assertEqual(lazy['zeros'].codecs, ((codec, 4000),))
+      restored, _ = serialization.materialize_parallel(lazy, max_workers=2)
+      jax.tree_util.tree_map(np.testing.assert_array_equal, restored, tree)
+
+  def test_compressed_chunked(self):
+    tree = {'a': np.zeros((10, 100), np.float32),
+            'b': np.random.RandomState(0).randint(0, 256, 2500, np.uint8)}
+    with mock.patch.object(serialization, 'MAX_CHUNK_SIZE', 1024):
+      encoded = serialization.to_bytes(tree, codec='zlib')
+    restored = serialization.msgpack_restore(encoded)
+    jax.tree_util.tree_map(np.testing.assert_array_equal, restored, tree)
+    lazy = serialization.msgpack_restore_lazy(io.BytesIO(encoded))
+    # Random chunks don't compress and are stored raw.
+    self.assertEqual(lazy['b'].codecs, (None, None, None))
+    restored, _ = serialization.materialize_parallel(
+        lazy, max_workers=4, chunk_size=256)
+    jax.tree_util.tree_map(np.testing.assert_array_equal, restored, tree)
+
+  def test_restore_dtype(self):
+    # Values that are exact in bfloat16.
+    a = np.arange(1000, dtype=np.float32).reshape((10, 100)) % 256
+    tree = {'a': a, 'b': np.arange(3, dtype=np.int32), 'c': np.float32(2.)}
+    with mock.patch.object(serialization, 'MAX_CHUNK_SIZE', 1024):
+      encoded = serialization.to_bytes(tree)
+      compressed = serialization.to_bytes(tree, codec='zlib')
+    for data in (encoded, compressed):
+      restored = serialization.from_bytes(tree, data, dtype=jnp.bfloat16)
+      self.assertEqual(restored['a'].dtype, jnp.bfloat16)
+      self.assertEqual(restored['b'].dtype, np.int32)
+      self.assertEqual(restored['c'].dtype, jnp.bfloat16)
+      jax.tree_util.tree_map(np.testing.assert_array_equal, restored, tree)
+      lazy = serialization.msgpack_restore_lazy(
+          data, dtype=lambda path, dtype: np.float16 if path == '/a' else None)
+      self.assertEqual(lazy['a'].dtype, np.float16)
+      self.assertEqual(lazy['a'].stored_dtype, np.float32)
+      restored, stats = serialization.materialize_parallel(
+          lazy, max_workers=4, chunk_size=256)
+      self.assertEqual(restored['a'].dtype, np.float16)
+      self.assertEqual(stats.num_bytes, 4012)
+      np.testing.assert_array_equal(
+          np.asarray(serialization.msgpack_restore_lazy(
+              data, dtype=np.float16)['a']), tree['a'])
+
+  def test_unknown_codec(self):
+    with self.assertRaisesRegex(ValueError, 'Unknown compression codec'):
+      serialization.to_bytes({'a': np.zeros((3,))}, codec='foo')
+
+
+if __name__ == '__main__':
+  absltest.main()
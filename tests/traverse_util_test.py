@@ -21,6 +21,7 @@ import flax
 from flax.core import freeze
 from flax import traverse_util
 import jax
+import numpy as np
 
 # Parse absl flags test_srcdir and test_tmpdir.
 jax.config.parse_flags_with_absl()
@@ -204,6 +205,64 @@ class TraversalTest(absltest.TestCase):
     xs_restore = traverse_util.unflatten_dict(flat_xs)
     self.assertEqual(xs, xs_restore)
 
+  def test_flatten_dict_matches_recursive(self):
+    xs = {'foo': 1, 'bar': {'b': {}, 'a': (2, 3)}, 'baz': None,
+          'frozen': freeze({'c': {'d': 4}})}
+    params = {'b': {'kernel': 1, 'bias': {}}, 'a': freeze({'c': 2})}
+    for x in (xs, freeze(xs), params, freeze(params), {'a': 1, 2: 3},
+              {'a': {}}):
+      for keep_empty_nodes in (False, True):
+        flat_xs = traverse_util.flatten_dict(
+            x, keep_empty_nodes=keep_empty_nodes)
+        expected = traverse_util._flatten_dict_recursive(
+            x, keep_empty_nodes=keep_empty_nodes)
+        self.assertEqual(flat_xs, expected)
+        self.assertEqual(list(flat_xs), list(expected))
+        self.assertEqual(traverse_util.unflatten_dict(flat_xs),
+                         traverse_util._unflatten_dict_recursive(flat_xs))
+    self.assertEqual(
+        traverse_util.unflatten_dict({'a/b': 1, 'a/c': 2}, sep='/'),
+        {'a': {'b': 1, 'c': 2}})
+    # Conflicting paths are handled like before.
+    self.assertEqual(traverse_util.unflatten_dict({('a', 'b'): 1, ('a',): 2}),
+                     {'a': 2})
+
+  def test_flatten_dict_key_order(self):
+    xs = {'b': 1, 'a': {'d': 2, 'c': 3}, 'e': {}}
+    for x in (xs, freeze(xs)):
+      flat_xs = traverse_util.flatten_dict(x)
+      self.assertEqual(list(flat_xs), [('b',), ('a', 'd'), ('a', 'c')])
+      flat_xs = traverse_util.flatten_dict(x, keep_empty_nodes=True, sep='/')
+      self.assertEqual(list(flat_xs), ['b', 'a/d', 'a/c', 'e'])
+    xs_restore = traverse_util.unflatten_dict(
+        traverse_util.flatten_dict(xs, keep_empty_nodes=True))
+    self.assertEqual(list(xs_restore), ['b', 'a', 'e'])
+    self.assertEqual(list(xs_restore['a']), ['d', 'c'])
+
+  def test_path_index(self):
+    xs = {'enc': {'layer_1': {'kernel': 1}, 'layer_0': {'kernel': 2, 'bias': 3}},
+          'dec': {'kernel': 4}, 'empty': {}}
+    index = traverse_util.path_index(xs)
+    self.assertIs(index, traverse_util.path_index(
+        jax.tree_util.tree_map(lambda x: -x, xs)))
+    self.assertEqual(index.paths, (
+        ('dec', 'kernel'), ('enc', 'layer_0', 'bias'),
+        ('enc', 'layer_0', 'kernel'), ('enc', 'layer_1', 'kernel')))
+    self.assertEqual(index.empty_paths, (('empty',),))
+    self.assertEqual(index.positions[('enc', 'layer_1', 'kernel')], 3)
+    self.assertEqual(list(index.prefix(('enc',))), [1, 2, 3])
+    self.assertEqual(list(index.prefix(('enc', 'layer_0'))), [1, 2])
+    self.assertEqual(list(index.prefix(('foo',))), [])
+    self.assertEqual(index.match(r'/kernel$'), (0, 2, 3))
+    self.assertEqual(index.match(r'^/enc/.*/bias'), (1,))
+    leaves = jax.tree_util.tree_leaves(xs)
+    self.assertEqual(index.flatten(leaves, keep_empty_nodes=True, sep='.'), {
+        'dec.kernel': 4, 'enc.layer_0.bias': 3, 'enc.layer_0.kernel': 2,
+        'enc.layer_1.kernel': 1, 'empty': traverse_util.empty_node})
+    self.assertEqual(index.unflatten(leaves), xs)
+    with self.assertRaises(ValueError):
+      traverse_util.path_index({'a': [1, 2]})
+
 
 class ModelParamTraversalTest(absltest.TestCase):
 
@@ -253,6 +312,41 @@ class ModelParamTraversalTest(absltest.TestCase):
       new_model = traversal.update(lambda x: x + x, model)
       self.assertEqual(new_model, expected_model)
 
+  def test_param_selection_is_compiled(self):
+    params = freeze({'b': {'kernel': 1, 'bias': 2}, 'a': {'kernel': 3},
+                     'empty': {}})
+    names = []
+    def filter_fn(name, _):
+      names.append(name)
+      return name.endswith('kernel')
+    traversal = traverse_util.ModelParamTraversal(filter_fn)
+    self.assertEqual(traversal.leaf_indices(params), (0, 2))
+    self.assertEqual(list(traversal.iterate(params)), [3, 1])
+    new_params = traversal.set([5, 6], params)
+    self.assertEqual(new_params, freeze(
+        {'b': {'kernel': 6, 'bias': 2}, 'a': {'kernel': 5}, 'empty': {}}))
+    self.assertEqual(traversal.update(lambda x: -x, new_params), freeze(
+        {'b': {'kernel': -6, 'bias': 2}, 'a': {'kernel': -5}, 'empty': {}}))
+    # The filter is only evaluated once for the structure of `params`.
+    self.assertEqual(names, ['/a/kernel', '/b/bias', '/b/kernel'])
+    with self.assertRaisesRegex(ValueError, 'Too many values'):
+      traversal.set([5, 6, 7], params)
+    # Values can change their structure.
+    self.assertEqual(traversal.update(lambda x: (x, x), params), freeze(
+        {'b': {'kernel': (1, 1), 'bias': 2}, 'a': {'kernel': (3, 3)},
+         'empty': {}}))
+
+  def test_value_dependent_filter(self):
+    traversal = traverse_util.ModelParamTraversal(lambda _, v: v.ndim == 2)
+    params = {'a': {'kernel': np.ones((2, 2)), 'bias': np.ones(2)}}
+    self.assertEqual([v.shape for v in traversal.iterate(params)], [(2, 2)])
+    # Same structure, but the filter selects another leaf.
+    params = {'a': {'kernel': np.ones(2), 'bias': np.ones((2, 2))}}
+    self.assertEqual([v.shape for v in traversal.iterate(params)], [(2, 2)])
+    new_params = traversal.update(lambda x: 2 * x, params)
+    np.testing.assert_array_equal(new_params['a']['bias'], 2 * np.ones((2, 2)))
+    np.testing.assert_array_equal(new_params['a']['kernel'], np.ones(2))
+
 
 if __name__ == '__main__':
   absltest.main()